@@ -453,6 +453,97 @@ def get_header(filename,i):
 		e.read_image(filename,i,read_header_only)
 		return e.get_attr_dict()
 
+# header values of these types are stored in the header index, others (ctf, EMData, ...) are read from the file when needed
+HEADER_INDEX_TYPES=(int,long,float,bool,str,unicode,list,tuple,Transform)
+header_index_cache={}
+header_index_lock=threading.Lock()
+
+def header_index_path(filename):
+	"""Returns the path of the sidecar file holding the header index for an image file"""
+	d,f=os.path.split(os.path.abspath(filename))
+	return os.path.join(d,"."+f+".hdridx")
+
+def header_index(filename):
+	"""Returns the header index of a (non-bdb) image stack. This is a dictionary with the number of images "n", a dictionary
+	"columns" mapping each header key to a list with one value per image (None where the key is absent) and a set "skipped"
+	of keys whose values weren't indexed. The index is kept in a sidecar file next to the stack, keyed by path, size and mtime.
+	If the stack changes it is rebuilt, unless images were only appended, in which case only the new headers are read."""
+
+	path=os.path.abspath(filename)
+	with header_index_lock:
+		st=os.stat(path)
+		idx=header_index_cache.get(path)
+		if idx==None :
+			try: idx=cPickle.load(open(header_index_path(path),"rb"))
+			except: idx=None
+			if idx!=None and idx.get("path")!=path : idx=None
+		if idx!=None and idx["size"]==st.st_size and idx["mtime"]==st.st_mtime :
+			header_index_cache[path]=idx
+			return idx
+
+		n=EMUtil.get_image_count(path)
+
+		# if the file grew and has more images, we assume they were appended and keep the existing entries
+		if idx==None or st.st_size<=idx["size"] or n<=idx["n"] :
+			idx={"path":path,"n":0,"columns":{},"skipped":set()}
+
+		cols=idx["columns"]
+		tmp=EMData()
+		for i in xrange(idx["n"],n):
+			tmp.read_image(path,i,True)
+			for k,v in tmp.get_attr_dict().items():
+				if not isinstance(v,HEADER_INDEX_TYPES) :
+					idx["skipped"].add(k)
+					continue
+				if not cols.has_key(k) : cols[k]=[None]*i
+				cols[k].append(v)
+			for c in cols.values():
+				if len(c)==i : c.append(None)
+
+		idx["n"]=n
+		idx["size"]=st.st_size
+		idx["mtime"]=st.st_mtime
+		header_index_cache[path]=idx
+
+		# written under a temporary name, so other processes never see a partial index
+		try:
+			tmpname="{}.{}".format(header_index_path(path),os.getpid())
+			out=open(tmpname,"wb")
+			cPickle.dump(idx,out,2)
+			out.close()
+			os.rename(tmpname,header_index_path(path))
+		except: pass		# eg - read-only directory, the in-memory copy is still useful
+
+	return idx
+
+def get_headers(filename,keys,default=None):
+	"""Returns a dictionary mapping each header key in keys (or a single key) to its values for every image in filename,
+	using the header index for non-bdb files. Columns of numbers present in every image are returned as numpy arrays,
+	so selections like get_headers(f,"ptcl_source_image") can be vectorized. Other columns are lists with default for
+	images lacking the key."""
+	import numpy as np
+
+	if isinstance(keys,str) : keys=[keys]
+
+	if filename[:4].lower()=="bdb:" :
+		hdrs=[get_header(filename,i) for i in xrange(EMUtil.get_image_count(filename))]
+		cols=dict([(k,[h.get(k,None) for h in hdrs]) for k in keys])
+	else :
+		idx=header_index(filename)
+		cols={}
+		for k in keys:
+			if k in idx["skipped"] : cols[k]=[get_header(filename,i).get(k,None) for i in xrange(idx["n"])]
+			else : cols[k]=idx["columns"].get(k,[None]*idx["n"])
+
+	ret={}
+	for k,c in cols.items():
+		if len(c)>0 and all(isinstance(v,(int,long,float)) and not isinstance(v,bool) for v in c) : ret[k]=np.array(c)
+		else : ret[k]=[default if v is None else v for v in c]
+
+	return ret
+
+EMUtil.get_headers=staticmethod(get_headers)
+
 def remove_image(fsp):
 	"""This will remove the image file pointed to by fsp. The reason for this function
 	to exist is formats like IMAGIC which store data in two files. This insures that
@@ -1913,21 +2004,31 @@ The file begins with
 # Line length (including \n)
 number<\t>filename<\t>comment
 ...
+
+If opened readonly, the file is memory mapped, and the number of records is computed from the file size rather than
+by reading every line. A read-only file with inconsistent line lengths is indexed by scanning its lines once instead. read_range(), read_many() and read_images() provide efficient access to many records at once.
 """
-	def __init__(self,path,ifexists=False):
+	def __init__(self,path,ifexists=False,readonly=False):
 		"""Initialize the object using the .lst file in 'path'. If 'ifexists' is set, an exception will be raised
-if the lst file does not exist."""
+if the lst file does not exist. If 'readonly' is set, the file must exist, and write() is not permitted."""
 
 		self.path=path
+		self.readonly=readonly
+		self.mm=None
+		self.offsets=None		# record start offsets, only used for read-only files which are not normalized
 
-		try: self.ptr=file(path,"r+")		# file exists
-		except:
-			if ifexists: raise Exception,"Error: lst file {} does not exist".format(path)
+		if readonly :
+			try: self.ptr=file(path,"r")
+			except: raise Exception,"Error: lst file {} does not exist".format(path)
+		else:
+			try: self.ptr=file(path,"r+")		# file exists
+			except:
+				if ifexists: raise Exception,"Error: lst file {} does not exist".format(path)
 
-			try: os.makedirs(os.path.dirname(path))
-			except: pass
-			self.ptr=file(path,"w+")	# file doesn't exist
-			self.ptr.write("#LSX\n# This file is in fast LST format. All lines after the next line have exactly the number of characters shown on the next line. This MUST be preserved if editing.\n# 20\n")
+				try: os.makedirs(os.path.dirname(path))
+				except: pass
+				self.ptr=file(path,"w+")	# file doesn't exist
+				self.ptr.write("#LSX\n# This file is in fast LST format. All lines after the next line have exactly the number of characters shown on the next line. This MUST be preserved if editing.\n# 20\n")
 
 		self.ptr.seek(0)
 		l=self.ptr.readline()
@@ -1939,7 +2040,8 @@ if the lst file does not exist."""
 			raise Exception
 		self.seekbase=self.ptr.tell()
 
-		self.normalize()
+		if readonly : self.index()
+		else : self.normalize()
 
 	def __del__(self):
 		self.close()
@@ -1953,7 +2055,11 @@ if the lst file does not exist."""
 
 	def close(self):
 		"""Once you call this, you should not try to access this object any more"""
-		self.normalize()
+		if getattr(self,"ptr",None)==None : return
+		if self.mm!=None :
+			self.mm.close()
+			self.mm=None
+		if not self.readonly : self.normalize()
 		self.ptr=None
 
 	def write(self,n,nextfile,extfile,comment=None):
@@ -1963,6 +2069,7 @@ nextfile : the image number in the referenced image file
 extfile : the path to the referenced image file (can be relative or absolute, depending on purpose)
 comment : optional comment string"""
 
+		if self.readonly : raise Exception,"Error: #LSX file {} opened read-only".format(self.path)
 		if comment==None : outln="{}\t{}".format(nextfile,extfile)
 		else: outln="{}\t{}\t{}".format(nextfile,extfile,comment)
 		if len(outln)+1>self.linelen : self.rewrite(len(outln))
@@ -1982,13 +2089,71 @@ comment : optional comment string"""
 		"""Reads the nth record in the file. Note that this does not read the referenced image, which can be
 performed with read_image either here or in the EMData class. Returns a tuple (n extfile,extfile,comment)"""
 		if n>=self.n : raise Exception,"Attempt to read record {} from #LSX {} with {} records".format(n,self.path,self.n)
-		self.ptr.seek(self.seekbase+self.linelen*n)
-		ln=self.ptr.readline().strip().split("\t")
+		if self.mm!=None : ln=self.mm[self.recpos(n):self.recpos(n+1)].strip().split("\t")
+		else :
+			self.ptr.seek(self.seekbase+self.linelen*n)
+			ln=self.ptr.readline().strip().split("\t")
 		if len(ln)==2 : ln.append(None)
 		ln[0]=int(ln[0])
 
 		return ln
 
+	def read_range(self,start=0,stop=None):
+		"""Reads records start through stop-1 (default all) with a single read. Returns three columns, a numpy array
+of image numbers, a list of filenames and a list of comments (None if no comment)"""
+		if stop==None or stop>self.n : stop=self.n
+		if start>=stop : return self.columns([])
+
+		if self.mm!=None : buf=self.mm[self.recpos(start):self.recpos(stop)]
+		else :
+			self.ptr.seek(self.seekbase+self.linelen*start)
+			buf=self.ptr.read(self.linelen*(stop-start))
+
+		return self.columns(buf.split("\n")[:stop-start])
+
+	def read_many(self,indices):
+		"""Reads the records in an arbitrary list of indices. Returns the same three columns as read_range(), in the
+order of indices"""
+		lines=[]
+		for n in indices:
+			if n>=self.n : raise Exception,"Attempt to read record {} from #LSX {} with {} records".format(n,self.path,self.n)
+			if self.mm!=None : lines.append(self.mm[self.recpos(n):self.recpos(n+1)])
+			else :
+				self.ptr.seek(self.seekbase+self.linelen*n)
+				lines.append(self.ptr.readline())
+
+		return self.columns(lines)
+
+	def columns(self,lines):
+		"""Converts a list of raw records into (image number array, filename list, comment list)"""
+		import numpy as np
+
+		recs=[l.strip().split("\t",2) for l in lines]
+		nums=np.array([int(r[0]) for r in recs],dtype=np.int32)
+		fsps=[r[1] for r in recs]
+		cmts=[r[2] if len(r)>2 else None for r in recs]
+
+		return (nums,fsps,cmts)
+
+	def read_images(self,indices=None,header_only=False):
+		"""Reads the images referenced by a list of records (default all). Records are grouped by the file they
+reference, so each image file is opened once and read in order. Returns a list of images in the order of indices."""
+		if indices==None : nums,fsps,cmts=self.read_range()
+		else : nums,fsps,cmts=self.read_many(indices)
+
+		byfile={}
+		for i,fsp in enumerate(fsps): byfile.setdefault(fsp,[]).append(i)
+
+		ret=[None]*len(fsps)
+		for fsp,idx in byfile.items():
+			idx.sort(key=lambda i:nums[i])
+			imgs=EMData.read_images(fsp,[int(nums[i]) for i in idx],header_only)
+			for i,im in zip(idx,imgs):
+				if cmts[i]!=None and len(cmts[i])>0 : im["lst_comment"]=cmts[i]
+				ret[i]=im
+
+		return ret
+
 	def read_image(self,n):
 		"""This reads the image referenced by the nth record in the #LSX file. The same task can be accomplished with EMData.read_image,
 but this method prevents multiple open/close operations on the #LSX file."""
@@ -2002,6 +2167,39 @@ but this method prevents multiple open/close operations on the #LSX file."""
 
 	def __len__(self): return self.n
 
+	def recpos(self,n):
+		"""Returns the file offset of the nth record (n==len(self) is the end of the last record)"""
+		if self.offsets!=None : return self.offsets[n]
+		return self.seekbase+self.linelen*n
+
+	def index(self):
+		"""Used in place of normalize() for read-only files. The file is memory mapped and the number of records is
+computed from the file size, checking only that the first and last records have the correct length. If they don't,
+the file can't be rewritten, so the record offsets are found by scanning the lines once instead."""
+		import mmap
+
+		size=os.fstat(self.ptr.fileno()).st_size
+		self.n=(size-self.seekbase)/self.linelen
+		if (size-self.seekbase)%self.linelen!=0 : bad=True
+		elif self.n==0 : bad=False
+		else:
+			self.ptr.seek(self.seekbase)
+			bad=len(self.ptr.readline())!=self.linelen
+			self.ptr.seek(self.seekbase+self.linelen*(self.n-1))
+			bad=bad or len(self.ptr.readline())!=self.linelen
+
+		self.mm=mmap.mmap(self.ptr.fileno(),0,access=mmap.ACCESS_READ)
+		if not bad : return
+
+		# same record boundaries as normalize(), which stops at the first blank line
+		self.offsets=[self.seekbase]
+		self.mm.seek(self.seekbase)
+		while 1:
+			ln=self.mm.readline()
+			if len(ln.strip())==0 : break
+			self.offsets.append(self.mm.tell())
+		self.n=len(self.offsets)-1
+
 	def normalize(self):
 		"""This will read the entire file and insure that the line-length parameter is valid. If it is not,
 it will rewrite the file with a valid line-length. """
@@ -45,11 +45,13 @@ import shutil
 import subprocess
 import thread,threading
 import getpass
+import hashlib
 import select
+import Queue
 
 from EMAN2 import test_image,EMData,abs_path,local_datetime,EMUtil,Util,get_platform
 from EMAN2db import e2filemodtime
-from EMAN2jsondb import JSTask,JSTaskQueue,js_open_dict
+from EMAN2jsondb import JSTask,JSTaskQueue,js_open_dict,file_content_id
 from e2classaverage import ClassAvTask
 from e2classifytree import TreeClassifyTask
 from e2refine_split import ClassSplitTask
@@ -60,7 +62,10 @@ from e2project3d import EMProject3DTaskDC
 
 from e2spt_classaverage import Align3DTask
 from e2spt_preproc import Preproc3DTask
-from e2spt_hac import Align3DTaskAVSA
+from e2spt_hac import Align3DTaskAVSA,Align3DTaskAVSABatch
+from e2spt_align import SptAlignTask
+from e2proc2d import Proc2dTask
+from e2make3dpar import Make3dParTask
 from e2spt_simulation import SubtomoSimTask
 
 from e2tomopreproc import TomoPreproc2DTask
@@ -104,7 +109,7 @@ class EMTaskCustomer:
 	def __init__(self,target):
 		"""Specify the type and target host of the parallelism server to use.
 	dc[:hostname[:port]] - default hostname localhost, default port 9990
-	thread:nthreads[:scratch_dir]
+	thread:nthreads[:scratch_dir[:spawn]] - spawn uses one process per task rather than persistent workers
 	mpi:ncpu[:scratch_dir_on_nodes]
 	"""
 		target=target.lower()
@@ -122,7 +127,10 @@ class EMTaskCustomer:
 			self.maxthreads=int(target.split(":")[1])
 			try: self.scratchdir=target.split(":")[2]
 			except: self.scratchdir="/tmp"
-			self.handler=EMLocalTaskHandler(self.maxthreads,self.scratchdir)
+			if len(self.scratchdir)==0 : self.scratchdir="/tmp"
+			try: spawn=target.split(":")[3]=="spawn"
+			except: spawn=False
+			self.handler=EMLocalTaskHandler(self.maxthreads,self.scratchdir,spawn)
 		elif self.servtype=="mpi":
 			self.maxthreads=int(target.split(":")[1])
 			try: self.scratchdir=target.split(":")[2]
@@ -399,11 +407,10 @@ class EMTestTask(JSTask):
 		# data should contain one element "input"
 		data=self.data["input"]
 		cname=data[1]
-		cache=db_open_dict(cname)
 
 		ret=[]
 		for i in image_range(*data[2:]):		# this allows us to iterate over the specified image numbers
-			ret.append(cache[i]*-1)
+			ret.append(EMData(cname,i)*-1)
 
 		return ret
 
@@ -483,10 +490,15 @@ accessible to the server."""
 # Here we define the classes for local threaded parallelism
 class EMLocalTaskHandler():
 	"""Local threaded Taskserver. This runs as a thread in the 'Customer' and executes tasks. Not a
-	subclass of EMTaskHandler for efficient local processing and to avoid data name translation."""
+	subclass of EMTaskHandler for efficient local processing and to avoid data name translation.
+
+	By default, nthreads long-lived worker processes ('e2parallel.py localworker') are started, each of which
+	imports EMAN2 once, then receives pickled tasks over a local socket and returns results as soon as they
+	are complete. If spawn is set, the older behavior of running a new 'e2parallel.py localclient' process
+	for each task, passing tasks and results through files in scratchdir, is used instead."""
 	lock=threading.Lock()
 	allrunning = {}	# Static dict of running local tasks. Used for killing thses task upon parent kill
-	def __init__(self,nthreads=2,scratchdir="/tmp"):
+	def __init__(self,nthreads=2,scratchdir="/tmp",spawn=False):
 		self.maxthreads=nthreads
 		self.running=[]			# running subprocesses
 		self.completed=set()	# completed subprocesses
@@ -494,23 +506,63 @@ class EMLocalTaskHandler():
 		self.maxid=0
 		self.nextid=0
 		self.doexit=0
+		self.spawn=spawn
 
+		if spawn :
+			os.makedirs(self.scratchdir)
+			self.thr=threading.Thread(target=self.run)
+			self.thr.start()
+			return
 
-		os.makedirs(self.scratchdir)
-		self.thr=threading.Thread(target=self.run)
-		self.thr.start()
+		self.tasks={}			# pickled tasks keyed by task id, removed when results are retrieved
+		self.results={}			# results of completed tasks keyed by task id
+		self.started=set()		# tasks which have been sent to a worker
+		self.pending=Queue.Queue(0)	# ids of tasks waiting for a worker
+
+		# workers connect back to us on a local socket. We use a socket rather than the workers' stdin/stdout so
+		# anything the tasks print still goes to the console
+		self.listensock=socket.socket()
+		self.listensock.bind(("127.0.0.1",0))
+		self.listensock.listen(nthreads)
+		self.listensock.settimeout(600)		# workers which haven't connected within 10 minutes have failed
+		port=self.listensock.getsockname()[1]
+
+		self.workers=[]
+		for i in xrange(nthreads):
+			if get_platform() == 'Windows':
+				proc=subprocess.Popen(["python", "%s\\bin\\e2parallel.py"%os.getenv('EMAN2DIR'),"localworker","--port=%d"%port])
+			else:
+				proc=subprocess.Popen(["e2parallel.py","localworker","--port=%d"%port],close_fds=True)
+			self.workers.append(proc)
+			EMLocalTaskHandler.allrunning[("worker",id(self),i)]=proc
+
+		self.thrs=[threading.Thread(target=self.runworker) for i in xrange(nthreads)]
+		for t in self.thrs: t.start()
 
 	def stop(self):
 		"""Called externally (by the Customer) to nicely shut down the task handler"""
 		self.doexit=1
-		self.thr.join()
-		shutil.rmtree(self.scratchdir,True)
+		if self.spawn :
+			self.thr.join()
+			shutil.rmtree(self.scratchdir,True)
+			return
+
+		for t in self.thrs: self.pending.put(None)		# each worker thread exits when it gets a None
+		for t in self.thrs: t.join()
+		self.listensock.close()
+		for i,proc in enumerate(self.workers):
+			proc.wait()
+			try: del EMLocalTaskHandler.allrunning[("worker",id(self),i)]
+			except: pass
 
 	def add_task(self,task):
 		EMLocalTaskHandler.lock.acquire()
 		if not isinstance(task,JSTask) : raise Exception,"Non-task object passed to EMLocalTaskHandler for execution"
-		dump(task,file("%s/%07d"%(self.scratchdir,self.maxid),"wb"),-1)
 		ret=self.maxid
+		if self.spawn : dump(task,file("%s/%07d"%(self.scratchdir,self.maxid),"wb"),-1)
+		else :
+			self.tasks[ret]=dumps(task,-1)
+			self.pending.put(ret)
 		self.maxid+=1
 		EMLocalTaskHandler.lock.release()
 		return ret
@@ -520,8 +572,9 @@ class EMLocalTaskHandler():
 		handled, so results are always -1, 0 or 100 """
 		ret=[]
 		for i in id_list:
-			if i>=self.nextid : ret.append(-1)
-			elif i in self.completed : ret.append(100)
+			if i in self.completed : ret.append(100)
+			elif self.spawn and i>=self.nextid : ret.append(-1)
+			elif not self.spawn and i not in self.started : ret.append(-1)
 			else: ret.append(0)
 		return ret
 
@@ -530,6 +583,14 @@ class EMLocalTaskHandler():
 #		print "Retrieve ",taskid
 		if taskid not in self.completed : raise Exception,"Task %d not complete !!!"%taskid
 
+		if not self.spawn :
+			EMLocalTaskHandler.lock.acquire()
+			task=loads(self.tasks.pop(taskid))
+			results=self.results.pop(taskid)
+			self.completed.remove(taskid)
+			EMLocalTaskHandler.lock.release()
+			return (task,results)
+
 		task=load(file("%s/%07d"%(self.scratchdir,taskid),"rb"))
 		results=load(file("%s/%07d.out"%(self.scratchdir,taskid),"rb"))
 
@@ -539,6 +600,55 @@ class EMLocalTaskHandler():
 
 		return (task,results)
 
+	def runworker(self):
+		"""One of these threads runs for each worker process. It hands tasks to the worker one at a time, and
+		marks each task complete as soon as its results come back"""
+
+		try: sock,addr=self.listensock.accept()
+		except:
+			print "Error: local worker process failed to start"
+			thread.interrupt_main()
+			sys.stderr.flush()
+			sys.stdout.flush()
+			os._exit(1)
+		sockf=sock.makefile()
+
+		while 1:
+			tid=self.pending.get()
+			if tid==None :
+				sendstr(sockf,None)		# tells the worker to exit
+				sockf.flush()
+				break
+
+			EMLocalTaskHandler.lock.acquire()
+			self.started.add(tid)
+			tsk=self.tasks[tid]
+			EMLocalTaskHandler.lock.release()
+
+			try:
+				sendstr(sockf,tsk)
+				sockf.flush()
+				status,results=recvobj(sockf)
+			except:
+				status,results="error","lost connection to worker process"
+
+			# This means that the task failed to execute properly
+			if status!="ok" :
+				print "Error running task : ",tid
+				print results
+				thread.interrupt_main()
+				sys.stderr.flush()
+				sys.stdout.flush()
+				os._exit(1)
+
+			EMLocalTaskHandler.lock.acquire()
+			self.results[tid]=results
+			self.completed.add(tid)
+			EMLocalTaskHandler.lock.release()
+
+		sockf.close()
+		sock.close()
+
 	def run(self):
 
 		while(1):
@@ -583,6 +693,30 @@ class EMLocalTaskHandler():
 				self.nextid+=1
 				EMLocalTaskHandler.lock.release()
 
+def runlocalworker(port):
+	"""This is the main loop of an 'e2parallel.py localworker' process. It connects to the EMLocalTaskHandler
+	listening on port, then executes tasks as they are received until it is told to exit."""
+
+	sock=socket.socket()
+	sock.connect(("127.0.0.1",port))
+	sockf=sock.makefile()
+
+	while 1:
+		tsk=recvstr(sockf)
+		if tsk==None : break
+
+		try:
+			task=loads(tsk)
+			ret=("ok",task.execute(lambda x:True))
+		except:
+			ret=("error",traceback.format_exc())
+
+		sendobj(sockf,ret)
+		sockf.flush()
+
+	sockf.close()
+	sock.close()
+
 
 #######################
 #  Here we define the classes for MPI parallelism
@@ -865,14 +999,13 @@ class EMMpiClient():
 
 		if self.cachedir==None : return path	# caching disabled, return original filename
 
-		# We strip out any punctuation, particularly '/', and take the last 40 characters, which hopefully gives us something unique
-		return "%s/%s.hdf"%(self.cachedir,path.translate(None,"#/\\:.!@$%^&*()-_=+")[-40:])
+		return "%s/%s"%(self.cachedir,self.pathtocachename(path))
 
 	def pathtocachename(self,path):
-		"""This will convert a remote filename to a local (unique) cache-file name"""
+		"""This will convert a remote filename to a local (unique) cache-file name, based on the file contents, so
+		it changes if the file does, and is the same in any job"""
 
-		# We strip out any punctuation, particularly '/', and take the last 40 characters, which hopefully gives us something unique
-		return str(path.translate(None,"#/\\:.!@$%^&*()-_=+")[-40:]+".hdf")
+		return "%d_%d.hdf"%file_content_id(path)
 
 def filesenum(lst):
 	"""This is a generator that takes a list of (name,#), (name,(#,#,#)), or (name,min,max) specifiers
@@ -1755,6 +1888,121 @@ def DCclient_alarm2(signum=None,stack=None):
 	raise Exception,"timeout"
 
 
+class EMNodeCache:
+	"""A cache of image data on the local disk of a compute node, shared by all of the clients on the node and persistent
+	across jobs. Entries are HDF files named by the content-derived data id (see EMAN2jsondb.file_content_id) and, for
+	partial entries, a hash of the image range, so the same particles are only transferred once per node, no matter which
+	job or refinement iteration asks for them. Images keep their original numbers within an entry. Entries are written to a
+	temporary file, then renamed, so they are immutable once visible. When the cache grows beyond its size limit, the least
+	recently used entries are removed. The location and size (in GB) come from $EMAN2CACHEDIR and $EMAN2CACHESIZE"""
+
+	def __init__(self,path=None,maxsize=None):
+		if path==None : path=os.getenv("EMAN2CACHEDIR")
+		if path==None :
+			try: user=getpass.getuser()
+			except: user="anyone"
+			path="/tmp/eman2cache-%s"%user
+		if maxsize==None : maxsize=float(os.getenv("EMAN2CACHESIZE",20.0))
+
+		self.path=path
+		self.maxsize=int(maxsize*1.0e9)
+		self.keep=600			# entries used within this many seconds are never evicted, they may be in use by a running task
+		try: os.makedirs(path)
+		except: pass
+
+	def name(self,did,rng=None):
+		"""Returns the filename for the entry containing the whole file did, or only the images in rng"""
+		if rng==None : return "%s/%d_%d.hdf"%(self.path,did[0],did[1])
+		return "%s/%d_%d_%s.hdf"%(self.path,did[0],did[1],hashlib.md5(repr(tuple(rng))).hexdigest()[:12])
+
+	def find(self,did,rng=None):
+		"""Returns the filename of an existing entry containing the requested images (all images if rng is None),
+		or None if they aren't cached"""
+		names=[self.name(did)]
+		if rng!=None : names.append(self.name(did,rng))
+
+		for n in names:
+			if os.path.isfile(n) :
+				try: os.utime(n,None)		# mark as recently used
+				except: pass
+				return n
+
+		return None
+
+	def tmpname(self,did):
+		"""Returns a unique temporary filename to write a new entry for did into"""
+		return "%s/tmp_%s_%d_%d_%d.hdf"%(self.path,socket.gethostname(),os.getpid(),did[1],random.randint(0,999999))
+
+	def commit(self,tmp,name):
+		"""Makes a completed temporary entry visible under name, then enforces the size limit"""
+		try: os.rename(tmp,name)
+		except:
+			traceback.print_exc()
+			print "Error: could not store cache entry ",name
+			try: os.unlink(tmp)
+			except: pass
+			return None
+
+		self.enforce()
+		return name
+
+	def enforce(self):
+		"""Removes least recently used entries until the cache is below its size limit. Temporary files left by
+		dead clients are removed after a day."""
+		now=time.time()
+		ents=[]
+		tot=0
+		for f in os.listdir(self.path):
+			fsp="%s/%s"%(self.path,f)
+			try: st=os.stat(fsp)
+			except: continue
+			if f[:4]=="tmp_" :
+				if now-st.st_mtime>86400 :
+					try: os.unlink(fsp)
+					except: pass
+				continue
+			ents.append((st.st_mtime,st.st_size,fsp))
+			tot+=st.st_size
+
+		ents.sort()
+		for t,sz,fsp in ents:
+			if tot<=self.maxsize or now-t<self.keep : break
+			try: os.unlink(fsp)
+			except: continue
+			tot-=sz
+
+class EMCacheWriter:
+	"""Collects a stream of (time,rand,img#,image) tuples, as sent by the server while precaching, into complete entries
+	in an EMNodeCache. Each data id is committed when the stream moves on to the next one, or on close()."""
+
+	def __init__(self,cache,verbose=0):
+		self.cache=cache
+		self.verbose=verbose
+		self.did=None
+		self.tmp=None
+
+	def start(self,did):
+		"""Begins a new entry if did differs from the current one"""
+		if did==self.did : return
+		self.close()
+		if self.verbose : print "Receiving cache data ",did
+		self.did=did
+		self.tmp=self.cache.tmpname(did)
+
+	def write(self,img):
+		self.start((img[0],img[1]))
+		img[3].write_image(self.tmp,img[2])
+
+	def close(self,complete=True):
+		"""Commits the current entry, or discards it if complete is False"""
+		if self.did==None : return
+		if complete and os.path.isfile(self.tmp) : self.cache.commit(self.tmp,self.cache.name(self.did))
+		else :
+			try: os.unlink(self.tmp)
+			except: pass
+		self.did=None
+		self.tmp=None
+
 class EMDCTaskClient(EMTaskClient):
 	"""Distributed Computing Task Client. This client will connect to an EMDCTaskServer, request jobs to run
  and run them ..."""
@@ -1765,6 +2013,7 @@ class EMDCTaskClient(EMTaskClient):
 		self.verbose=verbose
 		self.lastupdate=0
 		self.task=None
+		self.cache=EMNodeCache()
 		if myid!=None : self.myid=myid
 		signal.signal(signal.SIGALRM,DCclient_alarm)	# this is used for network timeouts
 
@@ -1794,7 +2043,7 @@ class EMDCTaskClient(EMTaskClient):
 		Not using it any more with new chain scheme."""
 
 		n=0
-		lname=""
+		writer=EMCacheWriter(self.cache,self.verbose)
 		while 1:
 			if len(cq)==0 : continue
 #			print len(cq), " in cache list"
@@ -1806,17 +2055,12 @@ class EMDCTaskClient(EMTaskClient):
 			# The data item should be a pickled tuple (time,rand,img#,image)
 			try : img=loads(decompress(img))
 			except : continue			# bad pickle :^(
-			try : cname="bdb:cache_%d.%d"%(img[0],img[1])
+			try : writer.write(img)
 			except : continue			# data wasn't what we expected
-
-			if cname!=lname :
-				if self.verbose : print "Receiving cache data ",cname
-				f=db_open_dict(cname)
-				lname=cname
-			f[img[2]]=img[3]
 #			print "> ",img[2],cname
 			n+=1
 
+		writer.close()
 		if self.verbose and n>0: print n," items cached"
 
 	def connectfromlist(self,hostlist):
@@ -1887,9 +2131,9 @@ class EMDCTaskClient(EMTaskClient):
 #		print "chainlist: ",chainlist
 		sockout,sockoutf=self.connectfromlist(chainlist)		# try to establish a connection to one of them
 
+		writer=EMCacheWriter(self.cache,self.verbose)
 		try:
 			ret=None
-			lname=""
 			nrecv=0
 			while 1 :
 				if nrecv==0 : signal.alarm(15)		# if we haven't gotten anything yet, only wait a little while
@@ -1927,16 +2171,10 @@ class EMDCTaskClient(EMTaskClient):
 				except :
 					print "ERROR (%s): Bad data on chain"%socket.gethostname()
 					continue			# bad pickle :^(
-				try : cname="bdb:cache_%d.%d"%(img[0],img[1])
+				try : writer.write(img)
 				except :
 					print "ERROR (%s): Bad data object on chain"%socket.gethostname()
 					continue			# data wasn't what we expected
-
-				if cname!=lname :
-					if self.verbose : print "Receiving cache data ",cname
-					f=db_open_dict(cname)
-					lname=cname
-				f[img[2]]=img[3]
 				nrecv+=1
 
 				if sockout!=None :
@@ -1952,6 +2190,7 @@ class EMDCTaskClient(EMTaskClient):
 			traceback.print_exc()		# we shouldn't really get an exception here
 			print "**** Exception in outer chain loop"
 
+		writer.close(ret=="DONE")		# a file interrupted part way through is discarded
 		if self.verbose :
 			print nrecv," total items cached"
 
@@ -1976,11 +2215,7 @@ class EMDCTaskClient(EMTaskClient):
 #		if self.verbose: print "Caching starting ",clist
 		needed=[]
 		for i in clist[1] :			# loop over list of files to cache
-			cname="bdb:cache_%d.%d"%(i[0],i[1])
-			cache=db_open_dict(cname)
-			try: z=cache.get_header(0)
-			except: needed.append(i)
-			if z==None : needed.append(i)
+			if self.cache.find(i)==None : needed.append(i)
 
 
 		sendobj(sockf,needed)
@@ -1998,7 +2233,7 @@ class EMDCTaskClient(EMTaskClient):
 #		print "chainlist (%s): %s"%(socket.gethostbyname(socket.gethostname()),chainlist)
 		sockout,sockoutf=self.connectfromlist(chainlist)		# try to establish a connection to one of them
 
-		lname=""
+		writer=EMCacheWriter(self.cache,self.verbose)
 		n=0
 #		t0,t1,t2,t3=0,0,0,0
 		# This loop receives the data from the server, then forwards it to the next host in the chain
@@ -2014,14 +2249,10 @@ class EMDCTaskClient(EMTaskClient):
 			sockf.write("ACK ")
 			sockf.flush()
 
-			try : cname="bdb:cache_%d.%d"%(img[0],img[1])
+			try : writer.start((img[0],img[1]))
 			except :
 				print "Invalid cache data '",img,"'"
 				break
-			if cname!=lname :
-				if self.verbose : print "Receiving cache data ",cname
-				f=db_open_dict(cname)
-				lname=cname
 
 			# Send the image down the chain
 			if sockout!=None :
@@ -2034,10 +2265,12 @@ class EMDCTaskClient(EMTaskClient):
 					print "Chain broken ! (%s)"%socket.gethostname()
 					sockout=None
 
-			f[img[2]]=img[3]		# Save the image in the local cache
+			writer.write(img)		# Save the image in the local cache
 
 			n+=1
 
+		writer.close(xmit=="DONE")
+
 		# Tell the chain we're done
 		if sockout!=None :
 			try:
@@ -2120,20 +2353,18 @@ class EMDCTaskClient(EMTaskClient):
 				if self.verbose>1 : print "Data translate ",k,i
 #				try:
 				if isinstance(i,list) and len(i)>0 and i[0]=="cache" :
-					cname="bdb:cache_%d.%d"%(i[1][0],i[1][1])
-					cache=db_open_dict(cname)
-					if self.verbose>2 : print "Open cache : ",cname
-
-					for j in image_range(*i[2:]):
-#						if not cache.has_key(j):
-						try:
-							z=cache.get_header(j)
-							if z==None : raise Exception
-						except:
-							cache[j]=self.get_data(sockf,i[1],j)
-#							print j,cache[j]
-
-						z=cache[j]		# this is here to raise an exception if something went funny in the data retrieval
+					did=tuple(i[1])
+					cname=self.cache.find(did,i[2:])
+					if self.verbose>2 : print "Open cache : ",did,cname
+
+					if cname==None :
+						tmp=self.cache.tmpname(did)
+						for j in image_range(*i[2:]):
+							img=self.get_data(sockf,i[1],j)
+							if not isinstance(img,EMData) : raise Exception,"Could not retrieve image %d of %s"%(j,str(did))
+							img.write_image(tmp,j)		# images keep their original numbers
+						cname=self.cache.commit(tmp,self.cache.name(did,i[2:]))
+						if cname==None : raise Exception,"Could not cache data for %s"%str(did)
 
 					i[1]=cname
 #				except: pass
@@ -45,6 +45,7 @@ import random
 import threading
 import traceback
 import re
+import hashlib
 
 from libpyEMData2 import EMData
 from libpyUtils2 import EMUtil
@@ -59,18 +60,22 @@ def js_one_key(url,key):
 
 	return JSDict.one_key(url,key)
 
-def js_open_dict(url):
+def js_open_dict(url,journal=False):
 	"""Opens a JSON file as a dict-like database object. The interface is almost identical to the BDB db_* functions.
 If opened. Writes to JDB dictionaries may be somewhat inefficient due to the lack of a good model (as BDB has) for
 multithreaded access. Default behavior is to write the entire dictionary to disk when any element is changed. File
 locking is attempted to avoid conflicts, but may not work in all situations. read-only access is a meaningless concept
 because file pointers are not held open beyond discrete transations. While it is possible to store images in JSON files
-it is not recommended due to inefficiency, and making files which are difficult to read."""
+it is not recommended due to inefficiency, and making files which are difficult to read.
+
+If journal is set, changes are instead appended to a .jrnl file next to the .json file, which is periodically folded
+back into the .json file. This is much faster for large dictionaries which are updated one key at a time. Once a
+journal exists, any process opening the same file will use it automatically."""
 
 	if url[-5:]!=".json" :
 		raise Exception,"JSON databases must have .json extension"
 
-	return JSDict.open_db(url)
+	return JSDict.open_db(url,journal)
 
 def js_close_dict(url):
 	"""This will free some resources associated with the database. Not associated with closing a file pointer at present."""
@@ -92,6 +97,8 @@ def js_remove_dict(url):
 	js_close_dict(url)
 	try : os.unlink(url)
 	except OSError: pass
+	try : os.unlink(url[:-5]+".jrnl")
+	except OSError: pass
 
 	return
 
@@ -245,6 +252,20 @@ except ImportError:
 ###  Task Management classes
 #############
 
+def file_content_id(path):
+	"""Returns a (modtime,int) data id for a file, depending only on the absolute path, inode, modification time
+	(full precision) and size of the file. An unchanged file thus has the same id in any job or task queue, so data cached on compute nodes can be
+	reused, and any change to the file produces a new id."""
+	if path[:4].lower()=="bdb:" :
+		from EMAN2db import db_parse_path
+		p=db_parse_path(path)
+		fsp=p[0]+"/EMAN2DB/"+p[1]+".bdb"
+	else : fsp=path
+
+	st=os.stat(fsp)
+	key="%s %d %r %d"%(os.path.abspath(fsp),st.st_ino,st.st_mtime,st.st_size)
+	return (int(st.st_mtime),int(hashlib.md5(key).hexdigest()[:12],16))
+
 class JSTaskQueue:
 	"""This class is used to manage active and completed tasks through an
 	JSDict object. Tasks are each assigned a number unique in the local file.
@@ -314,18 +335,13 @@ class JSTaskQueue:
 		return ret
 
 	def todid(self,name):
-		"""Returns the did for a path, creating one if not already known"""
-		fmt=e2filemodtime(name)
+		"""Returns the did for a path. The did is derived from the file contents (see file_content_id), so clients can
+		reuse data cached for the same file by earlier jobs"""
+		did=file_content_id(name)
 		try :
-			did=self.nametodid[name]			# get the existing did from the cache (modtime,int)
-			if fmt!=did[0]	:					# if the file has been changed, we need to assign a new did
-				del self.didtoname[did]
-				JSTaskQueue.lock.release()
-				raise Exception
-		except:
-			did=(fmt,random.randint(0,999999))	# since there may be multiple files with the same timestamp, we also use a random int
-			while (self.didtoname.has_key(did)):
-				did=(fmt,random.randint(0,999999))
+			old=self.nametodid[name]			# if the file has been changed, forget the old did
+			if old!=did : del self.didtoname[old]
+		except: pass
 
 		self.nametodid[name]=did
 		self.didtoname[did]=name
@@ -523,6 +539,9 @@ def denl(s):
 	"This will replace \n with nothing in a search match"
 	return s.group(0).replace("\n","")
 
+# A journaled JSDict will not be compacted until its journal is at least this large (in bytes)
+JRNLMINCOMPACT=1<<20
+
 class JSDict:
 	"""This class provides dict-like access to a JSON file on disk. It goes to some lengths to insure thread/process-safety, even if
 performance must be sacrificed. The only case where it may not work is when a remote filesystem which doesn't obey file-locking is used.
@@ -534,8 +553,9 @@ JSDicts are open at one time."""
 	lock=threading.Lock()		# to make this section threadsafe
 
 	@classmethod
-	def open_db(cls,path=None):
-		"""This should be used to create a JSDict instance. It caches already open dictionaries to avoid redundancy and conflicts."""
+	def open_db(cls,path=None,journal=False):
+		"""This should be used to create a JSDict instance. It caches already open dictionaries to avoid redundancy and conflicts.
+If journal is set, the dictionary will be switched to journaled mode if it isn't already."""
 
 		cls.lock.acquire()
 
@@ -552,10 +572,12 @@ JSDicts are open at one time."""
 			raise Exception,"Cannot find path for {}".format(path)
 
 		if cls.opendicts.has_key(normpath) :
+			ret=cls.opendicts[normpath]
 			cls.lock.release()
-			return cls.opendicts[normpath]
+			if journal and not ret.journal : ret.enable_journal()
+			return ret
 
-		try : ret=JSDict(path)
+		try : ret=JSDict(path,journal)
 		except:
 			cls.lock.release()
 			traceback.print_exc()
@@ -603,7 +625,7 @@ JSDicts are open at one time."""
 
 		return ret
 
-	def __init__(self,path=None):
+	def __init__(self,path=None,journal=False):
 		"""This is a dict-like representation of a JSON file on disk. Warning, the entire file contents are parsed and held
 in memory for efficient access. File change monitoring and file locking is used to insure self-consistency across processes.
 Due to JSON module, there may be some data types which aren't permitted as values. While this module may be used like a traditional
@@ -611,7 +633,10 @@ dictionary for the most part, for efficiency, you may consider using the setval(
 synchronization with the disk file.
 
 There is no name/path separation as existed with BDB objects. 'path' is a full path to the .json file. A normalized version
-of the path is stored as self.normpath"""
+of the path is stored as self.normpath
+
+If journal is set (or a journal file already exists for this path), the .json file is treated as a snapshot, and changes are
+appended to self.jrnlpath rather than rewriting the entire file. See sync_journal()."""
 
 		from EMAN2 import e2getcwd
 
@@ -625,8 +650,13 @@ of the path is stored as self.normpath"""
 		self.delkeys=set()				# a set of keys to delete on next update
 		self.lasttime=0					# last time the database was accessed
 
+		self.jrnlpath=self.normpath[:-5]+".jrnl"	# append-only journal of changes since the .json snapshot was written
+		self.jrnltoken=None				# identifies the snapshot our copy of the data is based on
+		self.jrnloffset=0				# how far into the journal we have already replayed
+
 		self.busy=False					# used for some degree of threadsafety to supplement file locking
-		self.sync()
+		if journal : self.enable_journal()
+		else : self.sync()
 		JSDict.opendicts[self.normpath]=self	# add ourselves to the cache
 
 	def __str__(self): return "<JSDict instance: %s>" % self.path
@@ -641,14 +671,63 @@ of the path is stored as self.normpath"""
 		if len(self.changes)>0 or len(self.delkeys): self.sync()
 		self.lasttime=0
 		self.data={}
+		self.jrnltoken=None
+		self.jrnloffset=0
 #		del JSDict.opendicts[self.normpath]
 
+	@property
+	def journal(self):
+		"""True if this dictionary is stored as a snapshot plus an append-only journal"""
+		return os.path.exists(self.jrnlpath)
+
+	def enable_journal(self):
+		"""Switches this dictionary to journaled mode. Once the journal file exists, every process opening this
+		file will use it. The snapshot (.json file) remains a valid (if possibly out of date) JSON file."""
+
+		if not self.journal :
+			try : jfile=file(self.jrnlpath,"a+")
+			except :
+				try: os.makedirs(os.path.dirname(self.jrnlpath))
+				except : pass
+				jfile=file(self.jrnlpath,"a+")
+			file_lock(jfile,readonly=False)
+			jfile.seek(0,2)
+			if jfile.tell()==0 : self.write_journal_header(jfile)
+			file_unlock(jfile)
+			jfile=None
+
+		self.sync()
+
+	def write_journal_header(self,jfile):
+		"""Starts a new (empty) journal. The token in the header is what readers use to detect that the journal
+		has been folded back into the snapshot, and that they need to reread the snapshot."""
+
+		jfile.seek(0)
+		jfile.truncate(0)
+		jfile.write("EMAN2JRNL {}_{}\n".format(time.time(),random.randint(0,999999)))
+		jfile.flush()
+
+	def compact(self):
+		"""Folds the journal back into the .json snapshot. This happens automatically as the journal grows, but
+		may be called explicitly when a program is finished writing, so the .json file is complete."""
+
+		if not self.journal : return
+		while self.busy: time.sleep(.1)
+		self.busy=True
+		try: self.sync_journal(True)
+		finally: self.busy=False
+
 	def sync(self):
 		"""This is where all of the JSON file access occurs. This one routine handles both reading and writing, with file locking"""
 
 		while self.busy: time.sleep(.1)		# this is for some degree of threadsafety beyond file locking
 		self.busy=True
 
+		if self.journal :
+			try: self.sync_journal()
+			finally: self.busy=False
+			return
+
 		# We check for the _tmp file first
 		try:
 			mt2=os.stat(self.normpath[:-5]+"_tmp.json").st_mtime
@@ -734,6 +813,107 @@ of the path is stored as self.normpath"""
 		self.lasttime=os.stat(self.normpath).st_mtime	# make sure we include our recent change, if made
 		self.busy=False
 
+	def sync_journal(self,compact=False):
+		"""Journaled equivalent of sync(). The .json file is a snapshot, and each change since the snapshot was written is
+appended to the journal as a single line, [key,value] for assignment or [key] for deletion. Readers replay only the part
+of the journal they haven't seen yet. When the journal becomes larger than the snapshot (or JRNLMINCOMPACT), it is folded
+back into the snapshot and restarted with a new header token, which tells other readers to reread the snapshot. Callers
+must hold self.busy."""
+
+		dirty=len(self.changes)>0 or len(self.delkeys)>0
+
+		try: jfile=file(self.jrnlpath,"r+" if dirty or compact else "r")
+		except: raise Exception,"Error: Unable to open {} for {}".format(self.jrnlpath,"writing" if dirty or compact else "reading")
+		file_lock(jfile,readonly=not (dirty or compact))
+
+		try:
+			### If the journal has been restarted since we last looked, we need to reread the snapshot
+			header=jfile.readline()
+			if header[-1:]!="\n" :
+				# a journal without a complete header is only possible if another process is just creating it
+				if dirty or compact : self.write_journal_header(jfile)
+				jfile.seek(0)
+				header=jfile.readline()
+			if header!=self.jrnltoken :
+				self.read_snapshot()
+				self.jrnltoken=header
+				self.jrnloffset=len(header)
+
+			### replay any records appended since our last access
+			jfile.seek(self.jrnloffset)
+			for l in jfile:
+				if l[-1:]!="\n" : break		# incomplete record from an interrupted write
+				rec=json.loads(l,object_hook=json_to_obj)
+				if len(rec)==2 : self.data[rec[0]]=rec[1]
+				else:
+					try: del self.data[rec[0]]
+					except: pass
+				self.jrnloffset+=len(l)
+
+			### append our own changes
+			if dirty :
+				jss=[]
+				for k in self.delkeys:
+					try: del self.data[k]
+					except: pass
+					jss.append(json.dumps([k],encoding="ascii"))
+				self.delkeys=set()
+				for k,v in self.changes.items():
+					self.data[k]=v
+					jss.append(json.dumps([k,v],default=obj_to_json,encoding="ascii"))
+				self.changes={}
+				jss="\n".join(jss)+"\n"
+
+				jfile.truncate(self.jrnloffset)		# drops any partial record left by an interrupted write
+				jfile.seek(self.jrnloffset)
+				jfile.write(jss)
+				jfile.flush()
+				self.jrnloffset+=len(jss)
+
+			### fold the journal back into the snapshot
+			if compact or (dirty and self.jrnloffset>max(JRNLMINCOMPACT,self.filesize)) :
+				jss=json.dumps(self.data,indent=0,sort_keys=True,default=obj_to_json,encoding="ascii")
+				jss=re.sub(listrex,denl,jss)
+				tmpfile=file(self.normpath[:-5]+"_tmp.json","w")
+				tmpfile.write(jss)
+				tmpfile.close()
+				os.rename(self.normpath[:-5]+"_tmp.json",self.normpath)		# atomic, so readers see either the old or new snapshot
+				self.filesize=len(jss)
+
+				self.write_journal_header(jfile)
+				jfile.seek(0)
+				self.jrnltoken=jfile.readline()
+				self.jrnloffset=len(self.jrnltoken)
+		finally:
+			file_unlock(jfile)
+			jfile=None
+
+		self.lasttime=time.time()
+
+	def read_snapshot(self):
+		"""Reads the .json snapshot underlying a journaled dictionary, creating an empty one if necessary"""
+
+		try: jfile=file(self.normpath,"r")
+		except:
+			jfile=file(self.normpath,"w")
+			json.dump({},jfile)
+			jfile=None
+			self.data={}
+			self.filesize=2
+			return
+
+		try:
+			self.data=json.load(jfile,object_hook=json_to_obj)
+		except:
+			jfile.seek(0)
+			if len(jfile.read().strip())==0 : self.data={}
+			else :
+				print "Error in file: ",self.path
+				traceback.print_exc()
+				raise Exception,"Error reading JSON file : {}".format(self.path)
+		self.filesize=jfile.tell()
+		jfile=None
+
 	def __len__(self):
 		"""Ignores any pending updates for speed"""
 		return len(self.data)
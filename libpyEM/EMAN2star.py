@@ -34,6 +34,7 @@ import os
 import os.path
 import re
 import traceback
+import numpy as np
 
 #from libpyEMData2 import EMData
 #from libpyUtils2 import EMUtil
@@ -57,9 +58,13 @@ import traceback
 #
 # keys have the leading "_" stripped off
 #
-# loop values are represented as a python list. keys from the same loop should have an identical number
-# of elements. loops are identified internally as a list of lists (self.loop) independent of the
+# loop values are represented one column at a time. Columns where every value is an int or a float become
+# numpy arrays, other columns are python lists of strings. keys from the same loop should have an identical number
+# of elements. loops are identified internally as a list of lists (self.loops) independent of the
 # actual data storage.
+#
+# A file may contain several data_ blocks. The StarFile object itself holds the contents of one block (the first, 
+# unless specified), and every block (including that one) is available by name in self.blocks.
 ######
 
 def goodval(vals): 
@@ -70,118 +75,246 @@ def goodval(vals):
 		except: pass
 	return val
 
-class StarFile(dict):
-	
-	def __init__(self,filename):
+def goodcol(vals):
+	"""Converts a list of value strings from one loop column into an int array, a float array or a list of strings"""
+	if len(vals)==0 : return []
+	arr=np.array(vals)
+	try: return arr.astype(np.int64)
+	except ValueError: pass
+	try: return arr.astype(np.float64)
+	except ValueError: pass
+	return list(vals)
+
+def starstr(val):
+	"""Formats a single value for writing to a STAR file, quoting it if necessary"""
+	if isinstance(val,float) : return repr(val)		# shortest string which reads back as the same float
+	val=str(val)
+	if len(val)==0 : return '""'
+	if "\n" in val : return "\n;{}\n;".format(val)
+	if val[0] in ("_","#","'",'"',"$") or len(val.split())>1 or val.lower()[:5] in ("data_","loop_","save_") :
+		if '"' not in val : return '"{}"'.format(val)
+		return "'{}'".format(val)
+	return val
+
+class StarBlock(dict):
+	"""The contents of a single data_ block. Single values and loop columns are stored as dictionary items.
+	self.loops is a list of loops, each of which is a list of the keys belonging to that loop"""
+
+	def __init__(self,dataname=""):
 		dict.__init__(self)
-		self.filename=filename
+		self.dataname=dataname
 		self.loops=[]
+
+	def writeblock(self,out):
+		"""Writes this block to an open file object"""
+
+		out.write("\ndata_{}\n".format(self.dataname))
+
+		inloop=set()
+		for loop in self.loops : inloop.update(loop)
+
+		for k in sorted(self.keys()):
+			if k in inloop : continue
+			out.write("_{}\t{}\n".format(k,starstr(self[k])))
+
+		for loop in self.loops:
+			loop=[k for k in loop if k in self]
+			if len(loop)==0 : continue
+
+			out.write("\nloop_\n")
+			for i,k in enumerate(loop): out.write("_{} #{}\n".format(k,i+1))
+
+			cols=[]
+			for k in loop:
+				col=self[k]
+				if isinstance(col,np.ndarray) and col.dtype.kind=="f" : cols.append([repr(v) for v in col.tolist()])
+				elif isinstance(col,np.ndarray) and col.dtype.kind in "iu" : cols.append([str(v) for v in col.tolist()])
+				else : cols.append([starstr(v) for v in col])
+
+			# write the rows in chunks to limit memory use with very large loops
+			nrows=min([len(c) for c in cols])
+			for i in xrange(0,nrows,100000):
+				out.write("\n".join(["\t".join(row) for row in zip(*[c[i:i+100000] for c in cols])]))
+				out.write("\n")
+
+		out.write("\n")
+
+class StarFile(StarBlock):
+	
+	def __init__(self,filename,block=None,columns=None):
+		"""Opens a STAR file. The StarFile acts as a dictionary containing the named data block (default the first one
+		in the file). If columns is specified, only the listed loop keys (without leading _) are parsed and stored,
+		which can save a great deal of time and memory with large files."""
+		StarBlock.__init__(self)
+		self.filename=filename
+		self.block=block
+		self.columns=columns
+		self.blocks={}
+		self.blockorder=[]
 		
 		if os.path.isfile(filename) :
 			self.readfile()
-	def _nextline(self):
-		"""Used internally when parsing a star file to emulate readline"""
-		self.lineptr+=1
-		return self.lines[self.lineptr-1]
-	
+
+	def _lines(self,fin):
+		"""Used internally when parsing a star file. Yields lines from the file, skipping blank lines and comments"""
+		for line in fin:
+			if len(line.strip())==0 or line[0]=="#" : continue
+			yield line
+
 	def readfile(self):
-		"""This parses the STAR file, replacing any previous contents in the dictionary"""
+		"""This parses the STAR file, replacing any previous contents in the dictionary. The file is read one line at a time, 
+		and loop columns are converted to their final type one column at a time."""
 		
 		self.loops=[]
 		self.clear()
+		self.blocks={}
+		self.blockorder=[]
 		
 		matcher=re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
+		if self.columns!=None : wanted=set(self.columns)
 		
-		# read the entire file into a buffer, this dramatically simplifies the logic, even if it eats a chunk of RAM
-		self.lines=[i for i in file(self.filename,"r") if len(i.strip())!=0 and i[0]!="#"]
-		self.lineptr=0
+		fin=file(self.filename,"r")
+		lines=self._lines(fin)
+		cur=None
+		pushback=None
 		
 		while 1:
-			try: line=self._nextline().strip()
-			except: break
+			if pushback!=None : 
+				line=pushback
+				pushback=None
+			else:
+				try: line=lines.next()
+				except StopIteration: break
+			line=line.strip()
 		
 			if line[0]=="_" :				# A single key/value pair
+				if cur==None : cur=self._newblock("")
 				spl=line.split(None,1)		# split on whitespace
 				key=spl[0][1:]
 				
 				if len(spl)==2:				# value on the same line
-					if spl[1][0] in ("'",'"') : self[key]=spl[1:-1]		# we assume the last non-whitespace character is the ending delimeter
+					if spl[1][0] in ("'",'"') : cur[key]=spl[1].strip()[1:-1]		# we assume the last non-whitespace character is the ending delimeter
 					else:
 						try: val=int(spl[1])
 						except: 
 							try: val=float(spl[1])
 							except: val=spl[1]			# if not an int or a float, must be a simple value string
 					
-						self[key]=val
+						cur[key]=val
 				else:						# value starts on next line
-					line2=self._nextline()
+					try: line2=lines.next()
+					except StopIteration: raise Exception,"StarFile: Key-value pair error. Matching value for %s not found."%key
 					if line2[0] in ("'",'"') :
-						self[key]=line2.strip()[1:-1]
+						cur[key]=line2.strip()[1:-1]
 					elif line2[0]==";" :
 						val=[line2[1:]]
 						while 1:
-							try: line2=self._nextline()
+							try: line2=lines.next()
 							except: raise Exception,"StarFile: Error found parsing multi-line string value for %s"%key
 							if line2[0]==';' : break
 							val.append(line2)
 						val[-1]=val[-1].rstrip()		# remove trailing whitespace on the last line
 						val="".join(val)
-						self[key]=val
+						cur[key]=val
 					else: raise Exception,"StarFile: Key-value pair error. Matching value for %s not found."%key
 			elif line[:5].lower()=="data_":
-				if len(self)>0 :
-					print "WARNING: second data_ block encountered in ",self.filename,". Cannot deal with this at present. Second block ignored"
-					return
-				self.dataname=line[5:]
+				cur=self._newblock(line[5:])
 			elif line[:5].lower()=="loop_":
+				if cur==None : cur=self._newblock("")
 				loop=[]
-				self.loops.append(loop)				# add it to the list of loops immediately then update it as we go
+				cur.loops.append(loop)				# add it to the list of loops immediately then update it as we go
 				# First we read the parameter names for the loop
-				while 1:
-					line2=self._nextline().strip()
-					if line2[0]=="_":
-						loop.append(line2.split()[0][1:])
-						self[loop[-1]]=[]			# this will hold the data values when we read them
+				line2=None
+				for line2 in lines:
+					line2=line2.strip()
+					if line2[0]=="_": loop.append(line2.split()[0][1:])
 					else: break
-				self.lineptr-=1
+				else: line2=None
 				
-				# Now we read the actual loop data elements
-				vals=[]
-				while 1:
-					try: line2=self._nextline().strip()
-					except: break
+				# which columns we actually keep
+				if self.columns==None : keep=range(len(loop))
+				else: keep=[i for i,k in enumerate(loop) if k in wanted]
+				nloop=len(loop)
 				
-					if line2[0]=="_" or line2.lower()[:5]=="loop_" : break
+				# Now we read the actual loop data elements. Values are kept as strings until the whole loop is read
+				rows=[]
+				vals=[]
+				while line2!=None:
+					if line2[0]=="_" or line2[:5].lower() in ("loop_","data_") : 
+						pushback=line2
+						break
 					elif line2[0]==";" :
-						val=line2[0][1:]
+						val=[line2[1:]]
 						while 1:
-							line2=self._nextline()
-							if line2[0]==";":
-								break
-							val+=line2
-						vals.append(val)
+							try: line3=lines.next()
+							except StopIteration: raise Exception,"StarFile: Error found parsing multi-line string value in loop"
+							if line3[0]==";": break
+							val.append(line3)
+						vals.append("".join(val).rstrip())
+					elif "'" in line2 or '"' in line2 :
+						vals.extend([max(i).strip("\"'") for i in matcher.findall(line2)])
 					else:
-						vals.extend([goodval(i) for i in matcher.findall(line2)])
-						if len(vals)<len(loop) :			# we may need to read multiple lines to get enough values
-							continue
-						if len(vals)>len(loop) : 
-							print "mismatch"
-							print line2
-							print len(loop),loop
-							print len(vals),vals
-							break
-						for i in range(len(vals)): self[loop[i]].append(vals[i])
+						vals.extend(line2.split())
+						
+					if len(vals)==nloop :
+						if len(keep)==nloop : rows.append(vals)
+						else : rows.append([vals[i] for i in keep])
 						vals=[]
-				self.lineptr-=1
+					elif len(vals)>nloop :
+						print "mismatch"
+						print line2
+						print nloop,loop
+						print len(vals),vals
+						break
+
+					try: line2=lines.next().strip()
+					except StopIteration: line2=None
+				
+				for j,i in enumerate(keep):
+					cur[loop[i]]=goodcol([r[j] for r in rows])
+				if len(keep)<nloop : loop[:]=[loop[i] for i in keep]
+				rows=None
 			else:
 				print "StarFile: Unknown content on line :",line
 				break
 
-				
+		fin.close()
+		
+		# The StarFile itself takes on the contents of the requested block
+		if len(self.blockorder)>0 : 
+			if self.block==None : name=self.blockorder[0]
+			else: name=self.block
+			try: blk=self.blocks[name]
+			except: raise Exception,"StarFile: No data_{} block in {}".format(name,self.filename)
+			self.update(blk)
+			self.dataname=blk.dataname
+			self.loops=blk.loops
+			self.blocks[name]=self
+
+	def _newblock(self,name):
+		"""Used internally to start a new data block when parsing"""
+		if name in self.blocks : print "WARNING: duplicate data_{} block in {}. Only the last will be kept.".format(name,self.filename)
+		else : self.blockorder.append(name)
+		ret=StarBlock(name)
+		self.blocks[name]=ret
+		return ret
+
 	def writefile(self,filename=None):
-		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in"""
+		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in.
+		All data blocks are written, in their original order. A new StarFile contains only its own block, and if no loops have been 
+		defined, any list/array values with the same length are written as a single loop."""
 		
-		print "Sorry, writing not implemented yet"
-					
-			
-			
\ No newline at end of file
+		if filename==None : filename=self.filename
+		
+		if self.dataname not in self.blocks :
+			self.blocks[self.dataname]=self
+			self.blockorder.append(self.dataname)
+
+		if len(self.loops)==0 :
+			lk=[k for k in self.keys() if isinstance(self[k],(list,tuple,np.ndarray))]
+			if len(lk)>0 : self.loops.append(sorted(lk))
+		
+		out=file(filename,"w")
+		out.write("# Written by EMAN2\n")
+		for name in self.blockorder: self.blocks[name].writeblock(out)
+		out.close()
@@ -1365,6 +1365,154 @@ EMFileType.alltocheck = (EMPlotFileType, EMPDBFileType, EMTextFileType)
 
 #---------------------------------------------------------------------------
 
+class EMBrowserCache(object) :
+	"""The metadata cache for the files in one directory, kept in <dir>/.browsercache.json. Records are keyed by file
+	name (plus a suffix for the kind of record) and begin with the time they were made, so they are valid while newer
+	than the file's mtime. The file is read once per directory, and new records are written in batches by flush(),
+	rather than rewriting the whole file for every entry."""
+
+	caches = {}
+	lock = threading.Lock()
+
+	@classmethod
+	def get(cls, root) :
+		"""Returns the (shared) cache for directory root"""
+
+		root = os.path.abspath(root)
+
+		with cls.lock :
+			if not root in cls.caches : cls.caches[root] = cls(root)
+			return cls.caches[root]
+
+	@classmethod
+	def flushAll(cls) :
+		with cls.lock : caches = cls.caches.values()
+
+		for c in caches : c.flush()
+
+	def __init__(self, root) :
+		self.path = os.path.join(root, ".browsercache.json")
+		self.db = None			# JSDict, None if the cache can't be written
+		self.data = None		# in-memory copy of the records
+		self.pending = 0		# number of records not yet written
+		self.lock = threading.Lock()
+
+	def load(self) :
+		if self.data != None : return
+
+		try :
+			self.db = js_open_dict(self.path)
+			self.data = dict(self.db.items())
+		except :
+			self.db = None
+			self.data = {}
+
+	def lookup(self, key) :
+		"""Returns the record for key, or None"""
+
+		with self.lock :
+			self.load()
+			return self.data.get(key, None)
+
+	def store(self, key, rec) :
+		with self.lock :
+			self.load()
+			self.data[key] = rec
+			if self.db == None : return
+			self.db.setval(key, rec, True)
+			self.pending += 1
+
+		if self.pending >= 500 : self.flush()
+
+	def flush(self) :
+		"""Writes any new records to disk"""
+
+		with self.lock :
+			if self.db == None or self.pending == 0 : return
+
+			try : self.db.sync()
+			except : pass
+			self.pending = 0
+
+class EMDetailScanner(object) :
+	"""Fills in the expensive details (fillDetails()) of EMDirEntry objects in a background thread, so the GUI thread never has
+	to open files. Entries are queued with add(), and the most recently added are scanned first. Entries which were updated are
+	collected with takeUpdated(). This has no Qt dependence, so it works without a display."""
+
+	def __init__(self) :
+		self.todo = []				# entries waiting to be scanned, the last is scanned next
+		self.updated = []			# entries filled in since the last takeUpdated()
+		self.lock = threading.Lock()
+		self.wake = threading.Event()
+		self.idle = threading.Event()
+		self.idle.set()
+		self.exit = False
+
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def add(self, entries) :
+		"""Queues a list of EMDirEntry objects for scanning"""
+
+		with self.lock :
+			self.todo.extend(entries)
+			self.idle.clear()
+
+		self.wake.set()
+
+	def clear(self) :
+		"""Drops any entries still waiting to be scanned"""
+
+		with self.lock : self.todo = []
+
+	def takeUpdated(self) :
+		"""Returns the list of entries updated since the last call"""
+
+		with self.lock :
+			ret = self.updated
+			self.updated = []
+
+		return ret
+
+	def wait(self, timeout = None) :
+		"""Blocks until all queued entries have been scanned. Returns False if timeout (seconds) expired first"""
+
+		return self.idle.wait(timeout)
+
+	def stop(self) :
+		self.exit = True
+		self.wake.set()
+
+	def run(self) :
+		while not self.exit :
+			with self.lock :
+				if len(self.todo) > 0 : entry = self.todo.pop()
+				else : entry = None
+
+			if entry == None :
+				EMBrowserCache.flushAll()		# write out new cache records whenever we run out of work
+
+				with self.lock :
+					if len(self.todo) == 0 :
+						self.wake.clear()
+						self.idle.set()
+
+				self.wake.wait(1.0)
+				continue
+
+			try : r = entry.fillDetails()
+			except :
+				traceback.print_exc()
+				r = 0
+
+			if r :
+				with self.lock : self.updated.append(entry)
+
+			if r == 1 : time.sleep(0.01)			# prevents updates from happening too fast and slowing the machine down
+
+#---------------------------------------------------------------------------
+
 class EMDirEntry(object) :
 	"""Represents a directory entry in the filesystem"""
 
@@ -1405,6 +1553,7 @@ class EMDirEntry(object) :
 
 		if not self.isbdb : self.size = stat[6]		# file size (integer, bytes)
 		else : self.size = "-"
+		self.mtime = stat[8]
 		self.date = local_datetime(stat[8])			# modification date (string: yyyy/mm/dd hh:mm:ss)
 
 		# These can be expensive so we only get them on request, or if they are fast
@@ -1625,14 +1774,15 @@ class EMDirEntry(object) :
 
 #		print "X %s\t%s\t%s"%(self.root, self.name, self.path())
 
-		cache = None
+		cache = EMBrowserCache.get(self.root)
 		cachename = self.name+"!main"
 
 		try :
-			cache = js_open_dict(self.root+"/.browsercache.json")
-			self.updtime, self.dim, self.filetype, self.nimg, self.size = cache[cachename]		# try to read the cache for the current file
+			rec = cache.lookup(cachename)		# try to read the cache for the current file
 
-			if self.cache_old(False) == 0 : return 2 		# current cache, no further update necessary
+			if rec != None and rec[0] >= self.mtime :
+				self.updtime, self.dim, self.filetype, self.nimg, self.size = rec
+				return 2 		# current cache, no further update necessary
 		except :
 			pass
 
@@ -1667,7 +1817,7 @@ class EMDirEntry(object) :
 				self.nimg = -1
 				self.dim = "-"
 
-			if cache != None : cache.setval(cachename, (time.time(), self.dim, self.filetype, self.nimg, self.size), True)
+			cache.store(cachename, (time.time(), self.dim, self.filetype, self.nimg, self.size))
 
 			return 1
 
@@ -1728,9 +1878,8 @@ class EMDirEntry(object) :
 				self.dim = "-"
 				self.nimg = "-"
 
-		if cache != None :
-			try : cache.setval(cachename, (time.time(), self.dim, self.filetype, self.nimg, self.size), True)
-			except : pass
+		try : cache.store(cachename, (time.time(), self.dim, self.filetype, self.nimg, self.size))
+		except : pass
 		return 1
 
 #---------------------------------------------------------------------------
@@ -1769,6 +1918,7 @@ class EMFileItemModel(QtCore.QAbstractItemModel) :
 		self.rootpath = startpath							# root path for current browser
 		self.last = (0, 0)
 		self.db = None
+		self.scanner = EMDetailScanner()		# fills in file details in the background
 #		print "Init FileItemModel ", self, self.__dict__
 
 	def canFetchMore(self, idx) :
@@ -1937,6 +2087,32 @@ class EMFileItemModel(QtCore.QAbstractItemModel) :
 		if index.internalPointer().fillDetails() :
 			self.dataChanged.emit(index, self.createIndex(index.row(), 5, index.internalPointer()))
 
+	def scanChildren(self, parent = None) :
+		"""Queues the children of parent (a QModelIndex, or None for the top level) to have their details filled in
+		by the background scanner. Call updateScanned() to display the results."""
+
+		if parent != None and parent.isValid() : entry = parent.internalPointer()
+		else : entry = self.root
+
+		self.scanner.add([entry.child(i) for i in xrange(entry.nChildren()-1, -1, -1)])
+
+	def updateScanned(self) :
+		"""Emits dataChanged for the entries the scanner has filled in since the last call, and returns how many there
+		were. Must be called from the GUI thread, which the browser does from a timer."""
+
+		upd = self.scanner.takeUpdated()
+		if len(upd) == 0 : return 0
+
+		# one event per parent, covering the range of updated rows
+		byparent = {}
+		for entry in upd : byparent.setdefault(id(entry.parent()), []).append((int(entry.index), entry))
+
+		ncol = self.columnCount(None)
+		for rows in byparent.values() :
+			self.dataChanged.emit(self.createIndex(min(rows)[0], 0, min(rows)[1]), self.createIndex(max(rows)[0], ncol-1, max(rows)[1]))
+
+		return len(upd)
+
 #---------------------------------------------------------------------------
 
 class myQItemSelection(QtGui.QItemSelectionModel) :
@@ -3259,15 +3435,10 @@ class EMBrowserWidget(QtGui.QWidget) :
 
 		self.updtimer = QTimer()		# This causes the actual display updates, which can't be done from a python thread
 		QtCore.QObject.connect(self.updtimer, QtCore.SIGNAL('timeout()'), self.updateDetailsDisplay)
-		self.updthreadexit = False		# when set, this triggers the update thread to exit
-		self.updthread = threading.Thread(target = self.updateDetails)	# The actual thread
-		self.updlist = []				# List of QModelIndex items in need of updating
-		self.redrawlist = []			# List of QModelIndex items in need of redisplay
 		self.needresize = 0			# Used to resize column widths occaisonally
 		self.expanded = set()			# We get multiple expand events for each path element, so we need to keep track of which ones we've updated
 
 		self.setPath(startpath)	# start in the local directory
-		self.updthread.start()
 		self.updtimer.start(200)
 
 		self.result = None			# used in modal mode. Holds final selection
@@ -3284,49 +3455,16 @@ class EMBrowserWidget(QtGui.QWidget) :
 
 		QtGui.qApp.setOverrideCursor(Qt.ArrowCursor)
 
-	def updateDetails(self) :
-		"""This is spawned as a thread to gradually fill in file details in the background"""
-
-		while 1 :
-			if self.updthreadexit : break
-
-			if len(self.updlist) == 0 :
-				time.sleep(1.0)				# If there is nothing to update at the moment, we don't need to spin our wheels as much
-			else :
-				de = self.updlist.pop()
-
-# 				print de.internalPointer().truepath()
-
-				r = de.internalPointer().fillDetails()
-				if r == 1 :
-					self.redrawlist.append(de)		# if the update changed anything, we trigger a redisplay of this entry
-					time.sleep(0.01)			# prevents updates from happening too fast and slowing the machine down
-				if r == 2 :						# This means we're reading from a cache, and we should probably update as fast as possible
-					self.redrawlist.append(de)
-# 				print "### ", de.internalPointer().path()
-
 	def updateDetailsDisplay(self) :
-		"""Since we can't do GUI updates from a thread, this is a timer event to update the display after the beckground thread
-		gets the details for each item"""
+		"""Since we can't do GUI updates from a thread, this is a timer event to update the display after the model's
+		background scanner gets the details for each item"""
 
 		if self.needresize > 0 :
 			self.needresize -= 1
 			self.wtree.resizeColumnToContents(3)
 			self.wtree.resizeColumnToContents(4)
 
-		if len(self.redrawlist) == 0 :
-			return
-
-		# we emit a datachanged event
-		rdr = []
-		while len(self.redrawlist) > 0 :
-			i = self.redrawlist.pop()
-			rdr.append((i.row(), i.internalPointer()))		# due to threads, we do it this way to make sure we don't miss any
-
-		# We emit only a single event here for efficiency
-		self.curmodel.dataChanged.emit(self.curmodel.createIndex(min(rdr)[0], 0, min(rdr)[1]), self.curmodel.createIndex(max(rdr)[0], 5, max(rdr)[1]))
-
-		self.needresize = 2
+		if self.curmodel != None and self.curmodel.updateScanned() > 0 : self.needresize = 2
 
 	def editFilter(self, newfilt) :
 		"""Sets a new filter. Requires reloading the current directory."""
@@ -3444,10 +3582,9 @@ class EMBrowserWidget(QtGui.QWidget) :
 
 		if qmi.internalPointer().filetype != "Folder" : return
 
-		# we add the child items to the list needing updates
+		# we queue the child items for background updates
 
-		for i in xrange(self.curmodel.rowCount(qmi)-1, -1, -1) :
-			self.updlist.append(self.curmodel.index(i, 0, qmi))
+		self.curmodel.scanChildren(qmi)
 
 	def buttonMisc(self, num) :
 		"""One of the programmable action buttons was pressed"""
@@ -3591,8 +3728,7 @@ class EMBrowserWidget(QtGui.QWidget) :
 		path = path.replace("\\", "/")
 		if path[:2] == "./" : path = path[2:]
 
-		self.updlist = []
-		self.redrawlist = []
+		if self.curmodel != None : self.curmodel.scanner.stop()
 
 		filt = str(self.wfilter.currentText()).strip()
 
@@ -3665,10 +3801,9 @@ class EMBrowserWidget(QtGui.QWidget) :
 
 		self.expanded = set()
 
-		# we add the child items to the list needing updates
+		# we queue the child items for background updates
 
-		for i in xrange(self.curmodel.rowCount(None)-1, -1, -1) :
-			self.updlist.append(self.curmodel.index(i, 0, None))
+		self.curmodel.scanChildren(None)
 
 		if not silent :
 			try : self.pathstack.remove(self.curpath)
@@ -3690,7 +3825,7 @@ class EMBrowserWidget(QtGui.QWidget) :
 
 	def closeEvent(self, event) :
 		E2saveappwin("e2display", "main", self)
-		self.updthreadexit = True
+		if self.curmodel != None : self.curmodel.scanner.stop()
 
 		for w in self.view2d+self.view2ds+self.view3d+self.viewplot2d+self.viewplot3d+self.viewhist :
 			w.close()
@@ -3718,6 +3853,6 @@ if __name__ == '__main__' :
 
 	window.show()
 	ret = em_app.exec_()
-	try : window.updthreadexit = True
+	try : window.curmodel.scanner.stop()
 	except : pass
 	sys.exit(ret)
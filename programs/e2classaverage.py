@@ -40,6 +40,7 @@ import sys
 import random
 from random import choice
 import traceback
+from collections import OrderedDict
 
 READ_HEADER_ONLY = True
 
@@ -89,6 +90,7 @@ def main():
 	parser.add_argument("--odd", default=False, help="Used by EMAN2 when running eotests. Includes only odd numbered particles in class averages.", action="store_true")
 	parser.add_argument("--even", default=False, help="Used by EMAN2 when running eotests. Includes only even numbered particles in class averages.", action="store_true")
 	parser.add_argument("--parallel", default=None, help="parallelism argument")
+	parser.add_argument("--cachemem", type=float, default=256, help="Total memory in MB used to keep normalized particles between iterations and classes, so they are only read once. With thread or mpi parallelism this is divided among the workers on each node. 0 disables. Default=256")
 	parser.add_argument("--force", "-f",dest="force",default=False, action="store_true",help="Force overwrite the output file if it exists.")
 	parser.add_argument("--saveali",action="store_true",help="Writes aligned particle images to aligned.hdf. Normally resultmx produces more useful informtation. This can be used for debugging.",default=False)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n",type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
@@ -151,6 +153,7 @@ def main():
 		if options.ref: pclist.append(options.ref)
 		if options.usefilt: pclist.append(options.usefilt)
 		etc.precache(pclist)
+		if etc.servtype=="thread" : options.cachemem/=max(etc.cpu_est(),1)		# each local worker keeps its own cache, MPI ranks divide it in ClassAvTask
 
 	# prepare tasks
 	tasks=[]
@@ -165,7 +168,7 @@ def main():
 			if options.even: ptcls=[i for i in ptcls if i%2==0]
 			tasks.append(ClassAvTask(options.input,ptcls,options.usefilt,options.ref,options.iter,options.normproc,options.prefilt,
 			  options.align,options.aligncmp,options.ralign,options.raligncmp,options.averager,options.cmp,options.keep,options.keepsig,
-			  options.automask,options.saveali,options.setsfref,options.verbose,cl,options.center))
+			  options.automask,options.saveali,options.setsfref,options.verbose,cl,options.center,options.cachemem))
 
 	else:
 		ptcls=range(nptcl)
@@ -174,7 +177,7 @@ def main():
 		if options.even: ptcls=[i for i in ptcls if i%2==0]
 		tasks.append(ClassAvTask(options.input,range(nptcl),options.usefilt,options.ref,options.iter,options.normproc,options.prefilt,
 			  options.align,options.aligncmp,options.ralign,options.raligncmp,options.averager,options.cmp,options.keep,options.keepsig,
-			  options.automask,options.saveali,options.setsfref,options.verbose,0,options.center))
+			  options.automask,options.saveali,options.setsfref,options.verbose,0,options.center,options.cachemem))
 
 	# execute task list
 	if options.parallel:				# run in parallel
@@ -307,7 +310,7 @@ class ClassAvTask(JSTask):
 	"""This task will create a single task-average"""
 
 	def __init__(self,imagefile,imagenums,usefilt=None,ref=None,niter=1,normproc=("normalize.edgemean",{}),prefilt=0,align=("rotate_translate_flip",{}),
-		  aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,setsfref=0,verbose=0,n=0,center="xform.center"):
+		  aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,setsfref=0,verbose=0,n=0,center="xform.center",cachemem=256):
 		if usefilt==None : usefilt=imagefile
 		self.center=center
 		data={"images":["cache",imagefile,imagenums],"usefilt":["cache",usefilt,imagenums]}
@@ -316,7 +319,7 @@ class ClassAvTask(JSTask):
 
 		self.options={"niter":niter, "normproc":normproc, "prefilt":prefilt, "align":align, "aligncmp":aligncmp,
 			"ralign":ralign,"raligncmp":raligncmp,"averager":averager,"scmp":scmp,"keep":keep,"keepsig":keepsig,
-			"automask":automask,"saveali":saveali,"setsfref":setsfref,"verbose":verbose,"n":n}
+			"automask":automask,"saveali":saveali,"setsfref":setsfref,"verbose":verbose,"n":n,"cachemem":cachemem}
 
 	def execute(self,callback=None):
 		"""This does the actual class-averaging, and returns the result"""
@@ -327,13 +330,15 @@ class ClassAvTask(JSTask):
 		try: ref=EMData(self.data["ref"][1],self.data["ref"][2])
 		except: ref=None
 
+		cache=particle_cache(options.get("cachemem",256)/local_ranks())
+
 #		print [self.data["images"][1]]+self.data["images"][2]
 
 		# make the class-average
 		try:
 			avg,ptcl_info=class_average([self.data["usefilt"][1]]+self.data["usefilt"][2],ref,options["niter"],options["normproc"],options["prefilt"],options["align"],
 				options["aligncmp"],options["ralign"],options["raligncmp"],options["averager"],options["scmp"],options["keep"],options["keepsig"],
-				options["automask"],options["saveali"],options["verbose"],callback)
+				options["automask"],options["saveali"],options["verbose"],callback,cache=cache)
 		except KeyboardInterrupt: return None
 		except SystemExit: return None
 		except:
@@ -359,7 +364,7 @@ class ClassAvTask(JSTask):
 			if options["verbose"]>0 : print "Final realign:",fxf
 #			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,Transform(),options["averager"],options["normproc"],options["verbose"])
 #			avg.write_image("bdb:xf",-1)
-			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,ref,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
+			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,ref,options["averager"],options["normproc"],options["setsfref"],options["verbose"],cache)
 #			avg.write_image("bdb:xf",-1)
 
 			#self.data["ref"].write_image("tst.hdf",-1)
@@ -383,7 +388,7 @@ class ClassAvTask(JSTask):
 				
 			if options["verbose"]>0 : print "Final center:",fxf.get_trans_2d()
 			avg1=avg
-			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,None,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
+			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,None,options["averager"],options["normproc"],options["setsfref"],options["verbose"],cache)
 		try:
 			avg["class_ptcl_qual"]=avg1["class_ptcl_qual"]
 			avg["class_ptcl_qual_sigma"]=avg1["class_ptcl_qual_sigma"]
@@ -399,10 +404,61 @@ class ClassAvTask(JSTask):
 
 jsonclasses["ClassAvTask"]=ClassAvTask.from_jsondict
 
-def get_image(images,n,normproc=("normalize.edgemean",{})):
-	"""used to get an image from a descriptor as provided to class_average function. Always a copy of the actual image."""
+class ParticleCache:
+	"""Keeps normalized particles in memory, so particles used in several iterations, in several classes (--sep), or
+	for both alignment and averaging are only read and normalized once. Least recently used particles are dropped
+	beyond maxmem (MB)."""
+
+	def __init__(self,maxmem=256):
+		self.maxmem=maxmem*1048576.0
+		self.mem=0
+		self.images=OrderedDict()		# (filename,n,normproc) -> EMData, oldest first
+
+	def get(self,fsp,n,normproc):
+		"""Returns a copy of the normalized particle"""
+		key=(fsp,n,str(normproc))
+		try :
+			img=self.images.pop(key)
+			self.images[key]=img		# move to the end
+			return img.copy()
+		except KeyError : pass
+
+		img=EMData(fsp,n)
+		if normproc!=None : img.process_inplace(normproc[0],normproc[1])
+
+		sz=img["nx"]*img["ny"]*img["nz"]*4
+		if sz>self.maxmem : return img
+
+		self.images[key]=img
+		self.mem+=sz
+		while self.mem>self.maxmem :
+			old=self.images.popitem(False)[1]
+			self.mem-=old["nx"]*old["ny"]*old["nz"]*4
+
+		return img.copy()
+
+cache_instance=None
+
+def local_ranks():
+	"""Returns the number of MPI ranks running on this node, as reported by the MPI launcher, or 1 when not running under MPI"""
+	for var in ("OMPI_COMM_WORLD_LOCAL_SIZE","MPI_LOCALNRANKS","MV2_COMM_WORLD_LOCAL_SIZE"):
+		try: return max(int(os.environ[var]),1)
+		except: pass
+	return 1
+
+def particle_cache(maxmem=256):
+	"""Returns the cache shared by all tasks executed in this process, or None if maxmem is 0"""
+	global cache_instance
+	if maxmem<=0 : return None
+	if cache_instance==None or cache_instance.maxmem!=maxmem*1048576.0 : cache_instance=ParticleCache(maxmem)
+	return cache_instance
+
+def get_image(images,n,normproc=("normalize.edgemean",{}),cache=None):
+	"""used to get an image from a descriptor as provided to class_average function. Always a copy of the actual image.
+	If a ParticleCache is provided, particles read from a file are taken from it."""
 	if isinstance(images[0],EMData) : ret=images[n].copy()
 	elif n>len(images)-2 : raise Exception, "get_image() outside range"
+	elif cache!=None : return cache.get(images[0],images[n+1],normproc)
 	else: ret=EMData(images[0],images[n+1])
 
 	if normproc!=None : ret.process_inplace(normproc[0],normproc[1])
@@ -428,7 +484,7 @@ def align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp):
 
 	return ali
 
-def class_average_withali(images,ptcl_info,xform,ref,averager=("mean",{}),normproc=("normalize.edgemean",{}),setsfref=0,verbose=0):
+def class_average_withali(images,ptcl_info,xform,ref,averager=("mean",{}),normproc=("normalize.edgemean",{}),setsfref=0,verbose=0,cache=None):
 	"""This will generate a final class-average, given a ptcl_info list as returned by class_average,
 	and a final transform to be applied to each of the relative transforms in ptcl_info. ptcl_info will
 	be modified in-place to contain the aggregate transformations, and the final aligned average will be returned"""
@@ -442,7 +498,7 @@ def class_average_withali(images,ptcl_info,xform,ref,averager=("mean",{}),normpr
 #	xforms=[]
 	avgr=Averagers.get(averager[0], averager[1])
 	for i in range(nimg):
-		img=get_image(images,i,normproc)
+		img=get_image(images,i,normproc,cache)
 		ptcl_info[i]=(ptcl_info[i][0],xform*ptcl_info[i][1],ptcl_info[i][2])		# apply the new Transform to the existing one
 #		ptcl_info[i]=(ptcl_info[i][0],ptcl_info[i][1]*xform,ptcl_info[i][2])		# apply the new Transform to the existing one
 		img.process_inplace("xform",{"transform":ptcl_info[i][1]})
@@ -475,7 +531,7 @@ def class_average_withali(images,ptcl_info,xform,ref,averager=("mean",{}),normpr
 	return avg
 
 def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),prefilt=0,align=("rotate_translate_flip",{}),
-		aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,verbose=0,callback=None,center="xform.center"):
+		aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,verbose=0,callback=None,center="xform.center",cache=None):
 	"""Create a single class-average by iterative alignment and averaging.
 	images - may either be a list/tuple of images OR a tuple containing a filename followed by integer image numbers
 	ref - optional reference image (EMData).
@@ -490,6 +546,7 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 	scmp - cmp tuple for comparing particle to reference for purposes of discarding bad particles
 	keep - 'keep' value. Meaning depends on keepsig.
 	keepsig - if set, keep is a 'sigma multiplier', otherwise keep is a fractional value (ie - 0.9 means discard the worst 10% of particles)
+	cache - optional ParticleCache, so each particle is only read and normalized once
 
 	returns (average,((cmp,xform,used),(cmp,xform,used),...))
 	"""
@@ -504,12 +561,12 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 	if verbose>2 : print "Average %d images"%nimg
 
 	# If one image and no reference, just return it
-	if nimg==1 and ref==None : return (get_image(images,0,normproc),[(0,Transform(),1)])
+	if nimg==1 and ref==None : return (get_image(images,0,normproc,cache),[(0,Transform(),1)])
 
 	# If one particle and reference, align and return
 	if nimg==1:
 		if averager[0]!="mean" : raise Exception,"Cannot perform correct average of single particle"
-		ali=align_one(get_image(images,0,normproc),ref,prefilt,align,aligncmp,ralign,raligncmp)
+		ali=align_one(get_image(images,0,normproc,cache),ref,prefilt,align,aligncmp,ralign,raligncmp)
 		try: ali["model_id"]=ref["model_id"]
 		except: pass
 		sim=ali.cmp(scmp[0],ref,scmp[1])			# compare similarity to reference (may use a different cmp() than the aligner)
@@ -520,14 +577,14 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 		if verbose : print "Generating reference"
 #		sigs=[(get_image(i)["sigma"],i) for i in range(nimg)]		# sigma for each input image, inefficient
 #		ref=get_image(images,max(sigs)[1])
-		ref=get_image(images,0,normproc)										# just start with the first, as EMAN1
+		ref=get_image(images,0,normproc,cache)										# just start with the first, as EMAN1
 
 		# now align and average the set to the gradually improving average
 		for i in range(1,nimg):
 			if verbose>1 :
 				print ".",
 				sys.stdout.flush()
-			ali=align_one(get_image(images,i,normproc),ref,prefilt,align,aligncmp,ralign,raligncmp)
+			ali=align_one(get_image(images,i,normproc,cache),ref,prefilt,align,aligncmp,ralign,raligncmp)
 			ref.add(ali)
 
 		# A little masking and centering
@@ -616,8 +673,8 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 		# Now align and average
 		avgr=Averagers.get(averager[0], averager[1])
 		for i in range(nimg):
-			if callback!=None and nimg%10==9 : callback(int((it+i/float(nimg))*100/(niter+2.0)))
-			ptcl=get_image(images,i,normproc)					# get the particle to align
+			if callback!=None and i%10==9 : callback(int((it+i/float(nimg))*100/(niter+2.0)))
+			ptcl=get_image(images,i,normproc,cache)					# get the particle to align
 			ali=align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp)  # align to reference
 			sim=ali.cmp(scmp[0],ref,scmp[1])			# compare similarity to reference (may use a different cmp() than the aligner)
 			if saveali and it==niter : ali.write_image("aligned.hdf",-1)
@@ -50,7 +50,9 @@ def main():
 
 	e2simmx.py proj.hed part.hed simMatrix.hed --saveali --align=rotate_translate:maxshift=5
 
-	The similarity matrix is a stack of 1 or 5 images: similarity, dx,dy,dalpha,mirror.
+	The similarity matrix is a stack of 1 or 5 images: similarity, dx,dy,dalpha,mirror. Sparse matrices produced by
+	e2simmx.py --prune are also accepted. These contain only the best references for each particle, with the reference
+	number for each column in an additional final image.
 	The output is 6 images: class, weight, dx, dy, dalpha, mirror).
 	See the wiki for more complete documentation of the files.
 	"""
@@ -103,7 +105,16 @@ def main():
 
 	tmp=EMData(args[0],0,True)
 	nptcl=tmp["ny"]
-	nref=tmp["nx"]
+	nref=tmp["nx"]		# for a sparse matrix, this is the number of retained references per particle
+	sparse=tmp.has_attr("sparse_nref")
+	if sparse :
+		if options.simvec :
+			print "Error: --simvec requires a full similarity matrix, not a sparse one"
+			sys.exit(1)
+		if options.sep>nref :
+			print "Error: the sparse similarity matrix only has %d references per particle, --sep=%d requested"%(nref,options.sep)
+			sys.exit(1)
+		num_sim-=1		# the last image contains reference numbers
 	if num_sim==5:
 		clsmx=(EMData(options.sep,nptcl),EMData(options.sep,nptcl),EMData(options.sep,nptcl),EMData(options.sep,nptcl),EMData(options.sep,nptcl),EMData(options.sep,nptcl))
 	elif num_sim==6:
@@ -141,6 +152,7 @@ def main():
 		
 		
 	simmx=(EMData(),EMData(),EMData(),EMData(),EMData(),EMData())
+	if sparse: refn=EMData()
 	for iptcl in xrange(nptcl):
 		simmx[0].read_image(args[0],0,False,Region(0,iptcl,nref,1))
 		if num_sim>=5 :
@@ -151,6 +163,7 @@ def main():
 			try:
 				simmx[5].read_image(args[0],5,False,Region(0,iptcl,nref,1))		#scale
 			except: pass
+		if sparse : refn.read_image(args[0],num_sim,False,Region(0,iptcl,nref,1))		# reference number for each column
 		
 		# We replace simmx[0] with a new version computed via average vectors
 		if options.simvec:
@@ -165,7 +178,8 @@ def main():
 		maximum=simmx[0]["maximum"]
 		for ic in xrange(options.sep):
 			cls=simmx[0].calc_min_index()
-			clsmx[0][ic,iptcl]=cls
+			if sparse : clsmx[0][ic,iptcl]=int(refn[cls])
+			else : clsmx[0][ic,iptcl]=cls
 			clsmx[1][ic,iptcl]=1.0		# weight
 			if num_sim>=5:
 				clsmx[2][ic,iptcl]=simmx[1][cls]
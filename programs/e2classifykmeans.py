@@ -43,8 +43,11 @@ import math
 import glob
 from os import system
 from os import unlink
-from sys import argv
 from EMAN2 import *
+import threading
+import Queue
+import traceback
+import numpy as np
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -73,6 +76,10 @@ together."""
 	parser.add_argument("--exclude", type=str,default=None,help="The named file should contain a set of integers, each representing an image from the input file to exclude.")
 	parser.add_argument("--minchange", type=int,default=-1,help="Minimum number of particles that change group before deicding to terminate. Default = len(data)/(#cls*25)")
 	parser.add_argument("--fastseed", action="store_true", default=False,help="Will seed the k-means loop quickly, but may produce lest consistent results.")
+	parser.add_argument("--minibatch", action="store_true", default=False,help="Use mini-batch k-means, which reads the input in random batches rather than loading it into memory. Suitable for very large data sets. --minchange is not used.")
+	parser.add_argument("--batchsize", type=int,default=1000,help="Number of images in each batch with --minibatch. Default=1000")
+	parser.add_argument("--niter", type=int,default=100,help="Number of batches used to refine the centers with --minibatch. Default=100")
+	parser.add_argument("--threads", type=int,default=1,help="Number of batches read and processed in parallel with --minibatch. Default=1")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 
@@ -81,7 +88,11 @@ together."""
 	
 	print "Classify by k-means"
 	logid=E2init(sys.argv, options.ppid)
-	if options.onein :
+	if options.minibatch :
+		if options.onein : data=KMeansData(args[0],0)
+		elif options.oneinali : data=KMeansData(args[0],4)
+		else : data=KMeansData(args[0])
+	elif options.onein :
 		d=EMData(args[0],0)
 		xs=d.get_xsize()
 		data=[]
@@ -107,20 +118,31 @@ together."""
 			excl=[int(i) for i in excl]
 			excl.sort(reverse=True)
 			for i in excl : 
-				del data[i]
+				if not options.minibatch : del data[i]
 				del filen[i]
 		except: print "Warning: exclude file failed"		# it's ok if this fails
 
-	print len(data)," images to classify."
+	print len(filen)," images to classify."
 
-	if options.minchange<=0 : options.minchange=len(data)/(options.ncls*25)+1
 	if options.fastseed : slowseed=0
 	else : slowseed=1
-	an=Analyzers.get("kmeans")
-	an.set_params({"ncls":options.ncls,"minchange":options.minchange,"verbose":1,"slowseed":slowseed,"calcsigmamean":options.sigma,"mininclass":options.mininclass})
-	
-	an.insert_images_list(data)
-	centers=an.analyze()
+	if options.minibatch :
+		data.filen=filen
+		centers,clsid=kmeans_minibatch(data,options.ncls,options.batchsize,options.niter,options.threads,options.mininclass,slowseed,options.sigma,options.verbose)
+		ali=[data.ali(n) for n in range(len(filen))]
+	else :
+		if options.minchange<=0 : options.minchange=len(data)/(options.ncls*25)+1
+		an=Analyzers.get("kmeans")
+		an.set_params({"ncls":options.ncls,"minchange":options.minchange,"verbose":1,"slowseed":slowseed,"calcsigmamean":options.sigma,"mininclass":options.mininclass})
+		
+		an.insert_images_list(data)
+		centers=an.analyze()
+		
+		clsid=[i.get_attr("class_id") for i in data]
+		ali=[]
+		for i in data:
+			try : ali.append((i.get_attr("ref_dx"),i.get_attr("ref_dy"),i.get_attr("ref_da"),i.get_attr("ref_flip")))
+			except : ali.append((0,0,0,0))
 	
 	nrep=[i.get_attr("ptcl_repr") for i in centers[:options.ncls]]
 	maxcls=max(nrep)
@@ -128,8 +150,8 @@ together."""
 		print "%d) %s (%d)"%(n,"#"*int(i*72/maxcls),i)
 		
 	classes=[[] for i in range(options.ncls)]
-	for n,i in enumerate(data):
-		classes[i.get_attr("class_id")].append(n)
+	for n,i in enumerate(clsid):
+		classes[i].append(n)
 		
 	# This is the old python version of the algorithm, functional but slow
 	# left here in case someone needs something they can tweak
@@ -189,39 +211,24 @@ together."""
 				centers[i].write_image("avg.hdf",-1)
 				if options.sigma: centers[i+options.ncls].write_image("avgsig.hdf",-1)
 			
-			# if original images specified, also write those averages to avg.orig.hed
-			if options.original :
-				for j in range(options.ncls):
-					i0=EMData(options.original,filen[classes[j][0]])
-					if (i0["nz"]>1) : avg=Averagers.get("mean.tomo")
-					elif options.sigma: 
-						i0.to_zero()
-						avg=Averagers.get("mean",{"ignore0":1,"sigma":i0})
-					else: avg=Averagers.get("mean",{"ignore0":1})
-					
-					for i in range(len(classes[j])):
-						avg.add_image(EMData(options.original,filen[classes[j][i]]))
-
-					avgi=avg.finish()
-					avgi.write_image("avg.orig.hdf",-1)
-					
-					if options.sigma and i0["nz"]==1:
-						i0.write_image("avgsig.orig.hdf",-1)
-					
+	# if original images specified, also write those averages to avg.orig.hed
+	avgorig=options.average and options.original and centers[0].get_zsize()==1
+	stackname=args[0]
+	if options.original : stackname=options.original
 		
 	if (options.clsfiles) :
 		map(os.remove, glob.glob('cls????.lst'))
-		stackname=argv[1]
-		if options.original : stackname=options.original
 		for j in range(options.ncls):
 			out=open("cls%04d.lst"%j,"w")
 			out.write("#LST\n")
 			for i in range(len(classes[j])):
 				out.write("%d\t%s\n"%(filen[classes[j][i]],stackname))
-				im=EMData(stackname,filen[classes[j][i]])
-				im.write_image("cls%04d.hdf"%j,-1)
 			out.close()
 	
+	# each image is read only once, in file order, for both the class stacks and the averages of the original images
+	if options.clsfiles or avgorig :
+		extract_classes(stackname,filen,classes,options.clsfiles,avgorig,options.sigma)
+	
 	# Write an EMAN2 standard classification matrix. Particles run along y
 	# each class a particle is in takes a slot in x. There are then a set of
 	# 6 images containing class #, a weight, and dx,dy,dangle,flip
@@ -231,25 +238,19 @@ together."""
 		clsnum.to_zero
 		clsnum+= -1			# class numbers are initialized to -1 in case we're using exclude
 		
-		dx=EMData(1,len(data),1)
-		dy=EMData(1,len(data),1)
-		dang=EMData(1,len(data),1)
-		flip=EMData(1,len(data),1)
+		dx=EMData(1,nimg,1)
+		dy=EMData(1,nimg,1)
+		dang=EMData(1,nimg,1)
+		flip=EMData(1,nimg,1)
 	
 		weight.to_one()
 		dx.to_zero()
-		for n,i in enumerate(data):
-			clsnum[filen[n]]=float(i.get_attr("class_id"))
-			try :
-				dx[filen[n]]=float(i.get_attr("ref_dx"))
-				dy[filen[n]]=float(i.get_attr("ref_dy"))
-				dang[filen[n]]=float(i.get_attr("ref_da"))
-				flip[filen[n]]=float(i.get_attr("ref_flip"))
-			except:
-				dx[filen[n]]=0
-				dy[filen[n]]=0
-				dang[filen[n]]=0
-				flip[filen[n]]=0
+		for n,i in enumerate(clsid):
+			clsnum[filen[n]]=float(i)
+			dx[filen[n]]=float(ali[n][0])
+			dy[filen[n]]=float(ali[n][1])
+			dang[filen[n]]=float(ali[n][2])
+			flip[filen[n]]=float(ali[n][3])
 		
 		remove_image(options.clsmx)
 		clsnum.write_image(options.clsmx,0)
@@ -261,5 +262,212 @@ together."""
 	
 	E2end(logid)
 
+def extract_classes(stackname,filen,classes,clsfiles,average,sigma):
+	"""Reads each classified image from stackname once, in file order, appending it to cls####.hdf for its class if clsfiles
+is set, and adding it to the average of its class if average is set. The averages are then written to avg.orig.hdf, and
+the standard deviations to avgsig.orig.hdf if sigma is set. Empty classes get a zero image, so image j is always class j."""
+	order=sorted([(filen[n],j) for j in range(len(classes)) for n in classes[j]])
+	
+	avgs={}
+	sigs={}
+	for i,j in order:
+		im=EMData(stackname,i)
+		if clsfiles : im.write_image("cls%04d.hdf"%j,-1)
+		if not average : continue
+		
+		if j not in avgs :
+			if (im["nz"]>1) : avgs[j]=Averagers.get("mean.tomo")
+			elif sigma: 
+				sigs[j]=im.copy()
+				sigs[j].to_zero()
+				avgs[j]=Averagers.get("mean",{"ignore0":1,"sigma":sigs[j]})
+			else: avgs[j]=Averagers.get("mean",{"ignore0":1})
+		avgs[j].add_image(im)
+	
+	if not average : return
+	
+	hdr=EMData(stackname,order[0][0],True)
+	for j in range(len(classes)):
+		if j in avgs : avgi=avgs[j].finish()
+		else :
+			avgi=EMData(hdr["nx"],hdr["ny"],hdr["nz"])
+			avgi.to_zero()
+			avgi["ptcl_repr"]=0
+		avgi.write_image("avg.orig.hdf",-1)
+		if sigma and hdr["nz"]==1 :
+			if j in sigs : sigs[j].write_image("avgsig.orig.hdf",-1)
+			else :
+				avgi.to_zero()
+				avgi.write_image("avgsig.orig.hdf",-1)
+
+class KMeansData:
+	"""Reads the vectors to classify as needed, rather than loading them into memory. They are either the images in
+a stack, or if skip is set, the rows of a single 2-D image with the first 'skip' elements of each row omitted (--onein,
+--oneinali). filen are the image numbers to use. Reads are serialized, so rows() may be called from multiple threads."""
+	def __init__(self,fsp,skip=None):
+		self.fsp=fsp
+		self.lock=threading.Lock()
+		self.aliparm=None
+		if skip==None :
+			self.rowdata=None
+			hdr=EMData(fsp,0,True)
+			self.shape=(hdr["nx"],hdr["ny"],hdr["nz"])
+			self.filen=range(EMUtil.get_image_count(fsp))
+		else :
+			img=EMData(fsp,0)
+			d=EMNumPy.em2numpy(img)
+			self.rowdata=d[:,skip:].copy()
+			if skip>=4 : self.aliparm=d[:,:4].copy()
+			self.shape=(self.rowdata.shape[1],1,1)
+			self.filen=range(self.rowdata.shape[0])
+		self.dim=self.shape[0]*self.shape[1]*self.shape[2]
+	
+	def __len__(self): 
+		return len(self.filen)
+	
+	def rows(self,idx):
+		"""Returns an array with one row for each element of idx, which are indices into filen"""
+		if self.rowdata is not None : return self.rowdata[[self.filen[i] for i in idx]].astype(np.float32)
+		
+		ret=np.empty((len(idx),self.dim),dtype=np.float32)
+		for j,i in enumerate(idx):
+			with self.lock: im=EMData(self.fsp,self.filen[i])
+			ret[j]=EMNumPy.em2numpy(im).ravel()
+		return ret
+	
+	def ali(self,i):
+		"""dx,dy,da,flip for element i of filen, from the first 4 elements of its row with --oneinali"""
+		if self.aliparm is None : return (0,0,0,0)
+		a=self.aliparm[self.filen[i]]
+		return tuple(a)
+	
+	def image(self,v):
+		"""Converts a vector back into an image"""
+		if self.shape[2]>1 : return EMNumPy.numpy2em(v.reshape(self.shape[2],self.shape[1],self.shape[0]).astype(np.float32))
+		return EMNumPy.numpy2em(v.reshape(self.shape[1],self.shape[0]).astype(np.float32))
+
+def kmeans_minibatch(data,ncls,batchsize,niter,threads,mininclass,slowseed,sigma,verbose):
+	"""Mini-batch k-means. Centers are seeded from a random sample of data using k-means++ (or randomly if not slowseed),
+then refined with niter random batches, each moving the centers towards the mean of their members in the batch with a
+per-center learning rate of 1/(number of members so far). A final pass over all of the data assigns each vector to its
+closest center and computes the exact class means. Classes with fewer than mininclass members are reseeded and refined
+again, up to 3 times. Returns the class averages (followed by the standard deviations if sigma is set) with ptcl_repr
+set, as the kmeans Analyzer does, and the class of each vector."""
+	n=len(data)
+	rng=np.random.RandomState(1)
+	batchsize=min(batchsize,n)
+	
+	seed=np.sort(rng.permutation(n)[:min(n,max(batchsize,ncls*10))])
+	pts=data.rows(seed).astype(np.float64)
+	if slowseed : centers=kmeans_pp(pts,ncls,rng)
+	else : centers=pts[rng.permutation(len(pts))[:ncls]]
+	pts=None
+	counts=np.zeros(ncls)
+	
+	# each batch is assigned using a snapshot of the centers, taken so it never sees a partial update
+	lock=threading.Lock()
+	def snapshot():
+		with lock: return centers.copy()
+	
+	for attempt in range(4):
+		batches=[np.sort(rng.randint(0,n,batchsize)) for i in range(niter)]
+		for it,(idx,lab,sums,sqsums,cnt) in enumerate(kmeans_chunks(batches,threads,lambda b:kmeans_assign(data,b,snapshot(),False))):
+			counts+=cnt
+			upd=cnt>0
+			with lock: centers[upd]+=(sums[upd]-cnt[upd,None]*centers[upd])/counts[upd,None]
+			if verbose>1 : print "batch %d/%d"%(it+1,niter)
+		
+		# final assignment of all of the data, in chunks
+		chunks=[np.arange(i,min(i+batchsize,n)) for i in range(0,n,batchsize)]
+		clsid=np.zeros(n,dtype=np.int32)
+		sums=np.zeros(centers.shape)
+		sqsums=np.zeros(centers.shape)
+		counts=np.zeros(ncls)
+		for idx,lab,s,sq,cnt in kmeans_chunks(chunks,threads,lambda b:kmeans_assign(data,b,centers,sigma)):
+			clsid[idx]=lab
+			sums+=s
+			if sigma : sqsums+=sq
+			counts+=cnt
+		
+		small=np.nonzero(counts<mininclass)[0]
+		if len(small)==0 or attempt==3 : break
+		if verbose>0 : print "Reseeding %d classes with fewer than %d members"%(len(small),mininclass)
+		centers[small]=data.rows(np.sort(rng.permutation(n)[:len(small)]))
+		counts[small]=0
+	
+	nz=counts>0
+	centers[nz]=sums[nz]/counts[nz,None]
+	
+	ret=[]
+	for j in range(ncls):
+		im=data.image(centers[j])
+		im["ptcl_repr"]=int(counts[j])
+		ret.append(im)
+	if sigma :
+		sqsums[nz]=np.sqrt(np.maximum(sqsums[nz]/counts[nz,None]-centers[nz]**2,0))
+		for j in range(ncls):
+			im=data.image(sqsums[j])
+			im["ptcl_repr"]=int(counts[j])
+			ret.append(im)
+	
+	return ret,[int(i) for i in clsid]
+
+def kmeans_pp(pts,k,rng):
+	"""Chooses k rows of pts as initial centers using k-means++ seeding"""
+	centers=[rng.randint(len(pts))]
+	d=((pts-pts[centers[0]])**2).sum(1)
+	for i in range(1,k):
+		if d.sum()>0 : c=np.searchsorted(np.cumsum(d),rng.uniform(0,d.sum()))
+		else : c=rng.randint(len(pts))
+		c=min(c,len(pts)-1)
+		centers.append(c)
+		d=np.minimum(d,((pts-pts[c])**2).sum(1))
+	return pts[centers].copy()
+
+def kmeans_assign(data,idx,centers,sigma):
+	"""Assigns the vectors idx to the closest of centers. Returns idx, the class of each vector, and the sum,
+sum of squares (if sigma is set) and number of the vectors in each class"""
+	x=data.rows(idx).astype(np.float64)
+	lab=((centers**2).sum(1)[None,:]-2.0*np.dot(x,centers.T)).argmin(1)
+	
+	ncls=len(centers)
+	cnt=np.bincount(lab,minlength=ncls).astype(np.float64)
+	sums=np.zeros(centers.shape)
+	np.add.at(sums,lab,x)
+	sqsums=None
+	if sigma :
+		sqsums=np.zeros(centers.shape)
+		np.add.at(sqsums,lab,x*x)
+	return idx,lab,sums,sqsums,cnt
+
+def kmeans_chunks(jobs,threads,func):
+	"""Calls func(job) for each of jobs in 'threads' parallel threads, and yields the results in the order they complete.
+At most 'threads' results are held at once."""
+	queue=Queue.Queue(0)
+	for j in jobs: queue.put(j)
+	results=Queue.Queue(threads)
+	thrds=[threading.Thread(target=kmeans_worker,args=(queue,results,func)) for i in range(threads)]
+	for t in thrds:
+		t.daemon=True
+		queue.put(None)
+		t.start()
+	
+	for j in jobs:
+		r=results.get()
+		if r is None : raise Exception,"Error processing images"
+		yield r
+	
+	for t in thrds: t.join()
+
+def kmeans_worker(jobs,results,func):
+	"""Thread processing jobs until it receives None"""
+	while True:
+		j=jobs.get()
+		if j is None : return
+		try: results.put(func(j))
+		except:
+			traceback.print_exc()
+			results.put(None)
+
 if __name__ == "__main__":
 	main()
@@ -133,7 +133,7 @@ NOTE: This program should be run from the project directory, not from within the
 	parser.add_argument("--classify",type=int,help="Highly experimental ! Subclassify particles (hopefully by defocus) into n groups.",default=0)
 	parser.add_argument("--sf",type=str,help="The name of a file containing a structure factor curve. Specify 'none' to use the built in generic structure factor. Default=auto",default="auto",guitype='strbox',nosharedb=True,returnNone=True,row=14,col=1,rowspan=1,colspan=1, mode='autofit,tuning')
 	parser.add_argument("--parallel", default=None, help="parallelism argument. This program supports only thread:<n>")
-	parser.add_argument("--threads", default=1,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful",guitype='intbox', row=14, col=2, rowspan=1, colspan=1, mode='autofit[1]')
+	parser.add_argument("--threads", default=1,type=int,help="Number of processes to use for autofit on a single computer. Stacks are handed to processes one at a time, largest first",guitype='intbox', row=14, col=2, rowspan=1, colspan=1, mode='autofit[1]')
 	parser.add_argument("--debug",action="store_true",default=False)
 	parser.add_argument("--dbds",type=str,default=None,help="Obsolete option for old e2workflow. Present only to provide warning messages.")
 	parser.add_argument("--source_image",type=str,default=None,help="Filters particles only with matching ptcl_source_image parameters in the header")
@@ -223,21 +223,13 @@ NOTE: This program should be run from the project directory, not from within the
 	options.filenames = args
 
 	### Power spectrum and CTF fitting
-	if nthreads>1:
-		print "Fitting in parallel with ",nthreads," threads"
-		chunksize=int(ceil(float(len(args))/nthreads))
-#		print " ".join(sys.argv+["--chunk={},{}".format(chunksize,0)])
-		threads=[threading.Thread(target=os.system,args=[" ".join(sys.argv+["--chunk={},{}".format(chunksize,i)])]) for i in xrange(nthreads)]
-		for t in threads: t.start()
-		for t in threads: t.join()
-		print "Parallel fitting complete"
-	else:
-		img_sets=None
-		if options.autofit:
-			img_sets=pspec_and_ctf_fit(options,debug) # converted to a function so to work with the workflow
-
-			if options.constbfactor>0:
-				for i in img_sets: i[1].bfactor=options.constbfactor
+	img_sets=None
+	if options.autofit:
+		if nthreads>1 : print "Fitting in parallel with ",nthreads," processes"
+		img_sets=pspec_and_ctf_fit(options,debug,nthreads) # converted to a function so to work with the workflow
+
+		if options.constbfactor>0:
+			for i in img_sets: i[1].bfactor=options.constbfactor
 
 	### GUI - user can update CTF parameters interactively
 	if options.gui :
@@ -515,113 +507,175 @@ def fixnegbg(bg_1d,im_1d,ds):
 	print "BG correction ratio %1.4f"%ratio
 	return [i*ratio for i in bg_1d]
 
-def pspec_and_ctf_fit(options,debug=False):
+def pspec_and_ctf_fit(options,debug=False,nthreads=1):
 	"""Power spectrum and CTF fitting. Returns an 'image sets' list. Each item in this list contains
-	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None"""
+	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None. With nthreads>1 the stacks are
+	handed, largest first, to a pool of worker processes as each becomes free. Results are stored in the info files
+	by the calling process only."""
 	global logid
+
+	if nthreads<=1 :
+		results=(fit_stack_checked(filename,options,debug) for filename in options.filenames)
+	else :
+		results=fit_stacks_parallel(options,debug,nthreads)
+
+	fits={}
+	apix=None
+	try:
+		for i,(filename,sets,fapix) in enumerate(results):
+			if sets!=None :
+				store_ctf_fit(filename,sets)
+				fits[filename]=sets
+				apix=fapix
+
+			if logid : E2progress(logid,float(i+1)/len(options.filenames))
+	except IOError,e:
+		print "ERROR: {}. Exiting.".format(e)
+		sys.exit(1)
+
+	# keep the input order regardless of the order the fits finished in
 	img_sets=[]
-	#db_parms=db_open_dict("bdb:e2ctf.parms")
-	#db_im2d=db_open_dict("bdb:e2ctf.im2d")
-	#db_bg2d=db_open_dict("bdb:e2ctf.bg2d")
+	for filename in options.filenames:
+		if filename in fits : img_sets.extend(fits[filename])
 
-	for i,filename in enumerate(options.filenames):
-		name=base_name(filename)
-		try : js_parms=js_open_dict(info_name(filename))
-		except :
-			print "ERROR: Cannot open {} for metadata storage. Exiting.".format(info_name(filename))
-			sys.exit(1)
+	project_db = js_open_dict("info/project.json")
+	try: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
+	except:
+		print "ERROR: apix not found. This probably means that no CTF curves were sucessfully fit !"
 
-		# compute the power spectra
-		if options.verbose or debug : print "Processing ",filename
-		apix=options.apix
-		if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
-
-		# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
-		if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
-		else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
-		# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
-		if ps==None :
-			print "Error fitting CTF on ",filename
-			continue
-		try: ds=1.0/(apix*ps[0][2].get_ysize())
-		except:
-			print "Error fitting CTF (ds) on ",filename
-			continue
+	return img_sets
 
-		for j,p in enumerate(ps):
-			try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
-			except:
-				im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
-				micro_1d=None
-			if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
-			if options.fixnegbg :
-				bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
+def fit_stacks_parallel(options,debug,nthreads):
+	"""Generator yielding fit_stack() results for all of options.filenames as they complete, using nthreads worker
+	processes (the fitting is pure python in large part, so threads would serialize on the interpreter lock). Stacks
+	are queued largest first, so a few big ones don't end up running alone at the end. Each process keeps its own
+	mask cache."""
+	from multiprocessing import Pool
+
+	def stacksize(fsp):
+		try: return os.path.getsize(fsp)
+		except: return 0
+
+	todo=[(fsp,options,debug) for fsp in sorted(options.filenames,key=stacksize,reverse=True)]
+	pool=Pool(min(nthreads,len(todo)))
+	try:
+		# an IOError in a worker is re-raised here, and reported by the caller as in the single process case
+		for r in pool.imap_unordered(fit_stack_task,todo,1) : yield r
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def fit_stack_task(args):
+	"""fit_stack_checked() with its arguments packed in a tuple, for use in a multiprocessing Pool"""
+	return fit_stack_checked(*args)
+
+def fit_stack_checked(filename,options,debug=False):
+	"""fit_stack(), treating any error other than an unreadable info file (IOError) as a failed fit"""
+	try: return fit_stack(filename,options,debug)
+	except IOError: raise
+	except:
+		traceback.print_exc()
+		print "Error fitting CTF on ",filename
+		return (filename,None,None)
+
+def fit_stack(filename,options,debug=False):
+	"""Computes the power spectra of one particle stack and fits the CTF. Returns (filename,img_sets,apix), where img_sets contains
+	one image set (as in pspec_and_ctf_fit) per particle class, or is None on failure. The info file is read, but not written.
+	Raises IOError if the info file cannot be opened."""
+
+	try : js_parms=js_open_dict(info_name(filename))
+	except : raise IOError("Cannot open {} for metadata storage".format(info_name(filename)))
+	oldctf=js_parms.getdefault("ctf",None)
+	oldframe=js_parms.getdefault("ctf_frame",None)
+	qual=js_parms.getdefault("quality",5)
+	js_parms.close()
+
+	# compute the power spectra
+	if options.verbose or debug : print "Processing ",filename
+	apix=options.apix
+	if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
+
+	# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
+	if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
+	else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
+	# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
+	if ps==None :
+		print "Error fitting CTF on ",filename
+		return (filename,None,apix)
+	try: ds=1.0/(apix*ps[0][2].get_ysize())
+	except:
+		print "Error fitting CTF (ds) on ",filename
+		return (filename,None,apix)
+
+	img_sets=[]
+	for j,p in enumerate(ps):
+		try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
+		except:
+			im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
+			micro_1d=None
+		if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
+		if options.fixnegbg :
+			bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
 
-			if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
+		if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
 
-			# Fit the CTF parameters
-			if debug : print "Fit CTF"
-			if options.curdefocushint or options.curdefocusfix:
+		# Fit the CTF parameters
+		if debug : print "Fit CTF"
+		if options.curdefocushint or options.curdefocusfix:
+			try:
+				ctf=oldctf[0]
+				curdf=ctf.defocus
+				curdfdiff=ctf.dfdiff
+				curdfang=ctf.dfang
+				if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
+				else: dfhint=(curdf-.001,curdf+.001)
+				print "Using existing defocus as hint :",dfhint
+			except :
 				try:
-					ctf=js_parms["ctf"][0]
+					ctf=oldframe[1]
 					curdf=ctf.defocus
 					curdfdiff=ctf.dfdiff
 					curdfang=ctf.dfang
 					if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
 					else: dfhint=(curdf-.001,curdf+.001)
-					print "Using existing defocus as hint :",dfhint
-				except :
-					try:
-						ctf=js_parms["ctf_frame"][1]
-						curdf=ctf.defocus
-						curdfdiff=ctf.dfdiff
-						curdfang=ctf.dfang
-						if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
-						else: dfhint=(curdf-.001,curdf+.001)
-						print "Using existing defocus from frame as hint :",dfhint
-					except:
-						dfhint=None
-						print "No existing defocus to start with"
-			else: dfhint=(options.defocusmin,options.defocusmax)
-			ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,options.cs,options.ac,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
-			if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
-			elif options.astigmatism:
-				ctf.dfdiff=curdfdiff
-				ctf.dfang=curdfang
-
-			im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
-			if options.constbfactor>0 : ctf.bfactor=options.constbfactor
-			else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
-
-
-			if debug:
-				Util.save_data(0,ds,im_1d,"ctf.fg.txt")
-				Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
-				Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
-
-			try : qual=js_parms["quality"]
-			except :
-				qual=5
-				js_parms["quality"]=5
-			if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-			else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-
-		# store the results back in the database. We omit the filename, quality and bg_1d_low (which can be easily recomputed)
-		if img_sets[-1][-1]==None: js_parms.delete("ctf_microbox")
-		else: js_parms["ctf_microbox"]=img_sets[-1][-1]
-		js_parms["ctf"]=img_sets[-1][1:4]
-		js_parms["ctf_im2d"]=img_sets[-1][4]
-		js_parms["ctf_bg2d"]=img_sets[-1][5]
-		js_parms.close()
-
-		if logid : E2progress(logid,float(i+1)/len(options.filenames))
-
-	project_db = js_open_dict("info/project.json")
-	try: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
-	except:
-		print "ERROR: apix not found. This probably means that no CTF curves were sucessfully fit !"
-
-	return img_sets
+					print "Using existing defocus from frame as hint :",dfhint
+				except:
+					dfhint=None
+					print "No existing defocus to start with"
+		else: dfhint=(options.defocusmin,options.defocusmax)
+		ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,options.cs,options.ac,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
+		if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
+		elif options.astigmatism:
+			ctf.dfdiff=curdfdiff
+			ctf.dfang=curdfang
+
+		im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
+		if options.constbfactor>0 : ctf.bfactor=options.constbfactor
+		else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
+
+
+		if debug:
+			Util.save_data(0,ds,im_1d,"ctf.fg.txt")
+			Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
+			Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
+
+		if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
+		else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
+
+	return (filename,img_sets,apix)
+
+def store_ctf_fit(filename,img_sets):
+	"""Stores the fit from fit_stack() in the info file for filename. We omit the filename, quality and bg_1d_low (which can be easily recomputed)"""
+
+	js_parms=js_open_dict(info_name(filename))
+	if not js_parms.has_key("quality") : js_parms["quality"]=5
+	if img_sets[-1][-1]==None: js_parms.delete("ctf_microbox")
+	else: js_parms["ctf_microbox"]=img_sets[-1][-1]
+	js_parms["ctf"]=img_sets[-1][1:4]
+	js_parms["ctf_im2d"]=img_sets[-1][4]
+	js_parms["ctf_bg2d"]=img_sets[-1][5]
+	js_parms.close()
 
 def refine_and_smoothsnr(options,strfact,debug=False):
 	"""This will refine already determined defocus values by maximizing high-resolution smoothed
@@ -1013,17 +1067,19 @@ def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=
 		masks[(ys,radius)]=(mask1,ratio1,mask2,ratio2)
 #		display((mask1,mask2))
 
+	# the header index lets us select particles by source image without reading every header
+	if source_image!=None : srcs=get_headers(stackfile,"ptcl_source_image")["ptcl_source_image"]
+	if ptclns!=None : ptclns=set(ptclns)
+
 	av1,av2=None,None
 	for i in range(n):
 		if ptclns!=None and i not in ptclns :continue
 		im1 = EMData()
 		if source_image!=None :
-			im1.read_image(stackfile,i,True)
-			try:
-				if im1["ptcl_source_image"]!=source_image : continue
-			except:
+			if srcs[i]==None :
 				print "Image %d doesn't have the ptcl_source_image parameter. Skipping."%i
 				continue
+			if srcs[i]!=source_image : continue
 
 		im1.read_image(stackfile,i)
 
@@ -2722,8 +2778,8 @@ class GUIctf(QtGui.QWidget):
 #			self.guiplot.updateGL()
 		# All SNR vs defocus
 		elif self.plotmode==9:
-			dflist=[d[1].defocus for d in self.data]
-			snrlist=[sum(d[1].snr)/len(d[1].snr) for d in self.data]
+			dflist=[st[1].defocus for st in self.data]
+			snrlist=[sum(st[1].snr)/len(st[1].snr) for st in self.data]
 			self.guiplot.set_data((dflist,snrlist),"df vs snr",replace=True,linetype=-1,symtype=0,symsize=2)		# erase existing data quietly
 
 			self.guiplot.setAxisParms("Defocus (um)","Mean SNR")
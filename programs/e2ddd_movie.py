@@ -33,6 +33,11 @@
 import pprint
 from EMAN2 import *
 import sys
+import threading
+import Queue
+import traceback
+from collections import deque
+from itertools import islice,izip
 from numpy import *
 import numpy.linalg as LA
 
@@ -66,6 +71,7 @@ def main():
 	parser.add_argument("--movie", type=int,help="Display an n-frame averaged 'movie' of the stack, specify number of frames to average",default=0)
 	parser.add_argument("--simpleavg", action="store_true",help="Will save a simple average of the dark/gain corrected frames (no alignment or weighting)",default=False)
 	parser.add_argument("--avgs", action="store_true",help="Testing",default=False)
+	parser.add_argument("--streaming", action="store_true",help="Rather than keeping all corrected frames in memory, store them in a temporary file which is read sequentially as needed. Only a few frames are in memory at once. The next movie is corrected while the current one is processed.",default=False)
 	parser.add_argument("--parallel", default=None, help="parallelism argument. This program supports only thread:<n>")
 	parser.add_argument("--threads", default=1,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful", guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="refinement[4]")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-2)
@@ -87,8 +93,7 @@ def main():
 	if options.threads>1 : 
 		threads=max(threads,options.threads)
 
-	#if threads>1 : print "Running with {} threads".format(threads)
-	if threads>1 : print "Sorry, limited to one thread at the moment."
+	if threads>1 : print "Correcting frames with {} threads".format(threads)
 
 	pid=E2init(sys.argv)
 
@@ -168,9 +173,8 @@ def main():
 
 	# the user may provide multiple movies to process at once
 
+	movies=[]
 	for fsp in args:
-		if options.verbose : print "Processing", fsp
-				
 		n = EMUtil.get_image_count(fsp)
 
 		if n < 3 : 
@@ -189,54 +193,172 @@ def main():
 
 		if flast > n :
 			flast = n
-		
-		process_movie(fsp, dark, gain, first, flast, step, options)
-		
-	E2end(pid)
 
-def process_movie(fsp,dark,gain,first,flast,step,options):
-		outname=fsp.rsplit(".",1)[0]+"_proc.hdf"		# always output to an HDF file. Output contents vary with options
+		movies.append((fsp,flast))
+
+	# in streaming mode, the next movie is read and corrected in the background while the current one is processed
+	nextq=None
+	for i,(fsp,flast) in enumerate(movies):
+		if options.verbose : print "Processing", fsp
+
+		if nextq==None : frames=prepare_movie(fsp, dark, gain, first, flast, step, options, threads)
+		else : frames=nextq.get()
+
+		if options.streaming and i+1<len(movies) :
+			nextq=Queue.Queue(1)
+			thr=threading.Thread(target=prepare_movie,args=(movies[i+1][0], dark, gain, first, movies[i+1][1], step, options, threads, nextq))
+			thr.start()
+		else : nextq=None
+
+		if frames==None :
+			print "ERROR: unable to read/correct ",fsp
+			continue
+
+		process_movie(fsp, frames, first, flast, options)
+		frames.close()
 
+	E2end(pid)
+
+def ordered_imap(fn,items,threads=1,window=4):
+	"""Generator returning fn(i) for each i in items, in order. fn is evaluated by background threads, with at most
+	about 'window' results in memory at once, so i/o and processing can overlap"""
+	items=list(items)
+	jobs=Queue.Queue(0)
+	results=Queue.Queue(0)
+
+	def worker():
+		while True:
+			j=jobs.get()
+			if j==None : return
+			try: results.put((j,fn(items[j]),None))
+			except: results.put((j,None,traceback.format_exc()))
+
+	thrds=[threading.Thread(target=worker) for i in xrange(threads)]
+	for t in thrds: t.start()
+
+	done={}
+	nxt=0
+	try:
+		for i in xrange(len(items)):
+			while nxt<len(items) and nxt<i+window :
+				jobs.put(nxt)
+				nxt+=1
+			while not done.has_key(i) :
+				j,r,err=results.get()
+				if err!=None : raise Exception,"Error processing {}:\n{}".format(items[j],err)
+				done[j]=r
+			yield done.pop(i)
+	finally:
+		for t in thrds: jobs.put(None)
+		for t in thrds: t.join()
+
+class MovieFrames:
+	"""The dark/gain corrected frames of a movie. Frames are kept in memory or, in streaming mode, in an image file which
+	is read sequentially (with read-ahead) whenever the frames are needed."""
+
+	def __init__(self,fsp=None,istmp=True):
+		self.fsp=fsp
+		self.istmp=istmp
+		self.n=0
+		self.nx=self.ny=0
+		self.ims=[]
+		if fsp!=None and os.path.exists(fsp) : os.unlink(fsp)
+
+	def __len__(self): return self.n
+
+	def append(self,im):
+		if self.fsp==None : self.ims.append(im)
+		else : im.write_image(self.fsp,self.n)
+		self.nx,self.ny=im["nx"],im["ny"]
+		self.n+=1
+
+	def frames(self,start=0,stop=None):
+		"""iterates over the frames in order"""
+		if stop==None or stop>self.n : stop=self.n
+		if self.fsp==None : return iter(self.ims[start:stop])
+		return ordered_imap(lambda i:EMData(self.fsp,i),xrange(start,stop),1,4)
+
+	def blocks(self,step):
+		"""iterates over (i0,i1,sum) for each consecutive block of step frames, in a single pass over the frames"""
+		for i,im in enumerate(self.frames()):
+			if i%step==0 : av=im.copy()
+			else : av.add(im)
+			if (i+1)%step==0 or i==self.n-1 : yield i-i%step,i+1,av
+
+	def sum(self):
+		return self.blocks(self.n).next()[2]
+
+	def close(self):
+		"""frees memory and removes the temporary file if any"""
+		self.ims=[]
+		if self.fsp!=None and self.istmp and os.path.exists(self.fsp) : os.unlink(self.fsp)
+
+def correct_frame(fsp,ii,dark,gain,options,iolock):
+	"""Reads frame ii from fsp and applies dark/gain correction and other requested preprocessing"""
+	with iolock:
 		#if fsp[-4:].lower() in (".mrc","mrcs") :
 		if fsp[-4:].lower() in (".mrc") :
 			hdr=EMData(fsp,0,True)			# read header
-			nx,ny=hdr["nx"],hdr["ny"]
-		
-		# bgsub and gain correct the stack
-
-		outim=[]
-		for ii in xrange(first,flast,step):
-			if options.verbose:
+			im=EMData(fsp,0,False,Region(0,0,ii,hdr["nx"],hdr["ny"],1))
+		else: im=EMData(fsp,ii)
+
+	if dark!=None : im.sub(dark)
+	if gain!=None : im.mult(gain)
+	im.process_inplace("threshold.clampminmax",{"minval":0,"maxval":im["mean"]+im["sigma"]*3.5,"tozero":1})
+	if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1})		# fixes clear outliers as well as values which were exactly zero
+
+	#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
+#	im.mult(-1.0)
+	if options.normalize : im.process_inplace("normalize.edgemean")
+
+	return im
+
+def prepare_movie(fsp,dark,gain,first,flast,step,options,threads=1,outq=None):
+	"""bgsub and gain correct the stack, using threads in parallel. Returns a MovieFrames object, or puts it in outq
+	if specified (None on failure)"""
+	try:
+		outname=fsp.rsplit(".",1)[0]+"_proc.hdf"
+
+		if options.streaming :
+			if options.frames : frames=MovieFrames(outname[:-4]+"_corr.hdf",False)
+			else : frames=MovieFrames(outname[:-4]+"_corrtmp.hdf")
+		else : frames=MovieFrames()
+
+		iolock=threading.Lock()
+		idxs=range(first,flast,step)
+		for ii,im in izip(idxs,ordered_imap(lambda i:correct_frame(fsp,i,dark,gain,options,iolock),idxs,threads,threads*2)):
+			if options.verbose and outq==None:
 				print " {}/{}   \r".format(ii-first+1,flast-first+1),
 				sys.stdout.flush()
 
-			#if fsp[-4:].lower() in (".mrc","mrcs") :
-			if fsp[-4:].lower() in (".mrc") :
-				im=EMData(fsp,0,False,Region(0,0,ii,nx,ny,1))
-			else: im=EMData(fsp,ii)
-			
-			if dark!=None : im.sub(dark)
-			if gain!=None : im.mult(gain)
-			im.process_inplace("threshold.clampminmax",{"minval":0,"maxval":im["mean"]+im["sigma"]*3.5,"tozero":1})
-			if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1})		# fixes clear outliers as well as values which were exactly zero
-
-			#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
-#			im.mult(-1.0)
-			if options.normalize : im.process_inplace("normalize.edgemean")
-			
-			if options.frames : im.write_image(outname[:-4]+"_corr.hdf",ii-first)
-			outim.append(im)
+			if options.frames and not options.streaming : im.write_image(outname[:-4]+"_corr.hdf",ii-first)
+			frames.append(im)
 			#im.write_image(outname,ii-first)
+	except:
+		if outq==None : raise
+		traceback.print_exc()
+		frames=None
 
-		nx=outim[0]["nx"]
-		ny=outim[0]["ny"]
+	if outq!=None : outq.put(frames)
+	return frames
+
+def process_movie(fsp,frames,first,flast,options):
+		outname=fsp.rsplit(".",1)[0]+"_proc.hdf"		# always output to an HDF file. Output contents vary with options
+
+		nx=frames.nx
+		ny=frames.ny
 
 		# show a little movie of 5 averaged frames
 
 		if options.movie>0 :
 			mov=[]
-			for i in xrange(options.movie+1,len(outim)):
-				im=sum(outim[i-options.movie-1:i])
+			win=deque()
+			for i,fim in enumerate(frames.frames(0,len(frames)-1)):
+				win.append(fim)
+				if len(win)<=options.movie : continue
+				if len(win)>options.movie+1 : win.popleft()
+				im=win[0].copy()
+				for w in islice(win,1,None): im.add(w)
 				#im.write_image("movie%d.hdf"%(i/5-1),0)
 				#im.process_inplace("filter.lowpass.gauss",{"cutoff_freq":.02})
 				mov.append(im)
@@ -260,11 +382,11 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 		if options.simpleavg :
 			if options.verbose : print "Simple average"
 			avgr=Averagers.get("mean")
-			for i in xrange(len(outim)):						# only use the first second for the unweighted average
+			for i,im in enumerate(frames.frames()):						# only use the first second for the unweighted average
 				if options.verbose:
-					print " {}/{}   \r".format(i+1,len(outim)),
+					print " {}/{}   \r".format(i+1,len(frames)),
 					sys.stdout.flush()
-				avgr.add_image(outim[i])
+				avgr.add_image(im)
 			print ""
 
 			av=avgr.finish()
@@ -283,13 +405,13 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			if options.verbose : print "Weighted average"
 			normim=EMData(nx/2+1,ny)
 			avgr=Averagers.get("weightedfourier",{"normimage":normim})
-			for i in xrange(min(len(outim),25)):						# only use the first second for the unweighted average
+			for i,im in enumerate(frames.frames(0,25)):						# only use the first second for the unweighted average
 				if options.verbose:
-					print " {}/{}   \r".format(i+1,len(outim)),
+					print " {}/{}   \r".format(i+1,len(frames)),
 					sys.stdout.flush()
 				xy.set_y(1,1.0)					# no weighting
-				outim[i]["avg_weight"]=xy
-				avgr.add_image(outim[i])
+				im["avg_weight"]=xy
+				avgr.add_image(im)
 			print ""
 
 			av=avgr.finish()
@@ -299,13 +421,13 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			# linear weighting with shifting 0 cutoff
 
 			xy.set_y(1,0.0)
-			for i in xrange(len(outim)):
+			for i,im in enumerate(frames.frames()):
 				if options.verbose:
-					print " {}/{}   \r".format(i+1,len(outim)),
+					print " {}/{}   \r".format(i+1,len(frames)),
 					sys.stdout.flush()
-				xy.set_x(1,0.025+0.8*(len(outim)-i)/len(outim))
-				outim[i]["avg_weight"]=xy
-				avgr.add_image(outim[i])
+				xy.set_x(1,0.025+0.8*(len(frames)-i)/len(frames))
+				im["avg_weight"]=xy
+				avgr.add_image(im)
 			print ""
 
 			av=avgr.finish()
@@ -315,14 +437,14 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 
 			xy.set_size(64)
 			for j in xrange(64): xy.set_x(j,0.8*j/64.0)
-			for i in xrange(len(outim)):
+			for i,im in enumerate(frames.frames()):
 				if options.verbose:
-					print " {}/{}   \r".format(i+1,len(outim)),
+					print " {}/{}   \r".format(i+1,len(frames)),
 					sys.stdout.flush()
-				for j in xrange(64) : xy.set_y(j,exp(-j/(3.0+48.0*(len(outim)-i)/float(len(outim)))))
+				for j in xrange(64) : xy.set_y(j,exp(-j/(3.0+48.0*(len(frames)-i)/float(len(frames)))))
 #				plot(xy)
-				outim[i]["avg_weight"]=xy
-				avgr.add_image(outim[i])
+				im["avg_weight"]=xy
+				avgr.add_image(im)
 			print ""
 
 			av=avgr.finish()
@@ -361,38 +483,31 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 		# we iterate the alignment process several times
 
 		if options.align_frames :
-			outim2 = []
+			print len(frames)
 			
-			print len(outim)
-			
-			aliavg = sum(outim)				# we start with a simple average of all frames
+			aliavg = frames.sum()				# we start with a simple average of all frames
 			
 			for it in xrange(3) :
-				step = len(outim)		# coarsest search aligns the first 1/2 of the images against the second, step=step/2 each cycle
+				step = len(frames)		# coarsest search aligns the first 1/2 of the images against the second, step=step/2 each cycle
 				xali = XYData()		# this will contain the alignments which are hierarchically estimated and improved
 				yali = XYData()		# x is time in both cases, y is x or y
 
 				while step > 1 :
 					step /= 2
-					i0 = 0
-
-					while i0 < len(outim) :
-						i1 = min(i0+step, len(outim))
-						av0 = sum(outim[i0:i1])
 
+					for i0,i1,av0 in frames.blocks(step) :		# each block sum is computed from the frames as they are read
 						tloc=(i0+i1-1)/2.0		# the "time" of the current average
 						lrange=hypot(xali.get_yatx_smooth(i1,1)-xali.get_yatx_smooth(i0,1),yali.get_yatx_smooth(i1,1)-yali.get_yatx_smooth(i0,1))*1.5
 						if lrange<8 : lrange=8		
 						
 						guess=(xali.get_yatx_smooth(tloc,1),yali.get_yatx_smooth(tloc,1))
 						if xali.get_size()>1 and guess[0]<2 and guess[1]<2 : 
-							i0+=step
 							continue				# if the predicted shift is too small, then we won't get it right anyway, so we just interpolate
 						
 ##						print step,i0,xali.get_yatx_smooth(tloc,1),yali.get_yatx_smooth(tloc,1),lrange,
 	#					dx,dy,Z=align_subpixel(av0,av1,guess=alignments[i1+step/2]-alignments[i0+step/2],localrange=LA.norm(alignments[i1+step-1]-alignments[i0]))
 
-						if step==len(outim)/2 :
+						if step==len(frames)/2 :
 							dx,dy,Z=align(aliavg,av0,guess=(0,0),localrange=192,verbose=options.verbose-1)
 						else:
 							dx,dy,Z=align(aliavg,av0,guess=guess,localrange=lrange,verbose=options.verbose-1)
@@ -400,8 +515,6 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 						
 						xali.insort(tloc,dx)
 						yali.insort(tloc,dy)
-											
-						i0+=step
 					
 					# possible sometimes to have multiple values for the same x (img #), average in these cases
 
@@ -419,28 +532,30 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 ##					print ["%6.2f"%i for i in xali.get_ylist()]
 ##					print ["%6.2f"%i for i in yali.get_ylist()]
 					
-				outim2=[outim[i].get_clip(Region(-xali.get_yatx_smooth(i,1),-yali.get_yatx_smooth(i,1),outim[i]["nx"],outim[i]["ny"])) for i in xrange(len(outim))]
-				
-				aliavg=sum(outim2)
-				aliavg.mult(1.0/len(outim2))
+				# shifted frames are summed as they are produced rather than being stored. On the final iteration they may also be saved
+				aliavg=None
+				for i,im in enumerate(frames.frames()):
+					im2=im.get_clip(Region(-xali.get_yatx_smooth(i,1),-yali.get_yatx_smooth(i,1),im["nx"],im["ny"]))
+					if it==2 and options.save_aligned : im2.write_image(outname[:-4]+"_align.hdf",i,IMAGE_HDF, False, None, EM_USHORT)
+					if aliavg==None : aliavg=im2
+					else : aliavg.add(im2)
+				aliavg.mult(1.0/len(frames))
 			
 				if options.verbose>2 : 
 					out=file("align%d.txt"%it,"w")
 					for i in xrange(xali.get_size()):
 						out.write("%1.2f\t%1.2f\n"%(xali.get_y(i),yali.get_y(i)));
 					out=file("alignsm%d.txt"%it,"w")
-					for i in xrange(len(outim)):
+					for i in xrange(len(frames)):
 						out.write("%1.2f\t%1.2f\n"%(xali.get_yatx_smooth(i,1),yali.get_yatx_smooth(i,1)));
 					xali.write_file("alignx%d.txt"%it)
 					yali.write_file("aligny%d.txt"%it)
 
 			aliavg.write_image(outname[:-4]+"_aliavg.hdf",0)
-			if options.save_aligned:
-				for i,im in enumerate(outim2): im.write_image(outname[:-4]+"_align.hdf",i,IMAGE_HDF, False, None, EM_USHORT)
 				
 			if options.verbose>2 : 
-				t=sum(outim)
-				t.mult(1.0/len(outim2))
+				t=frames.sum()
+				t.mult(1.0/len(frames))
 				t=t.get_clip(Region(500,500,3072,3072))
 				aliavg=aliavg.get_clip(Region(500,500,3072,3072))
 				display([t,aliavg],True)
@@ -43,13 +43,19 @@ import sys
 import math
 import random
 import traceback
+import threading
+import Queue
+import tempfile
+import time
 import numpy as np
 
 def get_usage():
 	progname = os.path.basename(sys.argv[0])
 	usage = progname + """ [options]
 	Reconstructs 3D volumes using a set of 2D images. Euler angles are extracted from the 2D image headers and symmetry is imposed.
-	This is an optimized version with fewer options than e2make3d, but can run in parallel using threads, and has a number of other changes.
+	This is an optimized version with fewer options than e2make3d, but can run in parallel using threads or the EMAN2PAR
+	parallelism system (--parallel), and has a number of other changes. Each thread or task inserts its slices into a private
+	Fourier volume, and the partial volumes are summed before normalization, so memory use grows with the number of workers.
 
 	A simple example of usage is:
 
@@ -103,7 +109,8 @@ def main():
 
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 
-	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel on a single computer. This is the only parallelism supported by e2make3dpar", guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="refinement")
+	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel on a single computer. Each thread has its own copy of the padded Fourier volume.", guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="refinement")
+	parser.add_argument("--parallel","-P",type=str,help="Distribute slice insertion with the EMAN2PAR parallelism system, specify type:n=<proc>:option:option. Overrides --threads.",default=None)
 	parser.add_argument("--preprocess", metavar="processor_name(param1=value1:param2=value2)", type=str, action="append", help="preprocessor to be applied to the projections prior to 3D insertion. There can be more than one preprocessor and they are applied in the order in which they are specifed. Applied before padding occurs. See e2help.py processors for a complete list of available processors.")
 	parser.add_argument("--setsf",type=str,help="Force the structure factor to match a 'known' curve prior to postprocessing (<filename>, auto or none). default=none",default="none")
 	parser.add_argument("--postprocess", metavar="processor_name(param1=value1:param2=value2)", type=str, action="append", help="postprocessor to be applied to the 3D volume once the reconstruction is completed. There can be more than one postprocessor, and they are applied in the order in which they are specified. See e2help.py processors for a complete list of available processors.")
@@ -208,32 +215,39 @@ def main():
 
 	if options.verbose: print "After filter, %d images"%len(data)
 
-	# Get the reconstructor and initialize it correctly
+	# Parameters for the reconstructors, each worker has its own
 	a = {"size":padvol,"sym":options.sym,"mode":options.mode,"verbose":options.verbose-1}
-	if options.savenorm!=None : a["savenorm"]=options.savenorm
-	recon=Reconstructors.get("fourier", a)
 
 	#########################################################
 	# The actual reconstruction
 
-	threads=[threading.Thread(target=reconstruct,args=(data[i::options.threads],recon,options.preprocess,options.pad,
-			options.fillangle,options.verbose-1)) for i in xrange(options.threads)]
-
 	if options.seedmap!=None :
-		seed==EMData(options.seedmap)
+		seed=EMData(options.seedmap)
 		seed.process_inplace("normalize.edgemean")
-		seed.clip_inplace(Region((ny-padvol)/2,(ny-padvol)/2,(ny-padvol)/2,padvol,padvol,padvol))
+		seed.clip_inplace(Region((seed["nx"]-padvol[0])/2,(seed["ny"]-padvol[1])/2,(seed["nz"]-padvol[2])/2,padvol[0],padvol[1],padvol[2]))
 		seed.fft_inplace()
-		recon.setup_seed(seed,options.seedweight)
-	else : recon.setup()
-	
-	for i,t in enumerate(threads):
-		if options.verbose>1: print "started thread ",i
-		t.start()
+		acc=partial_recon([],a,options.preprocess,options.pad,0,seed,options.seedweight)
+	else : acc=None
+
+	if options.parallel!=None :
+		if max([i["fileslice"] for i in data])>=0 :
+			print "Error: --parallel cannot be used with volumetric tilt series, please use --threads"
+			sys.exit(1)
+		acc=reconstruct_parallel(data,a,options,acc)
+	else :
+		# each thread inserts into its own volume, and we sum them as they finish
+		jsd=Queue.Queue(0)
+		threads=[threading.Thread(target=partial_recon,args=(data[i::options.threads],a,options.preprocess,options.pad,
+				options.fillangle,None,1.0,options.verbose-1,jsd)) for i in xrange(options.threads)]
+
+		for i,t in enumerate(threads):
+			if options.verbose>1: print "started thread ",i
+			t.start()
 
-	for t in threads: t.join()
+		for i in xrange(len(threads)): acc=add_partial(acc,jsd.get())
+		for t in threads: t.join()
 
-	output = recon.finish(True)
+	output = finish_partials(acc,options.savenorm)
 
 	if options.verbose>0 : print "Finished Reconstruction"
 
@@ -367,29 +381,26 @@ def initialize_data(inputfile,inputmodel,tltfile,pad,no_weights,preprocess):
 			print "Error : %d images and only %d lines in .tlt file"%(n_input,len(data))
 			exit(1)
 	else :
-		tmp=EMData()
+		# these rely only on the header, so we use the header index rather than reading each image
+		hdrs=get_headers(inputfile,["xform.projection","model_id","ptcl_repr","class_qual"])
 		for i in xrange(n_input):
-			tmp.read_image(inputfile,i,True)
-			#else : tmp=get_processed_image(inputfile,i,-1,preprocess,pad)
-
-			# these rely only on the header
-			try: elem={"xform":tmp["xform.projection"]}
-			except : continue
+			if hdrs["xform.projection"][i] is None : continue
+			elem={"xform":hdrs["xform.projection"][i]}
 				#raise Exception,"Image %d doesn't have orientation information in its header"%i
 
 			# skip any particles targeted at a different model
-			if inputmodel != None and tmp["model_id"]!=inputmodel : continue
+			if inputmodel != None and hdrs["model_id"][i]!=inputmodel : continue
 
 			if no_weights: elem["weight"]=1.0
 			else :
-				try: elem["weight"]=float(tmp["ptcl_repr"])
+				try: elem["weight"]=float(hdrs["ptcl_repr"][i])
 				except: elem["weight"]=1.0
 				# This is bad if you have actual empty classes...
 				#if elem["weight"]<=0 :
 					#print "Warning, weight %1.2f on particle %d. Setting to 1.0"%(elem["weight"],i)
 					#elem["weight"]=1.0
 
-			try: elem["quality"]=float(tmp["class_qual"])
+			try: elem["quality"]=float(hdrs["class_qual"][i])
 			except:
 				try: elem["quality"]=1.0/(elem["weight"]+.00001)
 				except: elem["quality"]=1.0
@@ -495,5 +506,131 @@ def reconstruct(data,recon,preprocess,pad,fillangle,verbose=0):
 
 	return
 
+def partial_recon(data,a,preprocess,pad,fillangle,seed=None,seedweight=1.0,verbose=0,jsd=None):
+	"""Inserts the slices in data into a private Fourier reconstructor with parameters a. Returns (or puts in the queue jsd)
+	a (vol,norm) pair, where vol is the unnormalized complex volume and norm the normalization volume. Pairs from
+	independent workers are combined with add_partial() and finish_partials()."""
+
+	# finish() divides by the normalization volume and saves it. Undoing the division below is only exact for a whole
+	# volume normalized by the plain weights (no sqrt damping)
+	a=dict(a)
+	if a.get("sqrtnorm",False) or a.get("subvolume",None)!=None : raise Exception,"partial_recon() requires a whole volume without sqrtnorm"
+
+	fd,a["savenorm"]=tempfile.mkstemp(suffix=".hdf")
+	os.close(fd)
+	try:
+		os.unlink(a["savenorm"])
+
+		recon=Reconstructors.get("fourier",a)
+		if seed!=None : recon.setup_seed(seed,seedweight)
+		else : recon.setup()
+
+		reconstruct(data,recon,preprocess,pad,fillangle,verbose)
+
+		# We read the (origin shifted) normalization back and undo the division, since only the raw sums can be
+		# added across workers.
+		vol=recon.finish(False)
+		norm=EMData(a["savenorm"],0)
+	finally:
+		try: os.unlink(a["savenorm"])
+		except: pass
+	if norm["ny"]%2==0 and norm["nz"]%2==0 : norm.process_inplace("xform.fourierorigin.tocenter")	# this shift is its own inverse
+
+	v=EMNumPy.em2numpy(vol)
+	v=v.reshape(v.shape[:-1]+(v.shape[-1]/2,2))
+	v*=EMNumPy.em2numpy(norm)[...,np.newaxis]
+	vol.update()
+
+	if jsd!=None : jsd.put((vol,norm))
+	else : return (vol,norm)
+
+def add_partial(acc,part):
+	"""Adds a (vol,norm) pair from partial_recon() to the accumulated pair acc, which may be None. Returns the new acc."""
+
+	if acc==None : return part
+
+	for a,p in zip(acc,part):
+		an=EMNumPy.em2numpy(a)
+		an+=EMNumPy.em2numpy(p)
+		a.update()
+
+	return acc
+
+def finish_partials(acc,savenorm=None):
+	"""Normalizes the summed (vol,norm) pair and returns the real-space volume, as Reconstructor.finish(True) would"""
+
+	vol,norm=acc
+	v=EMNumPy.em2numpy(vol)
+	v=v.reshape(v.shape[:-1]+(v.shape[-1]/2,2))
+	n=EMNumPy.em2numpy(norm)
+	nz=n!=0
+	v[nz]/=n[nz][:,np.newaxis]
+	v[~nz]=0
+	vol.update()
+
+	if savenorm!=None :
+		if norm["ny"]%2==0 and norm["nz"]%2==0 : norm.process_inplace("xform.fourierorigin.tocenter")
+		norm.write_image(savenorm,0)
+
+	vol.do_ift_inplace()
+	vol.depad()
+	vol.process_inplace("xform.phaseorigin.tocenter")
+
+	return vol
+
+def reconstruct_parallel(data,a,options,acc=None):
+	"""Distributes slice insertion over the EMAN2PAR parallelism system, one task per CPU, and sums the partial
+	volumes into acc as the tasks finish. Returns the summed (vol,norm) pair."""
+
+	from EMAN2PAR import EMTaskCustomer
+	etc=EMTaskCustomer(options.parallel)
+
+	# every task returns a full volume, so we use as few tasks as will keep the CPUs busy
+	ntask=max(1,min(etc.cpu_est(),len(data)))
+	tasks=[Make3dParTask(data[0]["filename"],data[i::ntask],a,options) for i in xrange(ntask)]
+	tids=etc.send_tasks(tasks)
+	if options.verbose : print "{} tasks queued".format(len(tids))
+
+	nrecv=0
+	while len(tids)>0:
+		time.sleep(2)
+		proglist=etc.check_task(tids)
+		for i,prog in enumerate(proglist):
+			if prog==100 :
+				r=etc.get_results(tids[i])[1]
+				acc=add_partial(acc,(r["vol"],r["norm"]))
+				nrecv+=1
+
+		tids=[j for i,j in enumerate(tids) if proglist[i]!=100]
+		if options.verbose : print "{}/{} tasks complete".format(nrecv,ntask)
+
+	return acc
+
+from EMAN2jsondb import JSTask,jsonclasses
+
+class Make3dParTask(JSTask):
+	"""Inserts a subset of the slices into a private reconstructor for the parallelism system, returning the partial volumes"""
+
+	def __init__(self,fsp=None,data=None,a=None,options=None):
+		if fsp==None : dt=None
+		else :
+			elems=[{"xform":e["xform"],"weight":e["weight"],"filenum":e["filenum"]} for e in data]
+			dt={"images":["cache",fsp,[e["filenum"] for e in data]],"elems":elems}
+		if options==None : opts=None
+		else : opts={"recon":a,"preprocess":options.preprocess,"pad":options.pad,"fillangle":options.fillangle,"verbose":options.verbose-1}
+		JSTask.__init__(self,"Make3dPar",dt,opts)
+
+	def execute(self,callback=None):
+		fsp=self.data["images"][1]
+		data=[dict(e,filename=fsp,fileslice=-1) for e in self.data["elems"]]
+		o=self.options
+
+		vol,norm=partial_recon(data,o["recon"],o["preprocess"],tuple(o["pad"]),o["fillangle"],verbose=o["verbose"])
+		if callback!=None : callback(100)
+
+		return {"vol":vol,"norm":norm}
+
+jsonclasses["Make3dParTask"]=Make3dParTask.from_jsondict
+
 if __name__=="__main__":
 	main()
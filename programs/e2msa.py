@@ -39,6 +39,10 @@ from math import *
 import time
 import os
 import sys
+import threading
+import Queue
+import traceback
+import numpy as np
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -71,6 +75,10 @@ handled this way."""
 	parser.add_argument("--simmx",type=str,help="Will use transformations from simmx on each particle prior to analysis")
 	parser.add_argument("--normalize",action="store_true",help="Perform a careful normalization of input images before MSA. Otherwise normalization is not modified until after mean subtraction.",default=False)
 	parser.add_argument("--gsl",action="store_true",help="Use gsl SVD algorithm",default=False)
+	parser.add_argument("--rsvd",action="store_true",help="Use a randomized SVD which streams through the images in chunks, so memory use does not depend on the number of images",default=False)
+	parser.add_argument("--chunk",type=int,help="Number of images processed together with --rsvd. Default=1000",default=1000)
+	parser.add_argument("--rsvditer",type=int,help="Number of power iterations with --rsvd. Each iteration reads the images once more. Default=2",default=2)
+	parser.add_argument("--threads",type=int,help="Number of chunks read and processed in parallel with --rsvd. Default=1",default=1)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 
@@ -104,7 +112,11 @@ handled this way."""
 			mask=EMData(args[0],0)
 			mask.to_one()
 	
-	if options.simmx : out=msa_simmx(args[0],options.simmx,mask,options.nbasis,options.varimax,mode,options.normalize)
+	if options.rsvd :
+		simmx=None
+		if options.simmx : simmx=[EMData(options.simmx,i) for i in range(5)]
+		out=msa_rsvd(args[0],mask,options.nbasis,options.varimax,options.normalize,simmx,options.chunk,options.rsvditer,options.threads,options.verbose)
+	elif options.simmx : out=msa_simmx(args[0],options.simmx,mask,options.nbasis,options.varimax,mode,options.normalize)
 	else : out=msa(args[0],mask,options.nbasis,options.varimax,mode,options.normalize)
 	
 	if options.verbose>0 : print "MSA complete"
@@ -263,6 +275,136 @@ pca,pca_large or svd_gsl"""
 	results.insert(0,mean)
 	return results 
 
+def msa_rsvd(images,mask,nbasis,varimax,normalize=True,simmx=None,chunk=1000,niter=2,threads=1,verbose=0):
+	"""Perform principal component analysis as msa() does, using a randomized SVD rather than an Analyzer. The images are
+streamed in chunks of 'chunk' images, and the masked pixels of each chunk are packed into a matrix, so memory use does not
+depend on the number of images. The basis is found from a random subspace slightly larger than nbasis, refined by 'niter'
+power iterations, so the images are read niter+2 times. 'images' is either a list of EMData or a filename, and is not modified.
+If 'simmx' is a list of the 5 images from a simmx file, each image is transformed as in msa_simmx. 'threads' chunks are read
+and processed in parallel. As with pca_large, 'eigval' is an Eigenvalue of the (unscaled) covariance matrix."""
+
+	if isinstance(images,str) : n=EMUtil.get_image_count(images)
+	else : n=len(images)
+
+	maskpix=EMNumPy.em2numpy(mask)>0.5
+	npix=int(maskpix.sum())
+	iolock=threading.Lock()			# image IO is serialized, processing is not
+
+	def getimage(i):
+		if isinstance(images,str) :
+			with iolock: im=EMData(images,i)
+		else : im=images[i].copy()
+		if simmx!=None : im.transform(get_xform(i,simmx))
+		return im
+
+	def chunksum(c):
+		ret=None
+		for i in xrange(c[0],c[1]):
+			im=getimage(i)
+			if normalize : im.process_inplace("normalize.unitlen")
+			if ret is None : ret=EMNumPy.em2numpy(im).astype(np.float64)
+			else : ret+=EMNumPy.em2numpy(im)
+		return ret
+
+	def chunkmatrix(c):
+		ret=np.empty((c[1]-c[0],npix),dtype=np.float32)
+		for j,i in enumerate(xrange(c[0],c[1])):
+			im=getimage(i)
+			if normalize: im.process_inplace("normalize.toimage",{"to":mean})
+			im-=mean
+			im*=mask
+			im.process_inplace("normalize.unitlen")
+			ret[j]=EMNumPy.em2numpy(im)[maskpix]
+		return ret
+
+	def chunkproduct(c,q):
+		a=chunkmatrix(c)
+		return np.dot(a.T,np.dot(a,q)).astype(np.float64)
+
+	mean=getimage(0)
+	mean.to_zero()
+	msum=EMNumPy.em2numpy(mean)
+	for r in msa_chunks(n,chunk,threads,chunksum): msum+=r
+	msum/=float(n)
+	mean.update()
+	
+	eigval,eigvec=rsvd_eig(n,npix,min(nbasis,n,npix),chunkproduct,niter,chunk,threads,verbose)
+
+	results=[]
+	for j in xrange(len(eigval)):
+		a=np.zeros(maskpix.shape,dtype=np.float32)
+		a[maskpix]=eigvec[:,j]
+		im=EMNumPy.numpy2em(a)
+		im["eigval"]=float(eigval[j])
+		results.append(im)
+	
+	if varimax:
+		pca=Analyzers.get("varimax",{"mask":mask})
+		
+		for im in results:
+			pca.insert_image(im)
+		
+		results=pca.analyze()
+		for im in results: im.mult(mask)
+
+	for im in results:
+		if im["mean"]<0 : im.mult(-1.0)
+
+	mean["eigval"]=0
+	mean*=mask
+	mean.process_inplace("normalize.unitlen")
+	results.insert(0,mean)
+	return results 
+
+def rsvd_eig(n,npix,nvec,chunkproduct,niter=2,chunk=1000,threads=1,verbose=0):
+	"""Returns the nvec largest eigenvalues and the corresponding eigenvectors (columns) of A^T A, where A is an n x npix
+matrix which is only accessed through chunkproduct((first,last+1),q) = A[first:last+1]^T A[first:last+1] q. The subspace
+is seeded with nvec+10 random vectors and refined by 'niter' power iterations."""
+
+	# Each pass computes A^T A Q one chunk of rows of A at a time
+	nsub=min(nvec+10,n,npix)
+	q=np.linalg.qr(np.random.RandomState(1).standard_normal((npix,nsub)))[0].astype(np.float32)
+	for it in xrange(niter+1):
+		if verbose>0 : print "Randomized SVD pass %d/%d"%(it+1,niter+1)
+		z=np.zeros((npix,nsub))
+		for r in msa_chunks(n,chunk,threads,lambda c:chunkproduct(c,q)): z+=r
+		if it<niter : q=np.linalg.qr(z)[0].astype(np.float32)
+
+	# Rayleigh-Ritz on the final subspace
+	eigval,eigvec=np.linalg.eigh(np.dot(q.T,z))
+	order=eigval.argsort()[::-1][:nvec]
+	return eigval[order],np.dot(q,eigvec[:,order])
+
+def msa_chunks(n,chunk,threads,func):
+	"""Calls func((first,last+1)) for each chunk of n images in 'threads' parallel threads, and yields the results in
+the order they complete. At most 'threads' results are held at once."""
+	chunks=[(i,min(i+chunk,n)) for i in xrange(0,n,chunk)]
+	jobs=Queue.Queue(0)
+	for c in chunks: jobs.put(c)
+	results=Queue.Queue(threads)
+	thrds=[threading.Thread(target=msa_worker,args=(jobs,results,func)) for i in xrange(threads)]
+	for t in thrds:
+		t.daemon=True
+		jobs.put(None)
+		t.start()
+	
+	for c in chunks:
+		r=results.get()
+		if r is None : raise Exception,"Error processing images"
+		yield r
+
+	for t in thrds: t.join()
+
+def msa_worker(jobs,results,func):
+	"""Thread processing chunks from jobs until it receives None"""
+	while True:
+		c=jobs.get()
+		if c==None : return
+		try: results.put(func(c))
+		except:
+			traceback.print_exc()
+			results.put(None)
+
 if __name__== "__main__":
 	main()
 	
@@ -51,7 +51,7 @@ logid=None
 def main():
 	global debug,logid
 	progname = os.path.basename(sys.argv[0])
-	commandlist=("dcserver","dcclient","realdcclient","dckill","dckillclients","servmon","rerunall","killall","precache","localclient","mpiclient")
+	commandlist=("dcserver","dcclient","realdcclient","dckill","dckillclients","servmon","rerunall","killall","precache","localclient","localworker","mpiclient")
 	usage = """prog [options] <command> ...
 	
 This program implements much of EMAN2's coarse-grained parallelism mechanism. There are several flavors available via
@@ -119,6 +119,9 @@ run e2parallel.py dcclient on as many other machines as possible, pointing at th
 	elif args[0]=="localclient" :
 		runlocaltask(options.taskin,options.taskout)
 
+	elif args[0]=="localworker" :
+		runlocalworker(options.port)
+
 	elif args[0]=="mpiclient" :
 		runinmpi(options.scratchdir,options.verbose)
 		
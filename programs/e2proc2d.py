@@ -42,6 +42,7 @@ import os
 import datetime
 import time
 import traceback
+from EMAN2jsondb import JSTask,jsonclasses
 
 # constants
 
@@ -53,6 +54,12 @@ xzplanes = ['xz', 'zx']
 yzplanes = ['yz', 'yz']
 threedplanes = xyplanes + xzplanes + yzplanes
 
+# options which may be given more than once, applied in the order specified
+append_options = ["anisotropic","clip", "process", "meanshrink", "medianshrink", "fouriershrink", "scale", "randomize", "rotate", "translate", "multfile","addfile","add", "headertransform"]
+
+# options which act on each image independently, handled by process_image_option() and usable with --parallel
+image_options = ["apix", "process", "addfile", "add", "mult", "multfile", "calccont", "rfp", "fp", "anisotropic", "scale", "rotate", "translate", "clip", "randomize", "medianshrink", "meanshrink", "fouriershrink", "headertransform", "radon"]
+
 def changed_file_name (input_name, output_pattern, input_number, multiple_inputs) :
 	# convert an input file name to an output file name
 	# by replacing every @ or * in output_pattern with
@@ -233,8 +240,6 @@ def main():
 
 	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:n=<proc>:option:option",default=None)
 
-	append_options = ["anisotropic","clip", "process", "meanshrink", "medianshrink", "fouriershrink", "scale", "randomize", "rotate", "translate", "multfile","addfile","add", "headertransform"]
-
 	optionlist = pyemtbx.options.get_optionlist(sys.argv[1:])
 
 	(options, args) = parser.parse_args()
@@ -387,11 +392,6 @@ def main():
 #		print "copy file '" + infile + "' to file '" + outfile + "'."
 #		continue
 
-		if options.parallel :
-			r = doparallel(sys.argv,options.parallel,args)
-			E2end(logid)
-			sys.exit(r)
-
 		if options.average:
 			averager = parsemodopt(options.averager)
 			average = Averagers.get(averager[0], averager[1])
@@ -520,7 +520,13 @@ def main():
 		if options.verbose > 1 :
 			print "input file, output file, is three-d =", infile, outfile, isthreed
 
-		for i in range(n0, n1+1, options.step[1]):
+		if options.parallel :
+			indices = [i for i in range(n0, n1+1, options.step[1]) if i < len(imagelist) and imagelist[i]]
+			doparallel(infile, outfile, indices, isthreed, n0, options, optionlist)
+			imgrange = []
+		else : imgrange = range(n0, n1+1, options.step[1])
+
+		for i in imgrange:
 			if options.verbose >= 1:
 				if time.time()-lasttime > 3 or options.verbose > 2 :
 					sys.stdout.write(" %7d\r" %i)
@@ -561,16 +567,7 @@ def main():
 					if len(vals) >= 4 : func = vals[-1]
 
 					try :
-						x  = 0.0
-						y  = 0.0
-						z  = 0.0
-						xn = 0.0
-						yn = 0.0
-						zn = 0.0
-						nx = 1
-						ny = 1
-						nz = 1
-						w = eval(func)
+						eval(func,globals(),{"x":0.0,"y":0.0,"z":0.0,"xn":0.0,"yn":0.0,"zn":0.0,"nx":1,"ny":1,"nz":1})
 					except :
 						print "Error: Syntax error in image expression '" + func + "'"
 						sys.exit(1)
@@ -615,40 +612,8 @@ def main():
 				nx = d.get_xsize()
 				ny = d.get_ysize()
 
-				if option1 == "apix":
-					apix = options.apix
-					d.set_attr('apix_x', apix)
-					d.set_attr('apix_y', apix)
-					d.set_attr('apix_z', apix)
-
-					try:
-						if i == n0 and d["ctf"].apix != apix :
-							if options.verbose > 0:
-								print "Warning: A/pix value in CTF was %1.2f, changing to %1.2f. May impact CTF parameters."%(d["ctf"].apix,apix)
-
-						d["ctf"].apix = apix
-					except: pass
-
-				if option1 == "process":
-					fi = index_d[option1]
-					(processorname, param_dict) = parsemodopt(options.process[fi])
-
-					if not param_dict : param_dict = {}
-
-					# Parse the options to convert the image file name to EMData object
-					# (for both plain image file and bdb file)
-
-					for key in param_dict.keys():
-						#print str(param_dict[key])
-
-						if str(param_dict[key]).find('bdb:') != -1 or not str(param_dict[key]).isdigit():
-							try:
-								param_dict[key] = EMData(param_dict[key])			
-							except:
-								pass
-
-					d.process_inplace(processorname, param_dict)
-					index_d[option1] += 1
+				if option1 in image_options :
+					d = process_image_option(d,option1,index_d,options,i,n0)
 
                                 elif option1 == "extractboxes":
                                     try:
@@ -660,44 +625,6 @@ def main():
                                     except:
                                         boxesbad+=1
 
-				elif option1 == "addfile":
-					af=EMData(options.addfile[index_d[option1]],0)
-					d.add(af)
-					af=None
-					index_d[option1] += 1
-				elif option1 == "add":
-					d.add(options.add[index_d[option1]])
-					af=None
-					index_d[option1] += 1
-				elif option1 == "mult" :
-					d.mult(options.mult)
-				elif option1 == "multfile":
-					mf = EMData(options.multfile[index_d[option1]],0)
-					d.mult(mf)
-					mf = None
-					index_d[option1] += 1
-
-				elif option1 == "calccont":
-					dd = d.process("math.rotationalsubtract")
-					f = dd.do_fft()
-					#f = d.do_fft()
-
-					if d["apix_x"] <= 0 : raise Exception,"Error: 'calccont' requires an A/pix value, which is missing in the input images"
-
-					lopix = int(d["nx"]*d["apix_x"]/150.0)
-					hipix = int(d["nx"]*d["apix_x"]/25.0)
-					if hipix>d["ny"]/2-6 : hipix=d["ny"]/2-6	# if A/pix is very large, this makes sure we get at least some info
-
-					if lopix == hipix : lopix,hipix = 3,d["nx"]/5	# in case the A/pix value is drastically out of range
-
-					r = f.calc_radial_dist(d["ny"]/2,0,1.0,1)
-					lo = sum(r[lopix:hipix])/(hipix-lopix)
-					hi = sum(r[hipix+1:-1])/(len(r)-hipix-2)
-
-#					print lopix, hipix, lo, hi
-					d["eval_contrast_lowres"] = lo/hi
-	#				print lopix,hipix,lo,hi,lo/hi
-
 				elif option1 == "norefs" and d["ptcl_repr"] <= 0:
 					continue
 
@@ -722,124 +649,6 @@ def main():
 							d = dataf.do_ift();
 	#						dataf.gimme_fft();
 
-				elif option1 == "rfp":
-					d = d.make_rotational_footprint()
-
-				elif option1 == "fp":
-					d = d.make_footprint(options.fp)
-
-				elif option1 == "anisotropic":
-					try: 
-						amount,angle = (options.anisotropic[index_d[option1]]).split(",")
-						amount=float(amount)
-						angle=float(angle)
-					except:
-						traceback.print_exc()
-						print options.anisotropic[index_d[option1]]
-						print "Error: --anisotropic specify amount,angle"
-						sys.exit(1)
-						
-					rt=Transform({"type":"2d","alpha":angle})
-					xf=rt*Transform([amount,0,0,0,0,1/amount,0,0,0,0,1,0])*rt.inverse()
-					d.transform(xf)
-
-					index_d[option1] += 1
-
-
-				elif option1 == "scale":
-					scale_f = options.scale[index_d[option1]]
-
-					if scale_f != 1.0:
-						d.scale(scale_f)
-
-					index_d[option1] += 1
-
-				elif option1 == "rotate":
-					rotatef = options.rotate[index_d[option1]]
-
-					if rotatef != 0.0 : d.rotate(rotatef,0,0)
-
-					index_d[option1] += 1
-
-				elif option1 == "translate":
-					tdx,tdy = options.translate[index_d[option1]].split(",")
-					tdx,tdy = float(tdx),float(tdy)
-
-					if tdx != 0.0 or tdy != 0.0 :
-						d.translate(tdx,tdy,0.0)
-
-					index_d[option1] += 1
-
-				elif option1 == "clip":
-					ci = index_d[option1]
-					clipcx = nx/2
-					clipcy = ny/2
-
-					try: clipx,clipy,clipcx,clipcy = options.clip[ci].split(",")
-					except: clipx, clipy = options.clip[ci].split(",")
-
-					clipx, clipy = int(clipx),int(clipy)
-					clipcx, clipcy = int(clipcx),int(clipcy)
-
-					e = d.get_clip(Region(clipcx-clipx/2, clipcy-clipy/2, clipx, clipy))
-
-					try: e.set_attr("avgnimg", d.get_attr("avgnimg"))
-					except: pass
-
-					d = e
-					index_d[option1] += 1
-
-				elif option1 == "randomize" :
-					ci = index_d[option1]
-					rnd = options.randomize[ci].split(",")
-					rnd[0] = float(rnd[0])
-					rnd[1] = float(rnd[1])
-					rnd[2] = int(rnd[2])
-
-					t = Transform()
-					t.set_params({"type":"2d", "alpha":random.uniform(-rnd[0],rnd[0]), \
-									"mirror":random.randint(0,rnd[2]), "tx":random.uniform(-rnd[1],rnd[1]), \
-									"ty":random.uniform(-rnd[1],rnd[1])})
-					d.transform(t)
-
-				elif option1 == "medianshrink":
-					shrink_f = options.medianshrink[index_d[option1]]
-
-					if shrink_f > 1:
-						d.process_inplace("math.medianshrink",{"n":shrink_f})
-
-					index_d[option1] += 1
-
-				elif option1 == "meanshrink":
-					mshrink = options.meanshrink[index_d[option1]]
-
-					if mshrink > 1:
-						d.process_inplace("math.meanshrink",{"n":mshrink})
-
-					index_d[option1] += 1
-
-				elif option1 == "fouriershrink":
-					fshrink = options.fouriershrink[index_d[option1]]
-
-					if fshrink > 1:
-						d.process_inplace("math.fft.resample",{"n":fshrink})
-
-					index_d[option1] += 1
-					
-				elif option1 == "headertransform":
-					xfmode = options.headertransform[index_d[option1]]
-					
-					if xfmode not in (0,1) :
-						print "Error: headertransform must be set to 0 or 1"
-						sys.exit(1)
-					
-					try: xform=d["xform.align2d"]
-					except: print "Error: particle has no xform.align2d header value"
-
-					if xfmode == 1 : xform.invert()
-					
-					d.process_inplace("xform",{"transform":xform})
-
 				elif option1 == "selfcl":
 					scl = options.selfcl[0] / 2
 					sclmd = options.selfcl[1]
@@ -862,10 +671,6 @@ def main():
 
 							sys.exit(1)
 
-				elif option1 == "radon":
-					r = d.do_radon()
-					d = r
-
 				elif option1 == "average":
 					average.add_image(d)
 
@@ -934,65 +739,7 @@ def main():
 							#outfile = outfile + "%04d" % i + ".lst"
 							#options.outtype = "lst"
 
-					dont_scale = (options.fixintscaling == "noscale")
-
-					if options.fixintscaling != None and not dont_scale :
-						if options.fixintscaling == "sane" :
-							sca = 2.5
-						else :
-							try :
-								sca = float(options.fixintscaling)
-							except :
-								sca = 2.5
-
-								print "Warning: bad fixintscaling value - 2.5 used"
-
-						d["render_min"] = d["mean"] - d["sigma"]*sca
-						d["render_max"] = d["mean"] + d["sigma"]*sca
-
-						min_max_set = True
-					else :
-						min_max_set = False
-
-					#print_iminfo(data, "Final")
-
-					if options.outmode != "float" or dont_scale :
-	#					if outfile[-4:] != ".hdf" :
-	#						print "WARNING: outmode is not working correctly for non HDF images in"
-	#						print "2.1beta3. We expect to have this fixed in the next few days."
-
-						if options.outnorescale or dont_scale :
-							# This sets the minimum and maximum values to the range
-							# for the specified type, which should result in no rescaling
-
-#							outmode = file_mode_map[options.outmode]
-
-#							d["render_min"] = file_mode_range[outmode][0]
-#							d["render_max"] = file_mode_range[outmode][1]
-
-							if   options.outmode == "int8" :
-								u =   -128.0
-								v =    127.0
-							elif options.outmode == "uint8" :
-								u =      0.0
-								v =    255.0
-							elif options.outmode == "int16" :
-								u = -32768.0
-								v =  32767.0
-							elif options.outmode == "uint16" :
-								u =      0.0
-								v =  65535.0
-							else :
-								u =      1.0
-								v =      0.0
-
-							if u < v :
-								d["render_min"] = u
-								d["render_max"] = v
-						else :
-							if not min_max_set :
-								d["render_min"] = d["minimum"]
-				  				d["render_max"] = d["maximum"]
+					set_render_range(d,options)
 
 					if not options.average:	# skip writing the input image to output file
 						# write processed image to file
@@ -1087,28 +834,7 @@ def main():
 							#print "I will unstack to HDF" # JESUS
 
 						else:   # output a single 2D image or a 2D stack			
-							# optionally replace the output image with its rotational average
-
-							if options.rotavg:
-								rd = d.calc_radial_dist(d["nx"],0,0.5,0)
-								d = EMData(len(rd),1,1)
-
-								for x in xrange(len(rd)): d[x] = rd[x]
-
-							if d["sigma"]==0:
-								if options.verbose > 0:
-									print "Warning: sigma = 0 for image ",i
-
-								if options.writejunk == False:
-									if options.verbose > 0:
-										print "Use the writejunk option to force writing this image to disk"
-									continue
-
-							if outfile!=None :
-								if options.inplace:
-									d.write_image(outfile, i, out_type, False, None, out_mode, not_swap)
-								else: # append the image
-									d.write_image(outfile, -1, out_type, False, None, out_mode, not_swap)
+							write_2d_image(d,i,outfile,out_type,out_mode,not_swap,options)
 
 		# end of image loop
 
@@ -1128,7 +854,7 @@ def main():
 			curve = fftavg.calc_radial_dist(ny, 0, 0.5,1)
 			outfile2 = options.fftavg+".txt"
 
-			sf_dx = 1.0 / (apix * 2.0 * ny)
+			sf_dx = 1.0 / (options.apix * 2.0 * ny)
 			Util.save_data(0, sf_dx, curve, outfile2)
 
 		try:
@@ -1151,8 +877,411 @@ def main():
 
 	E2end(logid)
 
-def doparallel(argv,parallel,args):
-	pass
+def set_render_range(d,options):
+	"""Sets render_min/render_max in the header of d as required by --outmode, --fixintscaling and --outnorescale"""
+	dont_scale = (options.fixintscaling == "noscale")
+
+	if options.fixintscaling != None and not dont_scale :
+		if options.fixintscaling == "sane" :
+			sca = 2.5
+		else :
+			try :
+				sca = float(options.fixintscaling)
+			except :
+				sca = 2.5
+
+				print "Warning: bad fixintscaling value - 2.5 used"
+
+		d["render_min"] = d["mean"] - d["sigma"]*sca
+		d["render_max"] = d["mean"] + d["sigma"]*sca
+
+		min_max_set = True
+	else :
+		min_max_set = False
+
+	#print_iminfo(data, "Final")
+
+	if options.outmode != "float" or dont_scale :
+#					if outfile[-4:] != ".hdf" :
+#						print "WARNING: outmode is not working correctly for non HDF images in"
+#						print "2.1beta3. We expect to have this fixed in the next few days."
+
+		if options.outnorescale or dont_scale :
+			# This sets the minimum and maximum values to the range
+			# for the specified type, which should result in no rescaling
+
+#							outmode = file_mode_map[options.outmode]
+
+#							d["render_min"] = file_mode_range[outmode][0]
+#							d["render_max"] = file_mode_range[outmode][1]
+
+			if   options.outmode == "int8" :
+				u =   -128.0
+				v =    127.0
+			elif options.outmode == "uint8" :
+				u =      0.0
+				v =    255.0
+			elif options.outmode == "int16" :
+				u = -32768.0
+				v =  32767.0
+			elif options.outmode == "uint16" :
+				u =      0.0
+				v =  65535.0
+			else :
+				u =      1.0
+				v =      0.0
+
+			if u < v :
+				d["render_min"] = u
+				d["render_max"] = v
+		else :
+			if not min_max_set :
+				d["render_min"] = d["minimum"]
+				d["render_max"] = d["maximum"]
+
+def write_2d_image(d,i,outfile,out_type,out_mode,not_swap,options):
+	"""Writes processed image number i to a 2-D stack, in place or appended"""
+	# optionally replace the output image with its rotational average
+
+	if options.rotavg:
+		rd = d.calc_radial_dist(d["nx"],0,0.5,0)
+		d = EMData(len(rd),1,1)
+
+		for x in xrange(len(rd)): d[x] = rd[x]
+
+	if d["sigma"]==0:
+		if options.verbose > 0:
+			print "Warning: sigma = 0 for image ",i
+
+		if options.writejunk == False:
+			if options.verbose > 0:
+				print "Use the writejunk option to force writing this image to disk"
+			return
+
+	if outfile!=None :
+		if options.inplace:
+			d.write_image(outfile, i, out_type, False, None, out_mode, not_swap)
+		else: # append the image
+			d.write_image(outfile, -1, out_type, False, None, out_mode, not_swap)
+
+def process_image_option(d,option1,index_d,options,i=0,n0=0):
+	"""Applies one of the image_options to image number i and returns the result, which may be a new image. index_d
+	counts the uses of each repeatable option so far. Used by both the serial and parallel code paths."""
+	nx = d.get_xsize()
+	ny = d.get_ysize()
+
+	if option1 == "apix":
+		apix = options.apix
+		d.set_attr('apix_x', apix)
+		d.set_attr('apix_y', apix)
+		d.set_attr('apix_z', apix)
+
+		try:
+			if i == n0 and d["ctf"].apix != apix :
+				if options.verbose > 0:
+					print "Warning: A/pix value in CTF was %1.2f, changing to %1.2f. May impact CTF parameters."%(d["ctf"].apix,apix)
+
+			d["ctf"].apix = apix
+		except: pass
+
+	elif option1 == "process":
+		fi = index_d[option1]
+		(processorname, param_dict) = parsemodopt(options.process[fi])
+
+		if not param_dict : param_dict = {}
+
+		# Parse the options to convert the image file name to EMData object
+		# (for both plain image file and bdb file)
+
+		for key in param_dict.keys():
+			#print str(param_dict[key])
+
+			if str(param_dict[key]).find('bdb:') != -1 or not str(param_dict[key]).isdigit():
+				try:
+					param_dict[key] = EMData(param_dict[key])			
+				except:
+					pass
+
+		d.process_inplace(processorname, param_dict)
+		index_d[option1] += 1
+
+	elif option1 == "addfile":
+		af=EMData(options.addfile[index_d[option1]],0)
+		d.add(af)
+		af=None
+		index_d[option1] += 1
+	elif option1 == "add":
+		d.add(options.add[index_d[option1]])
+		af=None
+		index_d[option1] += 1
+	elif option1 == "mult" :
+		d.mult(options.mult)
+	elif option1 == "multfile":
+		mf = EMData(options.multfile[index_d[option1]],0)
+		d.mult(mf)
+		mf = None
+		index_d[option1] += 1
+
+	elif option1 == "calccont":
+		dd = d.process("math.rotationalsubtract")
+		f = dd.do_fft()
+		#f = d.do_fft()
+
+		if d["apix_x"] <= 0 : raise Exception,"Error: 'calccont' requires an A/pix value, which is missing in the input images"
+
+		lopix = int(d["nx"]*d["apix_x"]/150.0)
+		hipix = int(d["nx"]*d["apix_x"]/25.0)
+		if hipix>d["ny"]/2-6 : hipix=d["ny"]/2-6	# if A/pix is very large, this makes sure we get at least some info
+
+		if lopix == hipix : lopix,hipix = 3,d["nx"]/5	# in case the A/pix value is drastically out of range
+
+		r = f.calc_radial_dist(d["ny"]/2,0,1.0,1)
+		lo = sum(r[lopix:hipix])/(hipix-lopix)
+		hi = sum(r[hipix+1:-1])/(len(r)-hipix-2)
+
+#					print lopix, hipix, lo, hi
+		d["eval_contrast_lowres"] = lo/hi
+	#				print lopix,hipix,lo,hi,lo/hi
+
+	elif option1 == "rfp":
+		d = d.make_rotational_footprint()
+
+	elif option1 == "fp":
+		d = d.make_footprint(options.fp)
+
+	elif option1 == "anisotropic":
+		try: 
+			amount,angle = (options.anisotropic[index_d[option1]]).split(",")
+			amount=float(amount)
+			angle=float(angle)
+		except:
+			traceback.print_exc()
+			print options.anisotropic[index_d[option1]]
+			print "Error: --anisotropic specify amount,angle"
+			sys.exit(1)
+			
+		rt=Transform({"type":"2d","alpha":angle})
+		xf=rt*Transform([amount,0,0,0,0,1/amount,0,0,0,0,1,0])*rt.inverse()
+		d.transform(xf)
+
+		index_d[option1] += 1
+
+
+	elif option1 == "scale":
+		scale_f = options.scale[index_d[option1]]
+
+		if scale_f != 1.0:
+			d.scale(scale_f)
+
+		index_d[option1] += 1
+
+	elif option1 == "rotate":
+		rotatef = options.rotate[index_d[option1]]
+
+		if rotatef != 0.0 : d.rotate(rotatef,0,0)
+
+		index_d[option1] += 1
+
+	elif option1 == "translate":
+		tdx,tdy = options.translate[index_d[option1]].split(",")
+		tdx,tdy = float(tdx),float(tdy)
+
+		if tdx != 0.0 or tdy != 0.0 :
+			d.translate(tdx,tdy,0.0)
+
+		index_d[option1] += 1
+
+	elif option1 == "clip":
+		ci = index_d[option1]
+		clipcx = nx/2
+		clipcy = ny/2
+
+		try: clipx,clipy,clipcx,clipcy = options.clip[ci].split(",")
+		except: clipx, clipy = options.clip[ci].split(",")
+
+		clipx, clipy = int(clipx),int(clipy)
+		clipcx, clipcy = int(clipcx),int(clipcy)
+
+		e = d.get_clip(Region(clipcx-clipx/2, clipcy-clipy/2, clipx, clipy))
+
+		try: e.set_attr("avgnimg", d.get_attr("avgnimg"))
+		except: pass
+
+		d = e
+		index_d[option1] += 1
+
+	elif option1 == "randomize" :
+		ci = index_d[option1]
+		rnd = options.randomize[ci].split(",")
+		rnd[0] = float(rnd[0])
+		rnd[1] = float(rnd[1])
+		rnd[2] = int(rnd[2])
+
+		t = Transform()
+		t.set_params({"type":"2d", "alpha":random.uniform(-rnd[0],rnd[0]), \
+						"mirror":random.randint(0,rnd[2]), "tx":random.uniform(-rnd[1],rnd[1]), \
+						"ty":random.uniform(-rnd[1],rnd[1])})
+		d.transform(t)
+
+	elif option1 == "medianshrink":
+		shrink_f = options.medianshrink[index_d[option1]]
+
+		if shrink_f > 1:
+			d.process_inplace("math.medianshrink",{"n":shrink_f})
+
+		index_d[option1] += 1
+
+	elif option1 == "meanshrink":
+		mshrink = options.meanshrink[index_d[option1]]
+
+		if mshrink > 1:
+			d.process_inplace("math.meanshrink",{"n":mshrink})
+
+		index_d[option1] += 1
+
+	elif option1 == "fouriershrink":
+		fshrink = options.fouriershrink[index_d[option1]]
+
+		if fshrink > 1:
+			d.process_inplace("math.fft.resample",{"n":fshrink})
+
+		index_d[option1] += 1
+		
+	elif option1 == "headertransform":
+		xfmode = options.headertransform[index_d[option1]]
+		
+		if xfmode not in (0,1) :
+			print "Error: headertransform must be set to 0 or 1"
+			sys.exit(1)
+		
+		try: xform=d["xform.align2d"]
+		except: print "Error: particle has no xform.align2d header value"
+
+		if xfmode == 1 : xform.invert()
+		
+		d.process_inplace("xform",{"transform":xform})
+
+	elif option1 == "radon":
+		r = d.do_radon()
+		d = r
+
+	return d
+
+def doparallel(infile,outfile,indices,isthreed,n0,options,optionlist):
+	"""Applies the per-image options to the listed images of infile using the EMAN2PAR parallelism system. Results
+	are written to outfile in input order, as they would be by the serial loop"""
+
+	from EMAN2PAR import EMTaskCustomer
+
+	serialonly = ["average","fftavg","calcsf","setsfpairs","interlv","selfcl","extractboxes","unstacking","threed2threed","threed2twod","twod2threed"]
+	bad = [o for o in serialonly if getattr(options,o,None)]
+	if isthreed : bad.append("--plane")
+	if infile[0] == ":" : bad.append("image expressions")
+	if options.outtype in ["mrc", "pif", "png", "pgm", "spidersingle"] : bad.append("--outtype "+options.outtype)
+	if bad :
+		print "Error: --parallel cannot be used with: "+", ".join(bad)
+		sys.exit(1)
+
+	if not options.outtype : options.outtype = "unknown"
+	out_type = EMUtil.get_image_ext_type(options.outtype)
+	out_mode = file_mode_map[options.outmode]
+	not_swap = not(options.swap)
+
+	etc=EMTaskCustomer(options.parallel)
+
+	# a few tasks per CPU, with a bounded number outstanding so finished images don't pile up in memory
+	N=len(indices)
+	step=max(1,min(250,N/(etc.cpu_est()*4)))
+	chunks=[indices[j:j+step] for j in xrange(0,N,step)]
+	maxout=max(2,etc.cpu_est()*3)
+	if options.verbose : print "{} images in {} tasks".format(N,len(chunks))
+
+	tids=[]			# (task id, chunk number) for outstanding tasks
+	done={}			# chunk number -> results, for chunks which finished before their predecessors
+	nsent=0
+	nwritten=0
+	while nwritten<len(chunks):
+		if len(tids)<maxout and nsent<len(chunks):
+			nnew=min(maxout-len(tids),len(chunks)-nsent)
+			tasks=[Proc2dTask(infile,chunks[j],n0,options,optionlist) for j in xrange(nsent,nsent+nnew)]
+			tids.extend(zip(etc.send_tasks(tasks),range(nsent,nsent+nnew)))
+			nsent+=nnew
+
+		time.sleep(2)
+		proglist=etc.check_task([t[0] for t in tids])
+		for k,prog in enumerate(proglist):
+			if prog==100 :
+				r=etc.get_results(tids[k][0])
+				done[tids[k][1]]=r[1]["images"]
+		tids=[t for k,t in enumerate(tids) if proglist[k]!=100]
+
+		# write any results we can without breaking the input order
+		while nwritten in done:
+			for i,d in done.pop(nwritten):
+				fsp = outfile
+				if outfile!=None and options.split and options.split > 1:
+					fsp = outfile[:-4] + ".%02d." % (i % options.split) + (outfile[-4:] if outfile[-4:]=="mrcs" else outfile[-3:])
+				set_render_range(d,options)
+				write_2d_image(d,i,fsp,out_type,out_mode,not_swap,options)
+			nwritten+=1
+
+		if options.verbose : print "{}/{} tasks complete".format(nwritten,len(chunks))
+
+class Proc2dTask(JSTask):
+	"""Applies the per-image e2proc2d.py options to a set of images for the parallelism system"""
+
+	def __init__(self,infile=None,indices=None,n0=0,options=None,optionlist=None):
+		if infile==None : data=None
+		else : data={"images":["cache",infile,indices]}
+		if options==None : opts=None
+		else :
+			opts={k:v for k,v in vars(options).items() if isinstance(v,(int,float,str,unicode,list,tuple,type(None)))}
+			opts["optionlist"]=[o for o in optionlist if o in image_options]
+			opts["n0"]=n0
+		JSTask.__init__(self,"Proc2d",data,opts)
+
+	def execute(self,callback=None):
+		from EMAN2PAR import image_range
+		from argparse import Namespace
+		import threading
+		import Queue
+
+		fsp=self.data["images"][1]
+		imgs=list(image_range(*self.data["images"][2:]))
+		options=Namespace(**self.options)
+
+		# images are read in a separate thread so IO overlaps with processing
+		imq=Queue.Queue(4)
+		def reader():
+			for i in imgs:
+				try: imq.put((i,EMData(fsp,i)))
+				except:
+					imq.put((i,None))
+					return
+		thr=threading.Thread(target=reader)
+		thr.start()
+
+		ret=[]
+		try:
+			for j in xrange(len(imgs)):
+				i,d=imq.get()
+				if d==None : raise Exception,"Error: cannot read image {} from {}".format(i,fsp)
+
+				index_d=dict.fromkeys(append_options,0)
+				for option1 in options.optionlist:
+					d=process_image_option(d,option1,index_d,options,i,options.n0)
+				ret.append((i,d))
+				if callback!=None : callback(100*(j+1)/len(imgs))
+		finally:
+			# let the reader finish if we stopped early
+			while thr.is_alive():
+				try: imq.get(timeout=0.1)
+				except Queue.Empty: pass
+			thr.join()
+
+		return {"images":ret}
+
+jsonclasses["Proc2dTask"]=Proc2dTask.from_jsondict
 
 if __name__ == "__main__":
 	main()
@@ -39,60 +39,256 @@ from optparse import OptionParser
 import sys
 from math import *
 import os.path
+import threading
+import Queue
+import traceback
+import numpy as np
 import pyemtbx.options
 from pyemtbx.options import intvararg_callback
 from pyemtbx.options import floatvararg_callback
 
+AXES={"x":0,"y":1,"z":2}
+
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = progname + """ [options] <inputfile>
 	This is a specialized version of e2proc3d.py targeted at performing a limited set of operations on
-very large volumes in-place (such as tomograms) which may not readily fit into system memory. Operations are 
+very large volumes in-place (such as tomograms) which may not readily fit into system memory. Operations are
 performed by reading portions of the image, processing, then writing the portion back to disk. Unlike e2proc3d.py
-you may pass only a single operation to the program for each invocation, or behavior will be undefined. It will 
+you may pass only a single operation to the program for each invocation, or behavior will be undefined. It will
 process a single volume in a single file in-place.
 
+The volume is processed as a series of slabs along its longest axis, each divided into tiles which are processed
+in parallel (--threads). Tiles are read with an additional --halo of surrounding voxels, which is discarded after
+processing, so local filters will not produce seams. Slab thickness is chosen to fit within --maxmem.
 """
 	parser = OptionParser(usage)
-	
 
-	parser.add_option("--streaksubtract",type="string",help="This will subtract the histogram peak value along a single axis in the volume.",default=None)
+
+	parser.add_option("--streaksubtract",type="string",help="<x|y|z> This will subtract the histogram peak value along a single axis in the volume.",default=None)
 
 	parser.add_option("--process", metavar="processor_name:param1=value1:param2=value2", type="string",
 								action="append", help="apply a processor named 'processorname' with all its parameters/values. WARNING: this works by operating on fragments of the overall image at a time, and some processors won't work properly this way.")
 
-	parser.add_option("--mult", metavar="f", type="float", 
+	parser.add_option("--mult", metavar="f", type="float",
 								help="Scales the densities by a fixed number in the output")
-	
+
 	parser.add_option("--multfile", type="string", action="append",
 								help="Multiplies the volume by another volume of identical size. This can be used to apply masks, etc.")
-		
-	parser.add_option("--add", metavar="f", type="float", 
+
+	parser.add_option("--add", metavar="f", type="float",
 								help="Adds a constant 'f' to the densities")
 
 	parser.add_option("--trans", metavar="dx,dy,dz", type="string", default=0, help="Translate map by dx,dy,dz ")
+	parser.add_option("--tilesize", type="int", help="Size of the tiles each slab is divided into. Default=256",default=256)
+	parser.add_option("--halo", type="int", help="Extra voxels read on each side of a tile for --process, so filters are seam-free. Should be larger than the filter kernel. Default=16",default=16)
+	parser.add_option("--threads", type="int", help="Number of tiles to process in parallel. Default=1",default=1)
+	parser.add_option("--maxmem", type="int", help="Approximate memory limit in MB, used to determine the slab thickness. Default=2048",default=2048)
 	parser.add_option("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_option("--verbose", "-v", dest="verbose", action="store", metavar="n", type="int", default=0, help="verbose level [0-9], higner number means higher level of verboseness")
-		
+
 	(options, args) = parser.parse_args()
 
-	print "Sorry, this program still under development. Not functional yet."
-	sys.exit(1)
+	if len(args)!=1 :
+		print "ERROR: Please specify a single volume to process in-place"
+		sys.exit(1)
 
 	try:
-		hdr=EMData(args[1],0,1)
+		hdr=EMData(args[0],0,1)
 	except:
 		print "ERROR: Can't read input file header"
 		sys.exit(1)
 
+	dims=(hdr["nx"],hdr["ny"],hdr["nz"])
+
+	if options.process : options.process=[parsemodopt(p) for p in options.process]
+	if options.trans :
+		try: options.trans=[float(i) for i in options.trans.split(",")]
+		except:
+			print "ERROR: --trans must be dx,dy,dz"
+			sys.exit(1)
+	if options.multfile :
+		for f in options.multfile :
+			h=EMData(f,0,1)
+			if (h["nx"],h["ny"],h["nz"])!=dims :
+				print "ERROR: %s is not the same size as %s"%(f,args[0])
+				sys.exit(1)
+	if options.streaksubtract!=None and options.streaksubtract not in AXES :
+		print "ERROR: --streaksubtract must be x, y or z"
+		sys.exit(1)
+
+	# only operations which use neighboring voxels need a halo
+	halo=0
+	if options.process : halo=options.halo
+	if options.trans : halo=max(halo,int(ceil(max([abs(i) for i in options.trans]))))
+	options.halo=halo
+
+	logid=E2init(sys.argv,options.ppid)
+
+	slabs,delay=make_slabs(dims,options)
+	if options.verbose : print "%d x %d x %d volume in %d slabs of %d tiles, %d voxel halo"%(dims[0],dims[1],dims[2],len(slabs),len(slabs[0]),halo)
+
+	iolock=threading.Lock()			# image IO is serialized, processing is not
+	jobs=Queue.Queue(0)
+	results=Queue.Queue(0)
+	thrds=[threading.Thread(target=tileworker,args=(jobs,results,args[0],dims,options,iolock)) for i in xrange(options.threads)]
+	for t in thrds: t.start()
+
+	# Tiles are written in-place, so we must never overwrite voxels which another tile still needs to read. Within a
+	# slab, all tiles are read before any is written. The last 'delay' planes of each slab are also needed by the next
+	# slab, so they are held in memory until that slab has been read.
+	pending=[]
+	for sn,slab in enumerate(slabs):
+		for tile in slab: jobs.put(tile)
+		done=[]
+		for i in xrange(len(slab)):
+			tile,img=results.get()
+			if img==None :
+				print "ERROR: processing failed on tile ",tile
+				for t in thrds: jobs.put(None)
+				sys.exit(1)
+			done.append((tile,img))
+
+		for box,img in pending : writebox(args[0],box,img,iolock)
+
+		pending=[]
+		for box,img in done :
+			if sn<len(slabs)-1 and delay>0 :
+				now,later=splitbox(box,delay)
+				writebox(args[0],now,img.get_clip(boxregion(now,box[0])),iolock)
+				pending.append((later,img.get_clip(boxregion(later,box[0]))))
+			else : writebox(args[0],box,img,iolock)
+		done=None
+
+		if options.verbose : print "%d/%d slabs complete"%(sn+1,len(slabs))
+		E2progress(logid,float(sn+1)/len(slabs))
+
+	for t in thrds: jobs.put(None)
+	for t in thrds: t.join()
+
+	E2end(logid)
+
+def make_slabs(dims,options):
+	"""Divides the volume into slabs along its longest axis (excluding the streaksubtract axis, along which
+	tiles must be complete), then divides each slab into tiles. Returns a list of slabs, each a list of
+	(origin,size) tuples, and the number of planes at the end of each slab which must be written late."""
+
+	halo=options.halo
+	ts=[options.tilesize]*3
+	if options.streaksubtract!=None : ts[AXES[options.streaksubtract]]=dims[AXES[options.streaksubtract]]
+	ts=[min(ts[i],dims[i]) for i in xrange(3)]
+
+	cand=[i for i in xrange(3) if options.streaksubtract==None or i!=AXES[options.streaksubtract]]
+	outer=max(cand,key=lambda i:dims[i])
+	other=[i for i in xrange(3) if i!=outer]
+
+	# memory for one plane of a slab, and for one tile being processed (input, padded copies, output)
+	plane=4*dims[other[0]]*dims[other[1]]
+	def tilemem(thk): return 12*(thk+2*halo)*(ts[other[0]]+2*halo)*(ts[other[1]]+2*halo)
+
+	maxbytes=options.maxmem*1048576
+	thk=max(dims[outer],1)
+	while thk>max(halo,1) and (thk+halo)*plane+options.threads*tilemem(thk)>maxbytes : thk=max(thk/2,halo,1)
+	if (thk+halo)*plane+options.threads*tilemem(thk)>maxbytes :
+		print "Warning: unable to fit within --maxmem, reduce --tilesize, --halo or --threads"
+	ts[outer]=thk
+
+	slabs=[]
+	for s in xrange(0,dims[outer],thk):
+		slab=[]
+		for a in xrange(0,dims[other[0]],ts[other[0]]):
+			for b in xrange(0,dims[other[1]],ts[other[1]]):
+				org=[0,0,0]
+				size=[0,0,0]
+				for ax,v in ((outer,s),(other[0],a),(other[1],b)):
+					org[ax]=v
+					size[ax]=min(ts[ax],dims[ax]-v)
+				slab.append((tuple(org),tuple(size),outer))
+		slabs.append(slab)
+
+	return slabs,halo
+
+def splitbox(box,n):
+	"""Splits a tile into the portion which can be written immediately and the last n planes along the slab axis"""
+	org,size,outer=box
+	if size[outer]<=n : return (org,[0 if i==outer else size[i] for i in xrange(3)],outer),box
+	o2=list(org)
+	s1=list(size)
+	s2=list(size)
+	s1[outer]-=n
+	s2[outer]=n
+	o2[outer]+=s1[outer]
+	return (org,tuple(s1),outer),(tuple(o2),tuple(s2),outer)
+
+def boxregion(box,base=(0,0,0)):
+	"""Region corresponding to box, relative to base"""
+	org,size=box[:2]
+	return Region(org[0]-base[0],org[1]-base[1],org[2]-base[2],size[0],size[1],size[2])
+
+def writebox(fsp,box,img,iolock):
+	if min(box[1])<=0 : return
+	with iolock: img.write_image(fsp,0,EMUtil.ImageType.IMAGE_UNKNOWN,False,boxregion(box))
+
+def tileworker(jobs,results,fsp,dims,options,iolock):
+	"""Thread processing tiles from jobs until it receives None"""
+	while True:
+		tile=jobs.get()
+		if tile==None : return
+		try: results.put((tile,processtile(fsp,tile,dims,options,iolock)))
+		except:
+			traceback.print_exc()
+			results.put((tile,None))
+
+def processtile(fsp,tile,dims,options,iolock):
+	"""Reads one tile with its halo, performs the requested operations, and returns the unpadded tile"""
+	org,size=tile[:2]
+	halo=options.halo
+	porg=[max(org[i]-halo,0) for i in xrange(3)]
+	psize=[min(org[i]+size[i]+halo,dims[i])-porg[i] for i in xrange(3)]
+	pbox=(porg,psize)
+
+	img=EMData()
+	with iolock: img.read_image(fsp,0,False,boxregion(pbox))
+
+	if options.streaksubtract!=None :
+		a=EMNumPy.em2numpy(img)
+		a-=findmode(a,2-AXES[options.streaksubtract])		# numpy axes are z,y,x
+		img.update()
+
+	if options.process :
+		for name,parms in options.process :
+			if parms==None : parms={}
+			img.process_inplace(name,parms)
+
+	if options.multfile :
+		for f in options.multfile :
+			m=EMData()
+			with iolock: m.read_image(f,0,False,boxregion(pbox))
+			img.mult(m)
+
+	if options.mult!=None : img.mult(options.mult)
+	if options.add!=None : img.add(options.add)
+	if options.trans : img.translate(*options.trans)
+
+	if halo>0 : img=img.get_clip(boxregion(tile,porg))
+	return img
 
-	if options.mediansubtract!=None :
-		
-		
+def findmode(a,axis,nbins=64):
+	"""This computes something akin to the mode of each line of a along axis. A histogram of each line is computed
+	between mean-2*sigma and mean+2*sigma, and the center of the most populated bin is returned, in an array which
+	can be subtracted from a."""
+	mean=a.mean(axis=axis,keepdims=True)
+	wid=4.0*a.std(axis=axis,keepdims=True)/nbins
+	wid[wid==0]=1.0
+	lo=mean-nbins/2*wid
 
-def findmode(img) :
-	"""This computes something akin to the mode
+	b=np.clip(((a-lo)/wid).astype(np.int32),0,nbins-1)
+	b=np.rollaxis(b,axis,b.ndim)
+	nl=b.size/b.shape[-1]
+	b=b.reshape(nl,b.shape[-1])+np.arange(nl).reshape(nl,1)*nbins
+	pk=np.bincount(b.ravel(),minlength=nl*nbins).reshape(nl,nbins).argmax(axis=1)
 
+	return lo+(pk.reshape(lo.shape)+0.5)*wid
 
 if __name__ == "__main__":
 	main()
@@ -69,11 +69,12 @@ sort of virtual stack represented by .lst files, use e2proc2d.py or e2proc3d.py
 			rg=eval("range({})".format(options.range))
 			
 		for f in args:
-			n=EMUtil.get_image_count(f)
 			if f.endswith(".lst"):
-				lstin=LSXFile(f,True)
+				lstin=LSXFile(f,True,True)
+				n=len(lstin)
 				fromlst=True
 			else:
+				n=EMUtil.get_image_count(f)
 				fromlst=False
 			if options.verbose : 
 				if options.range:
@@ -81,19 +82,21 @@ sort of virtual stack represented by .lst files, use e2proc2d.py or e2proc3d.py
 				else:
 					print "Processing {} images in {}".format(n,f)
 			if options.range:
-				for i in rg:
-					if i>=n: break
-					if fromlst:
-						ln=lstin.read(i)
-						lst.write(-1,ln[0],ln[1],ln[2])
-					else:
+				if fromlst:
+					nums,fsps,cmts=lstin.read_many([i for i in rg if i<n])
+					for i in xrange(len(nums)):
+						lst.write(-1,nums[i],fsps[i],cmts[i])
+				else:
+					for i in rg:
+						if i>=n: break
 						lst.write(-1,i,f)
 			else:
-				for i in xrange(n):
-					if fromlst:
-						ln=lstin.read(i)
-						lst.write(-1,ln[0],ln[1],ln[2])
-					else:
+				if fromlst:
+					nums,fsps,cmts=lstin.read_range()
+					for i in xrange(len(nums)):
+						lst.write(-1,nums[i],fsps[i],cmts[i])
+				else:
+					for i in xrange(n):
 						lst.write(-1,i,f)
 		
 		sys.exit(0)
@@ -143,12 +146,12 @@ sort of virtual stack represented by .lst files, use e2proc2d.py or e2proc3d.py
 		
 		# loop over input files
 		for f in args:
-			lst=LSXFile(f,True)
+			lst=LSXFile(f,True,True)
 			ntot+=len(lst)
 			
-			for i in xrange(len(lst)):
-				im=lst.read(i)
-				lsto.write(-1,im[0],im[1],im[2])
+			nums,fsps,cmts=lst.read_range()
+			for i in xrange(len(nums)):
+				lsto.write(-1,nums[i],fsps[i],cmts[i])
 
 		if options.verbose : print "{} particles added to {}".format(ntot,options.merge)
 
@@ -161,13 +164,12 @@ sort of virtual stack represented by .lst files, use e2proc2d.py or e2proc3d.py
 		ptcls=[]
 		pfiles=set()
 		for f in args:
-			lst=LSXFile(f,True)
+			lst=LSXFile(f,True,True)
 			ntot+=len(lst)
 			
-			for i in xrange(len(lst)):
-				im=lst.read(i)
-				ptcls.append((im[1],im[0],im[2]))
-				pfiles.add(im[1])
+			nums,fsps,cmts=lst.read_range()
+			ptcls.extend(zip(fsps,nums.tolist(),cmts))
+			pfiles.update(fsps)
 				
 		ptcls.sort()
 		
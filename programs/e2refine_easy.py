@@ -71,6 +71,82 @@ def write_html() :
 	out.write("\n".join(output_html_com))
 	out.write("<br></br><hr></hr>Generated by {ver} {date}\n</body></html>".format(ver=EMANVERSION,date=DATESTAMP))
 
+# The stage manifest records each command run() executes, with its input/output files and timing, so an interrupted
+# refinement can be resumed with --resume. Stages are replayed in order, and skipped as long as every earlier stage was
+# also skipped, the command is identical, its outputs still exist and any inputs from outside the refinement directory
+# are unchanged. Once one stage has to be run, all later stages run as well.
+stage_path=None
+stage_db=None
+stage_list=[]
+stage_next=0
+stage_resume=False
+
+def stage_open(path,resume) :
+	global stage_path,stage_db,stage_list,stage_next,stage_resume
+	stage_path=path
+	stage_db=js_open_dict(path+"/0_refine_stages.json")
+	if resume : stage_list=stage_db.getdefault("stages",[])
+	else : stage_list=[]
+	stage_next=0
+	stage_resume=resume
+
+def file_stat(fsp) :
+	"""(mtime,size) for a file, or None if it doesn't exist"""
+	try :
+		st=os.stat(fsp)
+		return (st.st_mtime,st.st_size)
+	except : return None
+
+def stage_files(command) :
+	"""Returns a dictionary of the files named on a command line which currently exist, with their (mtime,size)"""
+	ret={}
+	for t in command.split() :
+		for f in t.split("=") :
+			if f in ret or not os.path.isfile(f) : continue
+			ret[f]=file_stat(f)
+	return ret
+
+def stage_done(command) :
+	"""Returns the manifest record if this command, the next stage to run, can be skipped when resuming"""
+	global stage_resume
+	if not stage_resume : return None
+
+	try :
+		rec=stage_list[stage_next]
+		if rec["command"]!=command : raise Exception
+		for f in rec["outputs"] :
+			if not os.path.isfile(f) : raise Exception
+		for f,st in rec["inputs"].items() :
+			if not os.path.abspath(f).startswith(os.path.abspath(stage_path)+"/") and file_stat(f)!=tuple(st) : raise Exception
+	except :
+		stage_resume=False
+		return None
+
+	return rec
+
+def stage_store(rec) :
+	"""Records a completed stage and rewrites the timing summary"""
+	global stage_list,stage_next
+	if stage_resume : stage_list[stage_next]=rec		# skipped, later records may still be used
+	else : stage_list=stage_list[:stage_next]+[rec]
+	stage_next+=1
+	stage_db["stages"]=stage_list
+
+	progs={}
+	out=file(stage_path+"/0_refine_timing.txt","w")
+	out.write("# stage\twall (s)\tcpu (s)\tstatus\tcommand\n")
+	for i,r in enumerate(stage_list) :
+		prog=r["command"].split()[0]
+		w,c=progs.get(prog,(0,0))
+		progs[prog]=(w+r["wall"],c+r["cpu"])
+		out.write("{}\t{:1.1f}\t{:1.1f}\t{}\t{}\n".format(i,r["wall"],r["cpu"],r["status"],r["command"]))
+
+	out.write("\n# program\twall (s)\tcpu (s)\n")
+	for prog in sorted(progs,key=lambda x:-progs[x][0]) :
+		out.write("{}\t{:1.1f}\t{:1.1f}\n".format(prog,progs[prog][0],progs[prog][1]))
+	out.write("total\t{:1.1f}\t{:1.1f}\n".format(sum(i[0] for i in progs.values()),sum(i[1] for i in progs.values())))
+	out.close()
+
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = """e2refine_easy.py [options]
@@ -129,6 +205,10 @@ To run this program, you would normally specify only the following options:
   --path=<path>          Normally the new directory will be named automatically. If you prefer your own convention
                          you can override, but it may cause minor GUI problems if you break the standard naming
                          convention.
+  --resume               Continue an interrupted refinement in --path. Run with the same options as the original
+                         command. Steps which already completed are skipped.
+
+The time spent in each step is written to 0_refine_timing.txt in the refinement directory.
 
 Since many parameters are now selected automatically, if you are curious exactly what the differences are between any
 two refinements, on Linux/Mac, you can run, for example, diff refine_01/0_refine_parms.json refine_02/0_refine_parms.json
@@ -171,6 +251,7 @@ not need to specify any of the following other than the ones already listed abov
 	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:<option>=<value>:<option>=<value>. See http://blake.bcm.edu/emanwiki/EMAN2/Parallel",default=None, guitype='strbox', row=30, col=0, rowspan=1, colspan=2, mode="refinement[thread:4]")
 	parser.add_argument("--threads", default=1,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful", guitype='intbox', row=30, col=2, rowspan=1, colspan=1, mode="refinement[4]")
 	parser.add_argument("--path", default=None, type=str,help="The name of a directory where results are placed. Default = create new refine_xx")
+	parser.add_argument("--resume", default=False, action="store_true",help="Continue an interrupted refinement in --path, which must be run with the same options. Steps which already completed are skipped.")
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 #	parser.add_argument("--usefilt", dest="usefilt", type=str,default=None, help="Specify a particle data file that has been low pass or Wiener filtered. Has a one to one correspondence with your particle data. If specified will be used in projection matching routines, and elsewhere.")
 
@@ -251,6 +332,10 @@ not need to specify any of the following other than the ones already listed abov
 	else:
 		m3dpreprocess="--preprocess "+options.m3dpreprocess
 
+	if options.resume and (options.path==None or not os.path.exists(options.path+"/0_refine_stages.json")) :
+		print "ERROR : --resume requires --path naming an existing refinement directory"
+		sys.exit(1)
+
 	if options.path == None:
 		fls=[int(i[-2:]) for i in os.listdir(".") if i[:7]=="refine_" and len(i)==9 and str.isdigit(i[-2:])]
 		if len(fls)==0 : fls=[0]
@@ -259,6 +344,7 @@ not need to specify any of the following other than the ones already listed abov
 	output_path="{}/report".format(options.path)
 	try: os.makedirs(output_path)
 	except: pass
+	stage_open(options.path,options.resume)
 
 	# make sure the box sizes match
 	if options.input!=None :
@@ -1092,9 +1178,21 @@ For the final completed iteration, the unmasked even and odd volumes are also re
 def run(command):
 	"Mostly here for debugging, allows you to control how commands are executed (os.system is normal)"
 
+	rec=stage_done(command)
+	if rec!=None :
+		print "{}: (already complete) {}".format(time.ctime(time.time()),command)
+		append_html("<p>{}: (already complete) {}</p>".format(time.ctime(time.time()),command),True)
+		rec["status"]="skipped"
+		stage_store(rec)
+		return
+
 	print "{}: {}".format(time.ctime(time.time()),command)
 	append_html("<p>{}: {}</p>".format(time.ctime(time.time()),command),True)
 
+	before=stage_files(command)
+	t0=time.time()
+	c0=os.times()
+
 	ret=launch_childprocess(command)
 
 	# We put the exit here since this is what we'd do in every case anyway. Saves replication of error detection code above.
@@ -1102,6 +1200,13 @@ def run(command):
 		print "Error running: ",command
 		sys.exit(1)
 
+	# files which changed are outputs, the rest are inputs
+	c1=os.times()
+	after=stage_files(command)
+	inputs=dict((f,st) for f,st in after.items() if before.get(f)==st)
+	outputs=[f for f in after if before.get(f)!=after[f]]
+	stage_store({"command":command,"inputs":inputs,"outputs":outputs,"time":t0,"wall":time.time()-t0,"cpu":c1[2]+c1[3]-c0[2]-c0[3],"status":"run"})
+
 	return
 
 if __name__ == "__main__":
@@ -13,6 +13,7 @@
 #import block
 from EMAN2 import *
 from EMAN2db import db_open_dict
+from EMAN2star import StarFile
 import pyemtbx.options
 import os
 import sys
@@ -218,11 +219,15 @@ for db in dblist:
 			#defocus = db_set['ctf'].to_dict()['defocus']*1000
 			break
 print "CTF information being pulled from: " + db
+# the particle table is accumulated in memory and written in one pass at the end
 if ctf_corr == 1:
-	s = """echo "data_\nloop_\n_rlnImageName\n_rlnMicrographName\n_rlnDefocusU\n_rlnDefocusV\n_rlnDefocusAngle\n_rlnVoltage\n_rlnSphericalAberration\n_rlnAmplitudeContrast" > """ + E2RLN + "/all_images.star"
+	starkeys = ["rlnImageName","rlnMicrographName","rlnDefocusU","rlnDefocusV","rlnDefocusAngle","rlnVoltage","rlnSphericalAberration","rlnAmplitudeContrast"]
 else:
-	s = """echo "data_\nloop_\n_rlnImageName\n_rlnMicrographName\n_rlnVoltage\n_rlnAmplitudeContrast" > """ + E2RLN + "/all_images.star"
-call(s,shell=True)
+	starkeys = ["rlnImageName","rlnMicrographName","rlnVoltage","rlnAmplitudeContrast"]
+if os.path.exists(E2RLN + "/all_images.star"): os.unlink(E2RLN + "/all_images.star")
+star = StarFile(E2RLN + "/all_images.star")
+star.loops = [starkeys]
+for key in starkeys: star[key] = []
 
 print "Converting EMAN2 Files to Formats Compatible with RELION"
 temp = EMData(set_name,0)
@@ -250,12 +255,10 @@ for k in range(num_ptcl):
 		if ctf_corr == 1:
 			defocus1 = defocus2 = str(temp['ctf'].to_dict()['defocus']*10000)
 			for num in range(k-i):
-				s = "echo \"" + str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + str(defocus1) + " " + str(defocus2) + " 0 " + str(voltage) + " " + str(cs) + " " + str(amplitude_contrast) + " \">> " + E2RLN + "/all_images.star" 
-				call(s,shell=True)
+				for key,val in zip(starkeys,[str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", str(defocus1), str(defocus2), "0", str(voltage), str(cs), str(amplitude_contrast)]): star[key].append(val)
 		else:
 			for num in range(k-i):
-				s = "echo \"" + str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + str(voltage) + " " + str(amplitude_contrast) + " \">> " + E2RLN + "/all_images.star" 
-				call(s,shell=True)
+				for key,val in zip(starkeys,[str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", str(voltage), str(amplitude_contrast)]): star[key].append(val)
 		s = "rm " + E2RLN + "/" + base_name(old_src) + ".hdf"
 		call(s,shell=True)
 		i = k
@@ -279,12 +282,10 @@ for k in range(num_ptcl):
 		if ctf_corr == 1:
 			defocus1 = defocus2 = str(temp['ctf'].to_dict()['defocus']*10000)
 			for num in range(k-i+1):
-				s = "echo \"" + str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + str(defocus1) + " " + str(defocus2) + " 0 " + str(voltage) + " " + str(cs) + " " + str(amplitude_contrast) + " \">> " + E2RLN + "/all_images.star"
-				call(s,shell=True)
+				for key,val in zip(starkeys,[str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", str(defocus1), str(defocus2), "0", str(voltage), str(cs), str(amplitude_contrast)]): star[key].append(val)
 		else:
 			for num in range(k-i+1):
-				s = "echo \"" + str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs " + str(voltage) + " " + amplitude_contrast + " \">> " + E2RLN + "/all_images.star"
-				call(s,shell=True)
+				for key,val in zip(starkeys,[str(num+1).zfill(6) + "@" + E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", E2RLN + "/stacks/" + base_name(old_src) + ".mrcs", str(voltage), str(amplitude_contrast)]): star[key].append(val)
 		
 		s = "rm " + E2RLN + "/" + base_name(src) + ".hdf"
 		call(s,shell=True)
@@ -292,6 +293,7 @@ for k in range(num_ptcl):
 		old_src = src
 		
 
+star.writefile()
 s = "rm " + E2RLN + "/ptcl_stack.hdf"
 call(s,shell=True)
 print "File Conversion Complete"
@@ -83,7 +83,7 @@ will be extracted from the STAR file and will be automatically processed through
 	os.chdir("eman2")	# many things need to happen with the project directory as a base
 
 	if options.verbose>0 : print "Parsing STAR file"
-	star=StarFile("../"+args[0])
+	star=StarFile("../"+args[0],columns=("rlnImageName","rlnDefocusU","rlnDefocusV","rlnDefocusAngle","rlnVoltage","rlnSphericalAberration","rlnAmplitudeContrast"))
 		
 	oldname=""
 	olddf=-1.0
@@ -39,11 +39,13 @@ from math import *
 import os
 import sys
 import traceback
+from collections import OrderedDict
 
 a = EMUtil.ImageType.IMAGE_UNKNOWN
 
 PROJ_FILE_ATTR = "projection_file" # this attribute important to e2simmxxplor
 PART_FILE_ATTR = "particle_file" # this attribute important to e2simmxxplor
+SPARSE_NREF_ATTR = "sparse_nref" # present only in sparse (--prune) matrices, the total number of references
 
 def opt_rectangular_subdivision(x,y,n):
 		'''
@@ -81,6 +83,51 @@ def opt_rectangular_subdivision(x,y,n):
 
 
 
+FFTCMPS=("phase","frc")		# comparators which accept Fourier transformed images directly
+
+def cmp_uses_fft(cmp):
+	"""True if the comparator cmp (name,parms) can be passed precomputed Fourier transforms of both images"""
+	if cmp==None or cmp[0] not in FFTCMPS : return False
+	return cmp[1]==None or not cmp[1].get("zeromask",0)
+
+class RefPrecompCache:
+	"""Images derived from each reference (masks, Fourier transforms) which are identical for every particle.
+	They are computed the first time they are needed, and reused for every other particle in the task. Only used
+	when no alignment is performed, as the aligners take the reference as a real-space image and redo their own
+	per-reference work for every particle. Items are
+	kept in least-recently-used order, and the oldest are discarded when the total size exceeds maxmem (MB). A discarded
+	item is simply recomputed if it is needed again."""
+
+	def __init__(self,maxmem=256):
+		self.maxbytes=maxmem*1048576
+		self.nbytes=0
+		self.cache=OrderedDict()
+		self.hits=0
+		self.misses=0
+
+	def get(self,key,fn):
+		"""Returns the cached item for key, calling fn() to compute it if necessary"""
+		try:
+			ret=self.cache.pop(key)
+			self.cache[key]=ret		# most recently used goes at the end
+			self.hits+=1
+			return ret
+		except KeyError: pass
+
+		ret=fn()
+		self.misses+=1
+		self.cache[key]=ret
+		self.nbytes+=ret.get_size()*4
+		while self.nbytes>self.maxbytes and len(self.cache)>1 :
+			k,v=self.cache.popitem(last=False)
+			self.nbytes-=v.get_size()*4
+
+		return ret
+
+	def clear(self):
+		self.cache=OrderedDict()
+		self.nbytes=0
+
 class EMParallelSimMX:
 	def __init__(self,options,args,logger=None):
 		'''
@@ -122,6 +169,11 @@ class EMParallelSimMX:
 				d["ralign"] = None
 				d["raligncmp"] = None
 			d["prefilt"]=options.prefilt
+			d["refcachemem"]=options.refcachemem
+			if options.prune>0 :
+				d["prune"]=options.prune
+				d["pruneshrink"]=options.pruneshrink
+				if options.prunecmp!=None : d["prunecmp"]=parsemodopt(options.prunecmp)
 
 			if hasattr(options,"shrink") and options.shrink != None: d["shrink"] = options.shrink
 			else: d["shrink"] = None
@@ -152,12 +204,18 @@ class EMParallelSimMX:
 			if options.force: remove_file(output)
 			else: raise RuntimeError("The output file exists. Please remove it or specify the force option")
 
-		e = EMData(self.clen,self.rlen)
+		if options.prune>0 :
+			# sparse matrix, one column for each retained reference, reference numbers in the last image
+			e = EMData(min(options.prune,self.clen),self.rlen)
+			e.set_attr(SPARSE_NREF_ATTR,self.clen)
+			n = 7
+		else :
+			e = EMData(self.clen,self.rlen)
+			n = 1
+			if self.options.saveali: n = 6 # the total number of images written to disk
 		e.to_zero()
 		e.set_attr(PROJ_FILE_ATTR,self.args[0])
 		e.set_attr(PART_FILE_ATTR,self.args[1])
-		n = 1
-		if self.options.saveali: n = 6 # the total number of images written to disk
 		if not options.fillzero : e.write_image(output,0)
 		for i in range(1,n):
 			e.write_image(output,i)
@@ -170,7 +228,9 @@ class EMParallelSimMX:
 		steve_factor = 3 # increase number of jobs a bit for better distribution
 		total_jobs = steve_factor*self.num_cpus
 
-		[col_div,row_div] = opt_rectangular_subdivision(self.clen,self.rlen,total_jobs)
+		# in pruned mode every task needs all of the references to rank them, so we only subdivide the particles
+		if self.options.prune>0 : [col_div,row_div] = [1,min(total_jobs,self.rlen)]
+		else : [col_div,row_div] = opt_rectangular_subdivision(self.clen,self.rlen,total_jobs)
 
 
 		block_c = self.clen/col_div
@@ -437,9 +497,20 @@ class EMSimTaskDC(JSTask):
 		# Note that 'refs' is now a dictionary of tuples: (reference,mask) or (reference,None)
 		return refs,ptcls,shrink,mask
 
-	def __cmp_one_to_many(self,ptcl,refs,mask,partial=None,progress_callback=None,cbi=0,cbn=1):
+	def __cmp_one_to_many(self,ptcl,refs,mask,partial=None,progress_callback=None,cbi=0,cbn=1,cache=None,options=None):
+
+		if options==None : options = self.options
+		if cache==None : cache=RefPrecompCache(0)
 
-		options = self.options
+		# anything which depends only on the particle is computed once, rather than for each reference
+		doalign=options.has_key("align") and options["align"][0] != None
+		prefilt=options.has_key("prefilt") and options["prefilt"]
+		if doalign and mask!=None :
+			target=ptcl.copy()
+			target.mult(mask)
+		else : target=ptcl
+		fftcmp=cmp_uses_fft(options["cmp"])
+		if fftcmp : targetf=target.do_fft()
 
 		data = {}
 		cbli=0
@@ -452,58 +523,118 @@ class EMSimTaskDC(JSTask):
 				else :
 					data[ref_idx] = (-1.0e38,None)			# ref wasn't in the partial list, skip this one
 					continue
-			if options.has_key("prefilt") and options["prefilt"]:
-				if ref[1]==None:
-					msk=ref[0].process("threshold.notzero")					# mask from the projection
-					ref[0]=ref[0].process("filter.matchto",{"to":ptcl})	# matched filter
-					ref[0].mult(msk)											# remask after setsf
-				else:
-					ref[0]=ref[0].process("filter.matchto",{"to":ptcl})	# matched filter
-					ref[0].mult(ref[1])											# remask after setsf
-			if options.has_key("align") and options["align"][0] != None:
-				aligned=ref[0].align(options["align"][0],ptcl,options["align"][1],options["aligncmp"][0],options["aligncmp"][1])
+			if prefilt:
+				# the reference itself is never modified, so it can be reused for the next particle
+				if ref[1]==None: msk=cache.get((ref_idx,"notzero"),lambda:ref[0].process("threshold.notzero"))	# mask from the projection
+				else: msk=ref[1]
+				refimg=ref[0].process("filter.matchto",{"to":ptcl})	# matched filter
+				refimg.mult(msk)											# remask after setsf
+			else : refimg=ref[0]
+			if doalign:
+				aligned=refimg.align(options["align"][0],ptcl,options["align"][1],options["aligncmp"][0],options["aligncmp"][1])
 
 				if options.has_key("ralign") and options["ralign"] != None: # potentially employ refine alignment
 					refine_parms=options["ralign"][1]
 					if ref[1]!=None :
 						#print "using mask, and ",mask
 						refine_parms["xform.align2d"] = aligned.get_attr("xform.align2d").inverse()
-						ref[0].del_attr("xform.align2d")
+						refimg.del_attr("xform.align2d")
 						refine_parms["mask"]=ref[1]
-						alip = ptcl.align(options["ralign"][0],ref[0],refine_parms,options["raligncmp"][0],options["raligncmp"][1])
-						aligned=ref[0].copy()
+						alip = ptcl.align(options["ralign"][0],refimg,refine_parms,options["raligncmp"][0],options["raligncmp"][1])
+						aligned=refimg.copy()
 						aligned.transform(alip["xform.align2d"].inverse())
 						aligned["xform.align2d"]=alip["xform.align2d"].inverse()
 					else:
 						refine_parms["xform.align2d"] = aligned.get_attr("xform.align2d")
-						ref[0].del_attr("xform.align2d")
-						aligned = ref[0].align(options["ralign"][0],ptcl,refine_parms,options["raligncmp"][0],options["raligncmp"][1])
-
+						refimg.del_attr("xform.align2d")
+						aligned = refimg.align(options["ralign"][0],ptcl,refine_parms,options["raligncmp"][0],options["raligncmp"][1])
 
-				if mask!=None :
-					aligned.mult(mask)
-					ptcl2=ptcl.copy()
-					ptcl2.mult(mask)
-					t =  aligned.get_attr("xform.align2d")
-					t.invert()
-					data[ref_idx] = (ptcl2.cmp(options["cmp"][0],aligned,options["cmp"][1]),t)
 
-				else:
-					t =  aligned.get_attr("xform.align2d")
-					t.invert()
-					data[ref_idx] = (ptcl.cmp(options["cmp"][0],aligned,options["cmp"][1]),t)
+				if mask!=None : aligned.mult(mask)
+				t =  aligned.get_attr("xform.align2d")
+				t.invert()
+				if fftcmp : data[ref_idx] = (targetf.cmp(options["cmp"][0],aligned.do_fft(),options["cmp"][1]),t)
+				else : data[ref_idx] = (target.cmp(options["cmp"][0],aligned,options["cmp"][1]),t)
 					
 			else:
-				data[ref_idx] = (ptcl.cmp(options["cmp"][0],ref[0],options["cmp"][1]),None)
+				if fftcmp :
+					if prefilt : reff=refimg.do_fft()
+					else : reff=cache.get((ref_idx,"fft"),lambda:refimg.do_fft())
+					data[ref_idx] = (targetf.cmp(options["cmp"][0],reff,options["cmp"][1]),None)
+				else : data[ref_idx] = (ptcl.cmp(options["cmp"][0],refimg,options["cmp"][1]),None)
 
 		return data
 
 	def dummycb(self,prog): return True
 
+	def __execute_pruned(self,refs,ptcls,shrink,mask,progress_callback):
+		"""Coarse-to-fine mode. Each particle is compared to all references after additional shrinking, with the primary
+		aligner only. Only the best 'prune' references are then aligned and compared at full sampling. Returns a sparse
+		similarity matrix, one row per particle, with the reference number of each column in the last image."""
+
+		options=self.options
+		k=min(options["prune"],len(refs))
+		pshrink=options.get("pruneshrink",2)
+
+		# coarse stage options, no refinement alignment or filtering
+		copts={"align":options["align"],"aligncmp":options["aligncmp"],"cmp":options["cmp"],"ralign":None,"prefilt":False}
+		if options.get("prunecmp",None)!=None : copts["cmp"]=options["prunecmp"]
+
+		if pshrink>1 :
+			crefs=dict([(i,(r[0].process("math.meanshrink",{"n":pshrink}),None)) for i,r in refs.items()])
+			if mask!=None : cmask=mask.process("math.meanshrink",{"n":pshrink})
+			else : cmask=None
+		else :
+			crefs=dict([(i,(r[0],None)) for i,r in refs.items()])
+			cmask=mask
+
+		result_data=[EMData(k,len(ptcls)) for i in range(7)]		# score,dx,dy,dalpha,mirror,scale,reference
+		for e in result_data: e.to_zero()
+
+		scale_correction = 1.0
+		if shrink != None: scale_correction = float(shrink)
+
+		min_ptcl_idx=min(ptcls.keys())
+		n=float(len(ptcls))
+		for i,ptcl_idx in enumerate(sorted(ptcls.keys())):
+			ptcl=ptcls[ptcl_idx]
+			if pshrink>1 : cptcl=ptcl.process("math.meanshrink",{"n":pshrink})
+			else : cptcl=ptcl
+
+			# rank all of the references using the coarse comparison, then keep the best k
+			coarse=self.__cmp_one_to_many(cptcl,crefs,cmask,None,progress_callback,i,n,None,copts)
+			best=sorted([(v[0],j) for j,v in coarse.items()])[:k]
+			best=[j for v,j in best]
+
+			fine=self.__cmp_one_to_many(ptcl,dict([(j,refs[j]) for j in best]),mask,None,progress_callback,i,n)
+			fine=sorted([(v[0],j,v[1]) for j,v in fine.items()])
+
+			rr=ptcl_idx-min_ptcl_idx
+			for c,v in enumerate(fine):
+				result_data[0][c,rr]=v[0]
+				result_data[6][c,rr]=v[1]
+				if v[2]!=None :
+					params = v[2].get_params("2d")
+					result_data[1][c,rr]=scale_correction*params["tx"]
+					result_data[2][c,rr]=scale_correction*params["ty"]
+					result_data[3][c,rr]=params["alpha"]
+					result_data[4][c,rr]=params["mirror"]
+					result_data[5][c,rr]=params["scale"]
+
+			if not progress_callback(int(100*(i+1)/n)) : return None
+
+		for r in result_data: r.update()
+		result_data[0].process_inplace("math.finite",{"to":1e24})
+
+		return {"rslt_data":result_data,"min_ref_idx":0,"min_ptcl_idx":min_ptcl_idx}
+
 	def execute(self,progress_callback=None):
 		if progress_callback==None: progress_callback=self.dummycb
 		if not progress_callback(0) : return None
 		refs,ptcls,shrink,mask = self.__init_memory(self.options)
+		if self.options.get("prune",0)>0 : return self.__execute_pruned(refs,ptcls,shrink,mask,progress_callback)
+		if not self.options.has_key("align") or self.options["align"][0]==None : cache=RefPrecompCache(self.options.get("refcachemem",256))		# shared by every particle in this task
+		else : cache=None
 
 
 		sim_data = {} # It's going to be our favorite thing, a dictionary of dictionaries
@@ -516,8 +647,8 @@ class EMSimTaskDC(JSTask):
 				min_ptcl_idx = ptcl_idx
 
 			if self.data.has_key("partial") :
-				sim_data[ptcl_idx] = self.__cmp_one_to_many(ptcls[ptcl_idx],refs,mask,[ii for ii in self.data["partial"] if ii[0]==ptcl_idx],progress_callback,i,n)
-			else : sim_data[ptcl_idx] = self.__cmp_one_to_many(ptcls[ptcl_idx],refs,mask,None,progress_callback,i,n)
+				sim_data[ptcl_idx] = self.__cmp_one_to_many(ptcls[ptcl_idx],refs,mask,[ii for ii in self.data["partial"] if ii[0]==ptcl_idx],progress_callback,i,n,cache)
+			else : sim_data[ptcl_idx] = self.__cmp_one_to_many(ptcls[ptcl_idx],refs,mask,None,progress_callback,i,n,cache)
 			i+=1
 			if not progress_callback(int(100*i/n)) : return None
 
@@ -602,6 +733,10 @@ def main():
 	parser.add_argument("--raligncmp",type=str,help="The name and parameters of the comparitor used by the second stage aligner. Default is dot.",default="dot")
 	parser.add_argument("--cmp",type=str,help="The name of a 'cmp' to be used in comparing the aligned images", default="dot:normalize=1")
 	parser.add_argument("--prefilt",action="store_true",help="Filter each reference (c) to match the power spectrum of each particle (r) before alignment and comparison",default=False)
+	parser.add_argument("--prune",type=int,help="Coarse-to-fine mode. Rank all references using a fast comparison of shrunken images, then fully align only the best N. Output is a sparse N column matrix, which e2classify.py can read. Requires --saveali, implies --parallel=thread:1 if not specified.",default=0)
+	parser.add_argument("--pruneshrink",type=int,help="Additional shrinking for the ranking stage of --prune. Default=2",default=2)
+	parser.add_argument("--prunecmp",type=str,help="The name of a 'cmp' for the ranking stage of --prune. Default is the same as --cmp",default=None)
+	parser.add_argument("--refcachemem",type=int,help="Memory (MB) each process may use to cache masks and Fourier transforms of the references (c) for reuse with every particle. Only used without --align. Default=256",default=256)
 	parser.add_argument("--mask",type=str,help="File containing a single mask image to apply after alignment, but before similarity comparison",default=None)
 	parser.add_argument("--colmasks",type=str,help="File containing one mask for each column (projection) image, to be used when refining row (particle) image alignments.",default=None)
 	parser.add_argument("--range",type=str,help="Range of images to process (c0,r0,c1,r1) c0,r0 inclusive c1,r1 exclusive", default=None)
@@ -641,6 +776,8 @@ def main():
 
 	E2n=E2init(sys.argv, options.ppid)
 
+	if options.prune>0 and not options.parallel : options.parallel="thread:1"		# the pruned mode is only implemented in EMParallelSimMX
+
 	if options.parallel:
 		parsimmx = EMParallelSimMX(options,args,E2n)
 		parsimmx.execute()
@@ -739,6 +876,8 @@ def main():
 	if options.mask==None : mask=None
 	else : mask=EMData(options.mask,0)
 
+	if options.align[0]==None : cache=RefPrecompCache(options.refcachemem)
+	else : cache=None
 	for r in range(*rrange):
 		if options.exclude and r in excl : continue
 
@@ -766,7 +905,7 @@ def main():
 		E2progress(E2n,float(r-rrange[0])/(rrange[1]-rrange[0]))
 		shrink = options.shrink
 		if options.verbose>1 : print "%d. "%r,
-		row=cmponetomany(cimgs,rimg,options.align,options.aligncmp,options.cmp, options.ralign, options.raligncmp,options.shrink,mask,subset,options.prefilt,options.verbose)
+		row=cmponetomany(cimgs,rimg,options.align,options.aligncmp,options.cmp, options.ralign, options.raligncmp,options.shrink,mask,subset,options.prefilt,options.verbose,cache)
 		for c,v in enumerate(row):
 			if v==None : mxout[0].set_value_at(c,r,0,-1.0e38)
 			else: mxout[0].set_value_at(c,r,0,v[0])
@@ -798,8 +937,21 @@ def main():
 
 	E2end(E2n)
 
-def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ralign=None, alircmp=("dot",{}),shrink=None,mask=None,subset=None,prefilt=False,verbose=0):
-	"""Compares one image (target) to a list of many images (reflist). Returns """
+def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ralign=None, alircmp=("dot",{}),shrink=None,mask=None,subset=None,prefilt=False,verbose=0,cache=None):
+	"""Compares one image (target) to a list of many images (reflist). Returns a list of (score,dx,dy,da,mirror,scale). If
+	a RefPrecompCache is provided, images derived from the references are kept there for reuse with the next target."""
+
+	if cache==None : cache=RefPrecompCache(0)
+
+	# anything which depends only on the target is computed once, rather than for each reference
+	if mask!=None :
+		ptcl2=target.copy()
+		ptcl2.mult(mask)
+	else : ptcl2=target
+	fftcmp=cmp_uses_fft(cmp)
+	if fftcmp :
+		if align[0] : targetf=ptcl2.do_fft()
+		else : targetf=target.do_fft()
 
 	ret=[None for i in reflist]
 #	target.write_image("dbug.hdf",-1)
@@ -810,13 +962,16 @@ def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ral
 			ret[i]=None
 			continue
 		if prefilt :
-			msk=r.process("threshold.notzero")					# mask from the projection
-			r[0]=r[0].process("filter.matchto",{"to":target})
-			r[0].mult(msk)											# remask after filtering
+			# the reference itself is never modified, so it can be reused for the next target
+			if r[1]==None : msk=cache.get((i,"notzero"),lambda:r[0].process("threshold.notzero"))	# mask from the projection
+			else : msk=r[1]
+			ref=r[0].process("filter.matchto",{"to":target})
+			ref.mult(msk)											# remask after filtering
+		else : ref=r[0]
 
 		if align[0] :
-			r[0].del_attr("xform.align2d")
-			ta=r[0].align(align[0],target,align[1],alicmp[0],alicmp[1])
+			ref.del_attr("xform.align2d")
+			ta=ref.align(align[0],target,align[1],alicmp[0],alicmp[1])
 			if verbose>3: print ta.get_attr("xform.align2d")
 			#ta.debug_print_params()
 
@@ -824,16 +979,16 @@ def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ral
 				if r[1]!=None :
 					#print "(single) using mask, and ",mask
 					ralign[1]["xform.align2d"] = ta.get_attr("xform.align2d").inverse()
-					r[0].del_attr("xform.align2d")
+					ref.del_attr("xform.align2d")
 					ralign[1]["mask"]=r[1]
-					alip = target.align(ralign[0],r[0],ralign[1],alircmp[0],alircmp[1])
-					ta=r[0].copy()
+					alip = target.align(ralign[0],ref,ralign[1],alircmp[0],alircmp[1])
+					ta=ref.copy()
 					ta.transform(alip["xform.align2d"].inverse())
 					ta["xform.align2d"]=alip["xform.align2d"].inverse()
 				else:
 					ralign[1]["xform.align2d"] = ta.get_attr("xform.align2d")
-					r[0].del_attr("xform.align2d")
-					ta = r[0].align(ralign[0],target,ralign[1],alircmp[0],alircmp[1])
+					ref.del_attr("xform.align2d")
+					ta = ref.align(ralign[0],target,ralign[1],alircmp[0],alircmp[1])
 
 				if verbose>3: print ta.get_attr("xform.align2d")
 
@@ -845,13 +1000,10 @@ def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ral
 			scale_correction = 1.0
 			if shrink != None: scale_correction = float(shrink)
 
-			if mask!=None :
-				ta.mult(mask)
-				ptcl2=target.copy()
-				ptcl2.mult(mask)
-				ret[i]=(ptcl2.cmp(cmp[0],ta,cmp[1]),scale_correction*p["tx"],scale_correction*p["ty"],p["alpha"],p["mirror"],p["scale"])
-			else:
-				ret[i]=(target.cmp(cmp[0],ta,cmp[1]),scale_correction*p["tx"],scale_correction*p["ty"],p["alpha"],p["mirror"],p["scale"])
+			if mask!=None : ta.mult(mask)
+			if fftcmp : score=targetf.cmp(cmp[0],ta.do_fft(),cmp[1])
+			else : score=ptcl2.cmp(cmp[0],ta,cmp[1])
+			ret[i]=(score,scale_correction*p["tx"],scale_correction*p["ty"],p["alpha"],p["mirror"],p["scale"])
 #			ta.write_image("dbug.hdf",-1)
 
 #				print ta["source_n"],target["source_n"]
@@ -863,7 +1015,11 @@ def cmponetomany(reflist,target,align=None,alicmp=("dot",{}),cmp=("dot",{}), ral
 
 
 		else :
-			ret[i]=(target.cmp(cmp[0],r[0],cmp[1]),0,0,0,1.0,False)
+			if fftcmp :
+				if prefilt : reff=ref.do_fft()
+				else : reff=cache.get((i,"fft"),lambda:ref.do_fft())
+				ret[i]=(targetf.cmp(cmp[0],reff,cmp[1]),0,0,0,1.0,False)
+			else : ret[i]=(target.cmp(cmp[0],ref,cmp[1]),0,0,0,1.0,False)
 
 		if verbose>2 : print ret[i][0],
 
@@ -951,6 +1107,22 @@ def check(options,verbose):
 				if ( check_eman2_type(options.raligncmp,Cmps,"Comparitor") == False ):
 					error = True
 
+	if options.prune>0 :
+		if not options.saveali :
+			if verbose>0:
+				print "Error: --prune produces a sparse matrix, and requires --saveali"
+			error = True
+		if options.fillzero or options.range!=None :
+			if verbose>0:
+				print "Error: --prune cannot be used with --fillzero or --range"
+			error = True
+		if options.pruneshrink<1 :
+			if verbose>0:
+				print "Error: --pruneshrink must be 1 or greater"
+			error = True
+		if options.prunecmp!=None and check_eman2_type(options.prunecmp,Cmps,"Comparitor") == False :
+			error = True
+
 	if hasattr(options,"parallel") and options.parallel != None:
   		if len(options.parallel) < 2:
   			print "The parallel option %s does not make sense" %options.parallel
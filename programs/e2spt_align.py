@@ -8,18 +8,39 @@ import threading
 import Queue
 from sys import argv,exit
 
-def alifn(jsd,fsp,i,a,options):
+def alifn(fsp,i,a,sym,saveali,verbose=0):
+	"""Aligns particle i in fsp to the (Fourier transformed, phase origin at corner) reference a. Returns the alignment
+	parameters, and if saveali is set, the aligned particle, so it needn't be reread from disk."""
 	t=time.time()
-	b=EMData(fsp,i).do_fft()
+	v=EMData(fsp,i)
+	b=v.do_fft()
 	b.process_inplace("xform.phaseorigin.tocorner")
 
 	# we align backwards due to symmetry
-	if options.verbose>2 : print "Aligning: ",fsp,i
-	c=a.xform_align_nbest("rotate_translate_3d_tree",b,{"verbose":0,"sym":options.sym,"sigmathis":0.1,"sigmato":0.1},1)
+	if verbose>2 : print "Aligning: ",fsp,i
+	c=a.xform_align_nbest("rotate_translate_3d_tree",b,{"verbose":0,"sym":sym,"sigmathis":0.1,"sigmato":0.1},1)
 	for cc in c : cc["xform.align3d"]=cc["xform.align3d"].inverse()
 
-	jsd.put((fsp,i,c[0]))
-	if options.verbose>1 : print "{}\t{}\t{}\t{}".format(fsp,i,time.time()-t,c[0]["score"])
+	if verbose>1 : print "{}\t{}\t{}\t{}".format(fsp,i,time.time()-t,c[0]["score"])
+
+	if saveali :
+		v.transform(c[0]["xform.align3d"])
+		return c[0],v
+	return c[0],None
+
+def aliworker(ptclq,jsd,fsp,ref,options):
+	"""Thread target. Aligns particles from the ptclq queue until it receives None. Results go into jsd"""
+	while 1:
+		i=ptclq.get()
+		if i==None : break
+		d,v=alifn(fsp,i,ref[i%2],options.sym,options.saveali,options.verbose)
+		jsd.put((fsp,i,d,v))
+
+def prepref(ref):
+	"""Returns a copy of a real-space reference prepared for alifn()"""
+	ret=ref.do_fft()
+	ret.process_inplace("xform.phaseorigin.tocorner")
+	return ret
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -30,7 +51,8 @@ This program will take an input stack of subtomograms and a reference volume, an
 
 	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
 
-	parser.add_argument("--threads", default=4,type=int,help="Number of alignment threads to run in parallel on a single computer. This is the only parallelism supported by e2spt_align at present.", guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="refinement")
+	parser.add_argument("--threads", default=4,type=int,help="Number of alignment threads to run in parallel on a single computer. Ignored if --parallel is specified.", guitype='intbox', row=24, col=2, rowspan=1, colspan=1, mode="refinement")
+	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:<option>=<value>:<option>=<value>. See http://blake.bcm.edu/emanwiki/EMAN2/Parallel",default=None)
 	parser.add_argument("--iter",type=int,help="Iteration number within path. Default = start a new iteration",default=0)
 	parser.add_argument("--goldstandard",type=float,help="If specified, will phase randomize the even and odd references past the specified resolution (in A, not 1/A)",default=0)
 	parser.add_argument("--goldcontinue",action="store_true",help="Will use even/odd refs corresponding to specified reference to continue refining without phase randomizing again",default=False)
@@ -77,47 +99,117 @@ This program will take an input stack of subtomograms and a reference volume, an
 			ref[0].write_image("{}/align_ref.hdf".format(options.path),0)
 			ref[1].write_image("{}/align_ref.hdf".format(options.path),1)
 
-	ref[0]=ref[0].do_fft()
-	ref[0].process_inplace("xform.phaseorigin.tocorner")
-	ref[1]=ref[1].do_fft()
-	ref[1].process_inplace("xform.phaseorigin.tocorner")
+	angs=js_open_dict("{}/particle_parms_{:02d}.json".format(options.path,options.iter),journal=True)	# one key per particle, so journaling avoids rewriting the whole file each time
+	N=EMUtil.get_image_count(args[0])
 
-	angs=js_open_dict("{}/particle_parms_{:02d}.json".format(options.path,options.iter))
-	jsd=Queue.Queue(0)
+	if options.parallel : results=runparallel(args[0],N,ref,options)
+	else : results=runthreads(args[0],N,ref,NTHREADS,options)
 
-	n=-1
-	N=EMUtil.get_image_count(args[0])
-	thrds=[threading.Thread(target=alifn,args=(jsd,args[0],i,ref[i%2],options)) for i in xrange(N)]
-
-	# here we run the threads and save the results, no actual alignment done here
-	print len(thrds)," threads"
-	thrtolaunch=0
-	while thrtolaunch<len(thrds) or threading.active_count()>1:
-		# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-		# note that it's ok that we wait here forever, since there can't be new results if an existing
-		# thread hasn't finished.
-		if thrtolaunch<len(thrds) :
-			while (threading.active_count()==NTHREADS ) : time.sleep(.1)
-			if options.verbose : print "Starting thread {}/{}".format(thrtolaunch,len(thrds))
-			thrds[thrtolaunch].start()
-			thrtolaunch+=1
-		else: time.sleep(1)
-	
-		while not jsd.empty():
-			fsp,n,d=jsd.get()
-			angs[(fsp,n)]=d
-			if options.saveali:
-				v=EMData(fsp,n)
-				v.transform(d["xform.align3d"])
-				v.write_image("{}/aliptcls.hdf".format(options.path),n)
+	# here we save the results as they arrive, no actual alignment done here
+	batch={}
+	lastflush=time.time()
+	for fsp,n,d,v in results:
+		batch[(fsp,n)]=d
+		if v!=None : v.write_image("{}/aliptcls.hdf".format(options.path),n)
 
+		# particle_parms is updated in batches, rather than after every particle
+		if len(batch)>=250 or time.time()-lastflush>30 :
+			angs.update(batch)
+			batch={}
+			lastflush=time.time()
 
-	for t in thrds:
-		t.join()
+	if len(batch)>0 : angs.update(batch)
+	angs.compact()		# so the .json file is complete on its own
 
 	E2end(logid)
 
 
+def runthreads(fsp,N,ref,nthreads,options):
+	"""Aligns all of the particles using a fixed pool of threads on this computer. This is a generator returning
+	(fsp,n,parms,aligned particle or None) for each particle as it finishes"""
+
+	ref=[prepref(ref[0]),prepref(ref[1])]
+
+	ptclq=Queue.Queue(0)
+	for i in xrange(N): ptclq.put(i)
+
+	jsd=Queue.Queue(nthreads*2)		# limits the number of aligned particles waiting to be written
+	thrds=[threading.Thread(target=aliworker,args=(ptclq,jsd,fsp,ref,options)) for i in xrange(nthreads-1)]
+	for t in thrds:
+		ptclq.put(None)		# one per thread, telling it to exit
+		t.start()
+
+	if options.verbose : print len(thrds)," threads"
+
+	nrecv=0
+	while nrecv<N:
+		try: r=jsd.get(True,1)
+		except Queue.Empty:
+			if max([t.is_alive() for t in thrds]) : continue
+			print "Error: alignment threads exited with {}/{} particles complete".format(nrecv,N)
+			sys.exit(1)
+		nrecv+=1
+		if options.verbose : print "{}/{} complete".format(nrecv,N)
+		yield r
+
+	for t in thrds:
+		t.join()
+
+def runparallel(fsp,N,ref,options):
+	"""Aligns all of the particles using the EMAN2PAR parallelism system. This is a generator returning
+	(fsp,n,parms,aligned particle or None) for each particle as its task finishes"""
+
+	from EMAN2PAR import EMTaskCustomer
+	etc=EMTaskCustomer(options.parallel)
+
+	# a few tasks per CPU, so results arrive steadily and the load stays balanced
+	step=max(1,min(100,N/(etc.cpu_est()*4)))
+	tasks=[SptAlignTask(fsp,i,min(i+step,N),ref,options) for i in xrange(0,N,step)]
+	tids=etc.send_tasks(tasks)
+	if options.verbose : print "{} tasks queued".format(len(tids))
+
+	nrecv=0
+	while len(tids)>0:
+		time.sleep(2)
+		proglist=etc.check_task(tids)
+		for i,prog in enumerate(proglist):
+			if prog==100 :
+				r=etc.get_results(tids[i])
+				for n,d,v in r[1]["results"]:
+					yield (fsp,n,d,v)
+				nrecv+=len(r[1]["results"])
+
+		tids=[j for i,j in enumerate(tids) if proglist[i]!=100]
+		if options.verbose : print "{}/{} complete".format(nrecv,N)
+
+from EMAN2jsondb import JSTask,jsonclasses
+class SptAlignTask(JSTask):
+	"""Aligns a range of particles to the even/odd references for the parallelism system"""
+
+	def __init__(self,fsp=None,first=0,last=0,ref=None,options=None):
+		if fsp==None : data=None
+		else : data={"particles":["cache",fsp,first,last],"ref":ref}
+		if options==None : opts=None
+		else : opts={"sym":options.sym,"saveali":options.saveali,"verbose":options.verbose}
+		JSTask.__init__(self,"SptAlign",data,opts)
+
+	def execute(self,callback=None):
+		from EMAN2PAR import image_range
+
+		fsp=self.data["particles"][1]
+		ref=[prepref(self.data["ref"][0]),prepref(self.data["ref"][1])]
+		ptcls=list(image_range(*self.data["particles"][2:]))
+
+		ret=[]
+		for j,i in enumerate(ptcls):
+			d,v=alifn(fsp,i,ref[i%2],self.options["sym"],self.options["saveali"],self.options["verbose"])
+			ret.append((i,d,v))
+			if callback!=None : callback(100*(j+1)/len(ptcls))
+
+		return {"results":ret}
+
+jsonclasses["SptAlignTask"]=SptAlignTask.from_jsondict
+
 if __name__ == "__main__":
 	main()
 
@@ -72,6 +72,14 @@ def main():
 	parser.add_argument("--pad", action='store_true', help="""Provide this if the particles in the --particlestack used to create a template, or the template supplied 
 															through --template are in a tight box. The size""",default=False)
 	parser.add_argument("--rotsearch", action='store_true', help="""At each translation position, vary euler angles as well when searching for particles.""",default=False)
+
+	parser.add_argument("--rotstep", type=float, default=30.0, help="""Default=30. Angular step in degrees between the template orientations searched when --rotsearch and --tiledscan are provided.""")
+
+	parser.add_argument("--tiledscan", action='store_true', default=False, help="""Default=False. Correlate the template against the entire tomogram in tiles with FFTs (overlap-save), 
+		keeping the best score and orientation for every voxel, instead of scanning overlapping cubical subregions one at a time. 
+		Tiles are processed in parallel by the number of threads in --parallel. The best score and orientation maps are written to scanscores_NN.hdf and scanorients_NN.hdf in --path, one image per tile.""")
+
+	parser.add_argument("--scanmem", type=int, default=2048, help="""Default=2048. Approximate memory limit in MB for --tiledscan, used to determine the size of the tiles.""")
 	
 	parser.add_argument('--tiltangles',type=str,default='',help="""File in .tlt or .txt format containing the tilt angle of each tilt image in the tiltseries.""")
 	
@@ -295,7 +303,8 @@ def main():
 	'''
 	c:determine cubical subregions/subblocks to divide the tomogram into
 	'''
-	tomochunkscenters = tomosubblocks( options, boxsize )
+	if not options.tiledscan:
+		tomochunkscenters = tomosubblocks( options, boxsize )
 	
 
 	
@@ -339,7 +348,10 @@ def main():
 	dataf = []
 	
 	for i in range( n ):
-		datas = scanchunks( options, tomochunkscenters, i )		#c:this should return a list of lists [ [score1,x1,y1,z1],[score2,x2,y2,z2], ...,[score3,xn,yn,zn] ]
+		if options.tiledscan:
+			datas = scantomogram( options, i )
+		else:
+			datas = scanchunks( options, tomochunkscenters, i )		#c:this should return a list of lists [ [score1,x1,y1,z1],[score2,x2,y2,z2], ...,[score3,xn,yn,zn] ]
 		
 		#print "scanchunks returned",datan
 		#print "scanchunks returned"
@@ -1552,6 +1564,289 @@ def scanchunks( options, centers, templateindx ):
 	return results
 
 
+'''
+c:tiled whole-tomogram template matching. the tomogram is divided into tiles in x,y (full thickness in z) 
+c:and each tile is read with a halo of half the template box on every side (overlap-save), so every voxel 
+c:of the tomogram is correlated exactly once for each template orientation, and tiles are processed by a pool of threads
+'''
+def scantomogram( options, templateindx ):
+	
+	import threading
+	import Queue
+	
+	if options.rotsearch:
+		template = EMData( options.template, templateindx )
+	else:
+		template = EMData( options.template.replace('.hdf','_sph.hdf'), 0 )
+	
+	box = template['nx']
+	
+	radius = box/4	#assuming the particle/template is in a box of 2x its diameter, 4x its radius
+	if options.ptclradius:
+		radius = options.ptclradius
+	elif options.boxsize:
+		radius = options.boxsize/4
+	
+	'''
+	c:orientations to search; only the identity for the spherically averaged template
+	'''
+	orients = [ Transform() ]
+	if options.rotsearch:
+		orients = OrientGens.get( 'eman', {'delta':options.rotstep,'inc_mirror':True} ).gen_orientations( Symmetries.get('c1') )
+	
+	nthreads = 1
+	if options.parallel and options.parallel.lower() != 'none':
+		if options.parallel.split(':')[0] == 'thread':
+			nthreads = int( options.parallel.split(':')[1] )
+		else:
+			import multiprocessing
+			nthreads = multiprocessing.cpu_count()
+	
+	tomohdr = EMData( options.tomogram, 0, True )
+	dims = ( tomohdr['nx'], tomohdr['ny'], tomohdr['nz'] )
+	
+	tiles, pdims, cache = scantiles( options, dims, box, len(orients), nthreads )
+	
+	print "\nscanning the tomogram in %d tiles of %d x %d x %d voxels (with halo) using %d threads and %d orientations" %( len(tiles), pdims[0], pdims[1], pdims[2], nthreads, len(orients) )
+	
+	ptclvol = (4.0/3.0)* math.pi *math.pow(radius,3)
+	
+	clamp = None
+	if options.goldthreshtomo and options.goldstack:
+		ret = meancalc( options, options.goldstack )
+		clamp = ( ret[0] - 30 * ret[1], ret[2] + 5 * math.fabs(ret[3]) )
+	
+	'''
+	c:template ffts are the same for every tile, since all tiles are padded to the same size; keep them if they fit in --scanmem
+	'''
+	tfts = [ None ] * len(orients)
+	if cache:
+		for o in range( len(orients) ):
+			tfts[o] = scantemplate( template, orients[o], pdims )
+	
+	iolock = threading.Lock()
+	jobs = Queue.Queue(0)
+	results = Queue.Queue(0)
+	thrds = [ threading.Thread( target=scanworker, args=( jobs, results, options, dims, pdims, template, orients, tfts, clamp, radius, ptclvol, iolock ) ) for i in range(nthreads) ]
+	for t in thrds: t.start()
+	
+	for tile in tiles: jobs.put( tile )
+	
+	scoresname = options.path + '/scanscores_' + str(templateindx).zfill(2) + '.hdf'
+	orientsname = options.path + '/scanorients_' + str(templateindx).zfill(2) + '.hdf'
+	
+	peaks = []
+	for i in range( len(tiles) ):
+		tile, ret = results.get()
+		if ret == None:
+			print "\nERROR: scanning failed on tile", tile
+			for t in thrds: jobs.put( None )
+			sys.exit(1)
+		
+		best, bestorient, tilepeaks = ret
+		
+		n = tiles.index( tile )
+		best.write_image( scoresname, n )
+		bestorient.write_image( orientsname, n )
+		
+		peaks += tilepeaks
+		
+		if options.verbose:
+			print "tile %d/%d done, %d peaks" %( i+1, len(tiles), len(tilepeaks) )
+	
+	for t in thrds: jobs.put( None )
+	for t in thrds: t.join()
+	
+	'''
+	c:exclude peaks too close to the edges of the tomogram, and outside the grid hole mask if one was specified
+	'''
+	xo = yo = 0
+	if options.gridoffset:
+		xo = int(options.gridoffset.split(',')[0])
+		yo = int(options.gridoffset.split(',')[-1])
+	
+	lines = []
+	data = []
+	for p in peaks:
+		score, x, y, z, o = p
+		if x < 2*radius or x > dims[0] - 2*radius or y < 2*radius or y > dims[1] - 2*radius or z < radius or z > dims[2] - radius:
+			continue
+		
+		if options.mask and options.gridradius:
+			dist = math.sqrt( math.pow( x - (xo + dims[0]/2), 2 ) + math.pow( y - (yo + dims[1]/2), 2 ) ) 
+			if dist > options.gridradius:
+				continue
+		
+		data.append( [score,x,y,z] )
+		
+		rot = orients[o].get_rotation('eman')
+		lines.append( '%f %d %d %d %f %f %f\n' %( score, x, y, z, rot['az'], rot['alt'], rot['phi'] ) )
+	
+	f = open( options.path + '/scanpeaks_' + str(templateindx).zfill(2) + '.txt', 'w' )
+	f.writelines( lines )
+	f.close()
+	
+	print "\nfound %d peaks scanning the tomogram; %d remain after excluding edges and masked regions" %( len(peaks), len(data) )
+	
+	return data
+
+
+'''
+c:function to determine the tiles to divide the tomogram into for scantomogram(). 
+c:returns a list of (x0,y0,nx,ny) tile cores, the padded tile size, and whether template ffts can be cached
+'''
+def scantiles( options, dims, box, norients, nthreads ):
+	
+	halo = box/2
+	pz = good_size( dims[2] + 2*halo )
+	
+	'''
+	c:each thread holds the padded tile, its fft, one ccf, and the best score and orientation maps for the core
+	'''
+	def tilemem( pxy ):
+		return 4 * 6 * pxy * pxy * pz
+	
+	maxbytes = options.scanmem * 1048576
+	
+	pxy = good_size( max( dims[0], dims[1] ) + 2*halo )
+	while pxy > good_size( 2*box ) and nthreads * ( tilemem( pxy ) + 4*pxy*pxy*pz ) > maxbytes:
+		pxy = good_size( max( pxy/2, 2*box ) )
+	
+	if nthreads * ( tilemem( pxy ) + 4*pxy*pxy*pz ) > maxbytes:
+		print "\nWARNING: unable to fit scanning within --scanmem; reduce the number of threads through --parallel"
+	
+	cache = nthreads * tilemem( pxy ) + norients * 4 * ( pxy + 2 ) * pxy * pz <= maxbytes
+	
+	core = pxy - 2*halo
+	
+	tiles = []
+	for x0 in range( 0, dims[0], core ):
+		for y0 in range( 0, dims[1], core ):
+			tiles.append( ( x0, y0, min( core, dims[0]-x0 ), min( core, dims[1]-y0 ) ) )
+	
+	return tiles, ( pxy, pxy, pz ), cache
+
+
+'''
+c:rotate the template, pad it to the size of the tiles and compute its fft
+'''
+def scantemplate( template, orient, pdims ):
+	
+	t = template.copy()
+	t.transform( orient )
+	
+	box = t['nx']
+	t = t.get_clip( Region( (box-pdims[0])/2, (box-pdims[1])/2, (box-pdims[2])/2, pdims[0], pdims[1], pdims[2] ) )
+	
+	return t.do_fft()
+
+
+'''
+c:thread processing tiles from jobs until it receives None
+'''
+def scanworker( jobs, results, options, dims, pdims, template, orients, tfts, clamp, radius, ptclvol, iolock ):
+	import traceback
+	
+	while True:
+		tile = jobs.get()
+		if tile == None: 
+			return
+		try: 
+			results.put( ( tile, scantile( tile, options, dims, pdims, template, orients, tfts, clamp, radius, ptclvol, iolock ) ) )
+		except:
+			traceback.print_exc()
+			results.put( ( tile, None ) )
+
+
+'''
+c:correlate one tile against every template orientation, keeping the best score and orientation for each voxel in the tile core,
+c:then pick peaks from the best score map the same way scanchunks() does from each ccf
+'''
+def scantile( tile, options, dims, pdims, template, orients, tfts, clamp, radius, ptclvol, iolock ):
+	
+	x0, y0, nx, ny = tile
+	nz = dims[2]
+	halo = template['nx']/2
+	
+	'''
+	c:read the tile with its halo; only the part inside the tomogram is read, and the rest is filled with the mean
+	'''
+	rx0 = max( x0-halo, 0 )
+	ry0 = max( y0-halo, 0 )
+	rx1 = min( x0+pdims[0]-halo, dims[0] )
+	ry1 = min( y0+pdims[1]-halo, dims[1] )
+	
+	sub = EMData()
+	with iolock: 
+		sub.read_image( options.tomogram, 0, False, Region( rx0, ry0, 0, rx1-rx0, ry1-ry0, nz ) )
+	
+	if clamp:
+		sub.process_inplace( 'threshold.clampminmax', {'maxval':clamp[0],'minval':clamp[1]} )
+	
+	sub = sub.get_clip( Region( x0-halo-rx0, y0-halo-ry0, -halo, pdims[0], pdims[1], pdims[2] ), sub['mean'] )
+	
+	best = numpy.empty( (nz,ny,nx), numpy.float32 )
+	best.fill( -numpy.inf )
+	bestorient = numpy.zeros( (nz,ny,nx), numpy.int32 )
+	
+	if not sub['sigma']:
+		print "\nthere's something wrong with tile", tile, "and it will be skipped; you might be scanning empty regions of the tomogram."
+		return EMNumPy.numpy2em( best ), EMNumPy.numpy2em( bestorient.astype( numpy.float32 ) ), []
+	
+	subfft = sub.do_fft()
+	sub = None
+	
+	for o in range( len(orients) ):
+		tfft = tfts[o]
+		if tfft == None:
+			tfft = scantemplate( template, orients[o], pdims )
+		
+		ccf = subfft.copy().calc_ccf( tfft )
+		ccf.process_inplace( 'xform.phaseorigin.tocorner' ) 
+		ccf.process_inplace( 'normalize' )
+		
+		c = EMNumPy.em2numpy( ccf )[ halo:halo+nz, halo:halo+ny, halo:halo+nx ]
+		better = c > best
+		best[better] = c[better]
+		bestorient[better] = o
+		ccf = None
+	
+	'''
+	c:iterate through the likely number of particles in the tile, zeroing out a sphere of one particle radius around each peak
+	'''
+	npeaks = max( int( nx*ny*nz / ptclvol ) / max( options.dilutionfactor, 1 ), 1 )
+	if options.test:
+		npeaks = 1
+	
+	r = int( math.ceil( radius ) )
+	zz, yy, xx = numpy.ogrid[ -r:r+1, -r:r+1, -r:r+1 ]
+	sphere = xx*xx + yy*yy + zz*zz <= radius*radius
+	
+	search = best.copy()
+	peaks = []
+	for p in range( npeaks ):
+		i = search.argmax()
+		score = search.flat[i]
+		if score == -numpy.inf:
+			break
+		
+		z, y, x = numpy.unravel_index( i, search.shape )
+		peaks.append( [ float(score), x0+x, y0+y, z, int( bestorient[z,y,x] ) ] )
+		
+		za, ya, xa = max( z-r, 0 ), max( y-r, 0 ), max( x-r, 0 )
+		zb, yb, xb = min( z+r+1, nz ), min( y+r+1, ny ), min( x+r+1, nx )
+		m = sphere[ za-z+r:zb-z+r, ya-y+r:yb-y+r, xa-x+r:xb-x+r ]
+		search[ za:zb, ya:yb, xa:xb ][m] = -numpy.inf
+	
+	bestimg = EMNumPy.numpy2em( best )
+	bestorientimg = EMNumPy.numpy2em( bestorient.astype( numpy.float32 ) )
+	for img in ( bestimg, bestorientimg ):
+		img['scan_tile_origin'] = [ x0, y0, 0 ]
+		img['apix_x'] = img['apix_y'] = img['apix_z'] = template['apix_x']
+	
+	return bestimg, bestorientimg, peaks
+
+
 '''
 c:function to prune picked particles by distance to one another (RMSD)
 '''
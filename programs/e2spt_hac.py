@@ -35,6 +35,7 @@ from EMAN2 import *
 
 import os
 import sys
+import hashlib
 from EMAN2jsondb import JSTask,jsonclasses
 
 from e2spt_classaverage import alignment
@@ -69,6 +70,10 @@ def main():
 	
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="""Default=0. Verbose level [0-9], higner number means higher level of verboseness""")
 		
+	parser.add_argument("--pairstore",type=str,default='',help="""Default=None (pairscores.json in --path). .json file storing the score and transform of every pair of particles aligned. Pass the file from an earlier (possibly interrupted) run with the same input and alignment options to reuse its alignments instead of recomputing them.""")
+
+	parser.add_argument("--pairbatch",type=int,default=0,help="""Default=0 (automatic). Number of particle pairs aligned by each parallel task. Larger batches reduce per-task overhead.""")
+
 	#parser.add_argument("--resume",type=str,default='',help="""(Not working currently). tomo_fxorms.json file that contains alignment information for the particles in the set. If the information is incomplete (i.e., there are less elements in the file than particles in the stack), on the first iteration the program will complete the file by working ONLY on particle indexes that are missing. For subsequent iterations, all the particles will be used.""")
 															
 	parser.add_argument("--plots", action='store_true', default=False,help="""Default=False. Turn this option on to generatea plot of the ccc scores during each iteration. Running on a cluster or via ssh remotely might not support plotting.""")
@@ -577,6 +582,7 @@ def allvsall(options):
 											#The totalTransform needs to be calculated for each particle after each round, to avoid multiple interpolations
 	
 	print "\n(e2spt_hac.py) Preparing particle headers"
+	ptcltags = js_open_dict(options.path + '/ptcl_tags.json')
 	for i in range(nptcl):								#In the first round, all the particles in the input stack are "new" and should have an identity transform associated to them
 		a=EMData(options.input,i)
 		totalt=Transform()
@@ -609,13 +615,14 @@ def allvsall(options):
 		#print "spt_dendoID has been set to", spt_dendoID
 		#print "for the particle it is", a['spt_dendoID']
 			
-		a.write_image(options.input,i)						#Overwrite the raw stack with one that has the appropriate header parameters set to work with e2spt_hac	
+		ptcltags.setval(str(i),{'spt_multiplicity':a['spt_multiplicity'],'spt_ptcl_indxs':a['spt_ptcl_indxs'],'spt_ID':particletag,'spt_dendoID':spt_dentoID_orig},True)	#Tags are recorded in a sidecar file rather than by rewriting the raw stack
 		
 		allptclsRound.update({particletag : [a,{i:totalt}]})			
 		
 		if options.verbose:
 			print "\n ptcl %d/%d done" %( i, nptcl )
-		
+	
+	ptcltags.sync()
 		
 	oldptcls = {}									#'Unused' particles (those that weren't part of any unique-best-pair) join the 'oldptcls' dictionary onto the next round
 	surviving_results = []							#This list stores the results for previous alignment pairs that weren't used, so you don't have to recompute them
@@ -624,14 +631,17 @@ def allvsall(options):
 	allptclsMatrix.append(allptclsRound)
 	
 	
-	FinalAliStack = {}								#This will keep track of the most updated alignment state of ALL particles regardless of whether they've participated 
-													#in averages or not.
+	FinalAliStack = {}								#This will keep track of the most updated alignment transform of ALL particles regardless of whether they've participated 
+													#in averages or not. The aligned particles are only generated when final_ali_stack.hdf is written.
 													
-	nptcls = EMUtil.get_image_count(options.input)
+	nptcls = nptcl
 	for i in range(nptcls):
-		rawptcl = EMData(options.input,i)
-		rawptcl['xform.alignd3d']=Transform()
-		FinalAliStack.update({i:rawptcl})
+		FinalAliStack.update({i:Transform()})
+	
+	if options.pairstore:
+		pairstore = PairStore(options.pairstore,options)
+	else:
+		pairstore = PairStore(options.path + '/pairscores.json',options)
 	
 	maxScore = 1
 	absoluteMaxScore = 1
@@ -672,7 +682,9 @@ def allvsall(options):
 					print "\n(e2spt_hac.py) (allvsall) Saving aligned particles"
 			
 				for key in FinalAliStack:
-					aliptcl = FinalAliStack[key]
+					aliptcl = EMData(options.input,key)
+					aliptcl.transform(FinalAliStack[key])
+					aliptcl['xform.align3d']=FinalAliStack[key]
 					aliptcl.write_image(options.path + '/final_ali_stack.hdf',key)
 					#print "Wrote this ptcl to final stack", key
 		
@@ -694,7 +706,7 @@ def allvsall(options):
 			etc=EMTaskCustomer(options.parallel)
 			pclist=[options.input]
 			etc.precache(pclist)
-		tasks = []
+		pairs = []								#(fixed stack, moving stack, pair description) for each comparison in this round
 		
 		'''
 		Make ALL vs ALL comparisons among all NEW particle INDEXES.
@@ -718,12 +730,7 @@ def allvsall(options):
 				
 				#def __init__(self,fixedimagestack,imagestack,comparison, ptcl1, ptcl2, p1n, p2n,label,options,transform):
 				
-				task = Align3DTaskAVSA(newstack,newstack, jj, reftag, particletag, ptcl1, ptcl2,"Aligning particle#%s VS particle#%s in iteration %d" % (reftag,particletag,k),options,k,iters)
-
-				#task = Align3DTaskAVSA(newstack,newstack, jj, reftag, particletag, ptcl1, ptcl2,"Aligning particle#%s VS particle#%s in iteration %d" % (reftag,particletag,k),options.mask,options.normproc,options.preprocess,options.lowpass,options.highpass,
-				#options.npeakstorefine,options.align,options.aligncmp,options.falign,options.faligncmp,options.shrink,options.shrinkfine,options.verbose-1)
-				
-				tasks.append(task)
+				pairs.append((newstack,newstack,{"comparison":jj,"ptclA":reftag,"ptclB":particletag,"pAn":ptcl1,"pBn":ptcl2,"label":"Aligning particle#%s VS particle#%s in iteration %d" % (reftag,particletag,k)}))
 				
 				jj+=1
 		
@@ -755,19 +762,38 @@ def allvsall(options):
 					#task = Align3DTaskAVSA( newstack, options.path + '/oldptclstack.hdf', jj , refkey, particlekey, ptcl1, ptcl2,"Aligning particle round#%d_%d VS particle#%s, in iteration %d" % (k,ptcl1,particlekey.split('_')[0] + str(ptcl2),k),options.mask,options.normproc,options.preprocess,options.lowpass,options.highpass,
 					#options.npeakstorefine,options.align,options.aligncmp,options.falign,options.faligncmp,options.shrink,options.shrinkfine,options.verbose-1)
 					
-					task = Align3DTaskAVSA( newstack, options.path + '/oldptclstack.hdf', jj , refkey, particlekey, ptcl1, ptcl2,"Aligning particle round#%d_%d VS particle#%s, in iteration %d" % (k,ptcl1,particlekey.split('_')[0] + '_' + str(ptcl2),k),options,k,iters)
-					
-					
-					tasks.append(task)
+					pairs.append((newstack,options.path + '/oldptclstack.hdf',{"comparison":jj,"ptclA":refkey,"ptclB":particlekey,"pAn":ptcl1,"pBn":ptcl2,"label":"Aligning particle round#%d_%d VS particle#%s, in iteration %d" % (k,ptcl1,particlekey.split('_')[0] + '_' + str(ptcl2),k)}))
 										
 					jj+=1
 				nnn+=1	
 		
+		'''
+		Pairs aligned in earlier rounds or runs are taken from the pair store, the rest are aligned in batches
+		'''
+		results = []
+		pending = []
+		for fixedstack,stack,pair in pairs:
+			r = pairstore.lookup(allptclsMatrix[k][pair['ptclA']],allptclsMatrix[k][pair['ptclB']])
+			if r:
+				r['ptclA'] = pair['ptclA']
+				r['ptclB'] = pair['ptclB']
+				results.append(r)
+			else:
+				pending.append((fixedstack,stack,pair))
+		
+		print "%d comparisons in iteration %d, %d found in the pair store"%(len(pairs),k,len(results))
+		
+		tasks = pair_batches(pending,options,k,iters,etc.cpu_est())
 		tids=etc.send_tasks(tasks)						#Start the alignments running
 		#if options.verbose > 0: 
 		print "%d tasks queued in iteration %d"%(len(tids),k) 
 		
-		results = get_results(etc,tids,options.verbose)				#Wait for alignments to finish and get results
+		newresults = get_results(etc,tids,options.verbose)				#Wait for alignments to finish and get results
+		for r in newresults:
+			pairstore.store(allptclsMatrix[k][r['ptclA']],allptclsMatrix[k][r['ptclB']],r)
+		pairstore.sync()
+		
+		results = results + newresults
 		
 		#results = ret[0]
 		results = results + surviving_results						#The total results to process/analyze includes results (comparisons) from previous rounds that were not used
@@ -1058,10 +1084,7 @@ def allvsall(options):
 					if options.saveali:
 						avg_ptcls.append(subp1)
 				
-						subp1_forFinalAliStack =subp1.copy()							#It would be insane to write out ALL the particles in each iteration in the final aligned state
-						subp1_forFinalAliStack['xform.align3d']=pastt
-						
-						FinalAliStack.update({int(p):subp1_forFinalAliStack})		#But let's keep track of them, and write them out only when the LAST iteration has been reached
+						FinalAliStack.update({int(p):pastt})		#The aligned particles are only generated when the LAST iteration has been reached
 						print "I have CHANGED a particle1 in final_ali_stack to have this transform", totalt
 
 					indx_trans_pairs.update({p:pastt})
@@ -1126,10 +1149,7 @@ def allvsall(options):
 					if options.saveali:
 						avg_ptcls.append(subp2)
 
-						subp2_forFinalAliStack =subp2.copy()							#It would be insane to write out ALL the particles in each iteration in the final aligned state
-						subp2_forFinalAliStack['xform.align3d']=totalt
-						
-						FinalAliStack.update({int(p):subp2_forFinalAliStack})			#But let's keep track of them, and write them out only when the LAST iteration has been reached			
+						FinalAliStack.update({int(p):totalt})		#The aligned particles are only generated when the LAST iteration has been reached
 						print "I have CHANGED a particle2 in final_ali_stack to have this transform", totalt
 
 					indx_trans_pairs.update({p:totalt})
@@ -1179,10 +1199,7 @@ def allvsall(options):
 						avg_ptcls.append(subp1)
 						
 						if options.saveali:	
-							subp1_forFinalAliStack =subp1.copy()							#It would be insane to write out ALL the particles in each iteration in the final aligned state
-							subp1_forFinalAliStack['xform.align3d']=totalt
-							
-							FinalAliStack.update({int(p):subp1_forFinalAliStack})		#But let's keep track of them, and write them out only when the LAST iteration has been reached
+							FinalAliStack.update({int(p):totalt})		#The aligned particles are only generated when the LAST iteration has been reached
 							print "After AUTOCENTER have CHANGED a particle1 in final_ali_stack to have this transform", totalt
 
 					
@@ -1198,10 +1215,7 @@ def allvsall(options):
 						avg_ptcls.append(subp2)
 						
 						if options.saveali:
-							subp2_forFinalAliStack =subp2.copy()							#It would be insane to write out ALL the particles in each iteration in the final aligned state
-							subp2_forFinalAliStack['xform.align3d']=totalt
-							
-							FinalAliStack.update({int(p):subp2_forFinalAliStack})		#But let's keep track of them, and write them out only when the LAST iteration has been reached
+							FinalAliStack.update({int(p):totalt})		#The aligned particles are only generated when the LAST iteration has been reached
 							print "After AUTOCENTER I have CHANGED a particle2 in final_ali_stack to have this transform", totalt
 				
 				#if options.sym != 'c1' and options.sym !='C1' and not options.breaksym:
@@ -1445,7 +1459,7 @@ def get_results(etc,tids,verbose):
 	
 	# wait for them to finish and get the results
 	# results for each will just be a list of (qual,Transform) pairs
-	results=[0]*len(tids)		# storage for results
+	results={}		# storage for results, keyed by comparison number
 	ncomplete=0
 	
 	tidsleft=tids[:]
@@ -1463,12 +1477,20 @@ def get_results(etc,tids,verbose):
 			
 			if prog==100:
 				r=etc.get_results(tidsleft[i])						# results for a completed task
-				comparison=r[0].classoptions["comparison"]					# get the comparison number from the task rather than trying to work back to it
-				
-				results[comparison]=r[1]["final"][0]					# this will be a list of (qual,Transform), containing the BEST peak ONLY
-				
-				results[comparison]['ptclA']=r[0].classoptions['ptclA']			#Associate the result with the pair of particles involved
-				results[comparison]['ptclB']=r[0].classoptions['ptclB']
+				if 'pairs' in r[0].classoptions:
+					pairs=r[0].classoptions['pairs']				# a batch of comparisons
+					finals=r[1]["final"]
+				else:
+					pairs=[r[0].classoptions]
+					finals=[r[1]["final"]]
+				
+				for pair,final in zip(pairs,finals):
+					comparison=pair["comparison"]					# get the comparison number from the task rather than trying to work back to it
+					
+					results[comparison]=final[0]					# this will be a list of (qual,Transform), containing the BEST peak ONLY
+					
+					results[comparison]['ptclA']=pair['ptclA']			#Associate the result with the pair of particles involved
+					results[comparison]['ptclB']=pair['ptclB']
 
 				ncomplete+=1
 		
@@ -1484,7 +1506,63 @@ def get_results(etc,tids,verbose):
 	
 	print "\n(e2spt_hac.py)(get_results) Exiting get_results function"
 
-	return results
+	return [results[c] for c in sorted(results)]
+
+
+class PairStore:
+	"""Disk-backed store of pairwise alignment results (score and transform). A particle is identified by the raw particles
+	it contains and the transforms applied to them, so results can be reused by later rounds and by later runs on the same
+	input with the same alignment options."""
+	
+	optionkeys = ('align','aligncmp','falign','faligncmp','mask','maskfile','normproc','threshold','preprocess','preprocessfine',
+		'lowpass','lowpassfine','highpass','highpassfine','shrink','shrinkfine','npeakstorefine','radius','precision','search',
+		'searchfine','sym','breaksym','clip','matchimgs','filterbyfsc','procfinelikecoarse','randomizewedge','tweak','averager','autocenter')
+	
+	def __init__(self,filename,options):
+		from EMAN2jsondb import file_content_id
+		self.db = js_open_dict(filename)
+		sig = repr([getattr(options,key,None) for key in self.optionkeys]) + repr(file_content_id(options.input))
+		self.sig = hashlib.md5(sig).hexdigest()[:16]
+	
+	def key(self,infoA,infoB):
+		"""infoA and infoB are [particle,{raw index:transform}] entries, as stored in allptclsMatrix"""
+		ident = []
+		for info in (infoA,infoB):
+			ident.append( ';'.join( '%d:%s' % ( i, ','.join('%.3f'%x for x in info[-1][i].get_matrix()) ) for i in sorted(info[-1]) ) )
+		
+		return self.sig + '_' + hashlib.md5( ident[0] + '|' + ident[1] ).hexdigest()
+	
+	def lookup(self,infoA,infoB):
+		"""Returns a new result dictionary, or None if this pair has not been aligned"""
+		r = self.db.getdefault(self.key(infoA,infoB),None)
+		if r: r = dict(r)
+		return r
+	
+	def store(self,infoA,infoB,result):
+		self.db.setval( self.key(infoA,infoB), {'score':result['score'],'xform.align3d':result['xform.align3d']}, True )
+	
+	def sync(self):
+		self.db.sync()
+
+
+def pair_batches(pending,options,round,iters,ncpu=1):
+	"""Groups (fixed stack, moving stack, pair) comparisons into Align3DTaskAVSABatch tasks"""
+	
+	bystacks = {}
+	for fixedstack,stack,pair in pending:
+		bystacks.setdefault((fixedstack,stack),[]).append(pair)
+	
+	batch = options.pairbatch
+	if batch <= 0:
+		batch = max( 1, int( ceil( len(pending) / ( ncpu * 4.0 ) ) ) )		#About 4 tasks per cpu, for load balancing
+	
+	tasks = []
+	for (fixedstack,stack),pairs in bystacks.items():
+		pairs.sort(key=lambda p:p['pAn'])		#Align3DTaskAVSABatch keeps only the current fixed volume
+		for i in xrange(0,len(pairs),batch):
+			tasks.append( Align3DTaskAVSABatch( fixedstack, stack, pairs[i:i+batch], options, round, iters ) )
+	
+	return tasks
 
 
 class Align3DTaskAVSA(JSTask):
@@ -1522,28 +1600,70 @@ class Align3DTaskAVSA(JSTask):
 		fixedimage = EMData( self.data["fixedimage"], classoptions['pAn'] )
 		image = EMData( self.data["image"], classoptions['pBn'] )
 		
-		nptcls = EMUtil.get_image_count( classoptions['options'].input )
-		
-		if classoptions['options'].groups:
-			nptcls = ( nptcls / int(classoptions['options'].groups) ) + nptcls % int(classoptions['options'].groups)
-		
-		potentialcomps = ( nptcls * (nptcls - 1) )/ 2
-		
-		xformslabel = 'round' + str(classoptions['round']).zfill( len( str( classoptions['iters']))) + '_comparison' + str(classoptions['comparison']).zfill( len( str(potentialcomps) ) ) + '_ptclA' + str(classoptions['pAn']).zfill( len(str(nptcls))) + '_ptclB' + str(classoptions['pBn']).zfill( len(str(nptcls)))
+		return align_pair( fixedimage, image, classoptions )
+
+
+def align_pair( fixedimage, image, classoptions ):
+	"""Aligns image to fixedimage for one comparison, described by a classoptions dictionary as used by Align3DTaskAVSA"""
+	
+	nptcls = EMUtil.get_image_count( classoptions['options'].input )
+	
+	if classoptions['options'].groups:
+		nptcls = ( nptcls / int(classoptions['options'].groups) ) + nptcls % int(classoptions['options'].groups)
+	
+	potentialcomps = ( nptcls * (nptcls - 1) )/ 2
+	
+	xformslabel = 'round' + str(classoptions['round']).zfill( len( str( classoptions['iters']))) + '_comparison' + str(classoptions['comparison']).zfill( len( str(potentialcomps) ) ) + '_ptclA' + str(classoptions['pAn']).zfill( len(str(nptcls))) + '_ptclB' + str(classoptions['pBn']).zfill( len(str(nptcls)))
+	
+	refpreprocess=1
+	
+	print "\n(e2spt_hac.py)(Align3DTaskAVSA) Will call alignment function"
+	ret=alignment( fixedimage, image, classoptions['label'], classoptions['options'],xformslabel,classoptions['round'],None,'e2spt_hac',refpreprocess)
+			
+	#ret=alignment(fixedimage,image,classoptions['label'],classoptions['options'],xformslabel,classoptions['currentIter'],classoptions['transform'],'e2spt_classaverage',refpreprocess)
+
+	print "\n(e2spt_hac.py)(Align3DTaskAVSA) Done with alignment, back in e2spt_hac.py."
+	
+	bestfinal=ret[0]
+	bestcoarse=ret[1]
+	
+	return {"final":bestfinal,"coarse":bestcoarse}
+
+
+class Align3DTaskAVSABatch(JSTask):
+	"""Aligns a batch of particle pairs from the same two stacks in a single task. Pairs are ordered by the fixed particle,
+	so each fixed volume is read once; moving volumes are read for each pair, so only two volumes are held at a time"""
+	
+	def __init__(self,fixedimagestack,imagestack,pairs,options,round,iters):
 		
-		refpreprocess=1
+		data={"fixedimage":fixedimagestack,"image":imagestack}
+		JSTask.__init__(self,"SptHacBatch",data,{},"")
 		
-		print "\n(e2spt_hac.py)(Align3DTaskAVSA) Will call alignment function"
-		ret=alignment( fixedimage, image, classoptions['label'], classoptions['options'],xformslabel,classoptions['round'],None,'e2spt_hac',refpreprocess)
-				
-		#ret=alignment(fixedimage,image,classoptions['label'],classoptions['options'],xformslabel,classoptions['currentIter'],classoptions['transform'],'e2spt_classaverage',refpreprocess)
-
-		print "\n(e2spt_hac.py)(Align3DTaskAVSA) Done with alignment, back in e2spt_hac.py."
+		self.classoptions={"pairs":pairs,"options":options,'round':round,'iters':iters}
+	
+	def execute(self,callback=None):
+		"""Returns {"final":[best final alignments for each pair],"coarse":[...]}"""
 		
-		bestfinal=ret[0]
-		bestcoarse=ret[1]
+		fixedn = None
+		fixedimage = None
+		finals = []
+		coarses = []
+		for i,pair in enumerate( self.classoptions['pairs'] ):
+			if callback!=None : callback( int( 100 * i / len( self.classoptions['pairs'] ) ) )
+			
+			if pair['pAn'] != fixedn :
+				fixedn = pair['pAn']
+				fixedimage = EMData( self.data["fixedimage"], fixedn )
+			image = EMData( self.data["image"], pair['pBn'] )
+			
+			classoptions = dict(pair)
+			classoptions.update( {"options":self.classoptions['options'],'round':self.classoptions['round'],'iters':self.classoptions['iters']} )
+			
+			ret = align_pair( fixedimage.copy(), image, classoptions )
+			finals.append( ret["final"] )
+			coarses.append( ret["coarse"] )
 		
-		return {"final":bestfinal,"coarse":bestcoarse}
+		return {"final":finals,"coarse":coarses}
 		
 
 def plotter(xaxis,yaxis,options,name,maxX,maxY,invert=1,sort=1):
@@ -1680,6 +1800,7 @@ def plotter(xaxis,yaxis,options,name,maxX,maxY,invert=1,sort=1):
 	return	
 
 jsonclasses["Align3DTaskAVSA"]=Align3DTaskAVSA.from_jsondict
+jsonclasses["Align3DTaskAVSABatch"]=Align3DTaskAVSABatch.from_jsondict
 
 if __name__ == '__main__':
 	main()
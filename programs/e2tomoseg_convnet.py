@@ -5,6 +5,9 @@ import random
 import numpy as np
 from EMAN2 import *
 import cPickle
+import threading
+import Queue
+import traceback
 
 def import_theano():
 	global theano,T,conv,downsample
@@ -37,6 +40,7 @@ def main():
 	parser.add_argument("--tomograms", type=str,help="Tomograms input.", default=None,guitype='filebox',browser="EMBrowserWidget(withmodal=True)", row=1, col=0, rowspan=1, colspan=3, mode="test")
 	parser.add_argument("--applying", action="store_true", default=False ,help="Applying the neural network on tomograms", guitype='boolbox', row=4, col=0, rowspan=1, colspan=1, mode='test[True]')
 	parser.add_argument("--output", type=str,help="Segmentation out file name", default="tomosegresult.mrcs", guitype='strbox', row=3, col=0, rowspan=1, colspan=1, mode="test")
+	parser.add_argument("--applybatch", type=int,help="Number of images segmented together when applying the neural network. Larger batches are faster but use more memory. Default is 4.", default=4, guitype='intbox', row=4, col=1, rowspan=1, colspan=1, mode="test")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 
 	(options, args) = parser.parse_args()
@@ -220,73 +224,106 @@ def apply_neuralnet(convnet,options):
 	nframe=EMUtil.get_image_count(options.tomograms)
 	is3d=False
 	### deal with 3D volume or image stack
+	e=EMData(options.tomograms, 0, True)
+	shape=[e["nx"],e["ny"],e["nz"]]
 	if nframe==1:
-		e=EMData(options.tomograms, 0, True)
 		nframe=e["nz"]
 		if nframe>1:
-			esz=e["nx"]
 			is3d=True
+			shape[2]=1
 	
-	for nf in range(nframe):
-		if is3d:
-			e=EMData(options.tomograms,0,False,Region(0,0,nf,esz,esz,1))
-		else:
-			e=EMData(options.tomograms,nf)
+	### the input shape is a shared variable of the network, so the function only needs to be compiled once, 
+	### and the shape is updated for each batch
+	batch=max(options.applybatch,1)
+	convnet.update_shape((batch, 1, shape[0],shape[1]))
+	print "Compiling the convolution net..."
+	test_imgs = theano.function(
+		inputs=[convnet.x],
+		outputs=convnet.clslayer.hidden
+	)
+	newshp=convnet.outsize
+	
+	### images are read and preprocessed in a separate thread while the previous batch is segmented
+	queue=Queue.Queue(2)
+	thrd=threading.Thread(target=read_batches,args=(options.tomograms,nframe,is3d,shape,batch,queue))
+	thrd.daemon=True
+	thrd.start()
+	
+	out=np.zeros((nframe,newshp,newshp),dtype="float32")
+	nf=0
+	while nf<nframe:
+		data=queue.get()
+		if data is None:
+			print "Error reading images from {}...exit.".format(options.tomograms)
+			exit()
 		
-		print "Preprocessing image No {}...".format(nf)
-
-
-
-		e.process_inplace("normalize")
-		enp=EMNumPy.em2numpy(e)
-		enp[enp>3.0]=3.0
-		enp/=np.max(enp)
-		ar=[enp]
-		shape=[e["nx"],e["ny"],e["nz"]]
-		convnet.update_shape((1, 1, shape[0],shape[1]))
-		data=theano.shared(np.asarray(ar,dtype=theano.config.floatX),borrow=True)
-		img=data[0].eval().reshape(shape[0],shape[1]).T
-		e = EMNumPy.numpy2em(img.astype("float32"))
-		#e.process_inplace("normalize")
-		newshp=convnet.outsize
-		e.scale(float(newshp)/float(shape[0]))
-		e=e.get_clip(Region((shape[0]-newshp)/2,(shape[0]-newshp)/2,newshp,newshp))
 		if nframe==1:
+			img=data[0].reshape(shape[0],shape[1]).T
+			e = EMNumPy.numpy2em(img.astype("float32"))
+			e.scale(float(newshp)/float(shape[0]))
+			e=e.get_clip(Region((shape[0]-newshp)/2,(shape[0]-newshp)/2,newshp,newshp))
 			e.process_inplace("normalize")
 			e.write_image(options.output,-1)
-		#print np.shape(data.get_value())
-		print "Applying the convolution net..."
-		test_imgs = theano.function(
-			inputs=[],
-			outputs=convnet.clslayer.hidden,
-			givens={
-				convnet.x: data[0]
-			}
-		)
-			
-		img=test_imgs()
-		print np.shape(img)
-		img=img.reshape(convnet.outsize,convnet.outsize).T
-		e = EMNumPy.numpy2em(img.astype("float32"))
-		#print "Post-processing..."
-		#eg=20
-		#e.process_inplace("mask.zeroedge2d",{"x0":eg,"x1":eg,"y0":eg,"y1":eg})
-		#e.process_inplace("normalize")
-		#e.process_inplace("threshold.belowtozero",{"minval":0})
-		#e.process_inplace("filter.lowpass.gauss",{"cutoff_abs":.05})
-		#e.div(e["maximum"])
-		if nframe==1:
-			e.process_inplace("normalize")
+		
+		print "Applying the convolution net on images {} to {}...".format(nf,nf+len(data)-1)
+		convnet.update_shape((len(data), 1, shape[0],shape[1]))
+		img=test_imgs(data)
+		for i in range(len(data)):
+			out[nf+i]=img[i].reshape(newshp,newshp).T
+		nf+=len(data)
+	
+	thrd.join()
+	
+	e = EMNumPy.numpy2em(out)
+	#print "Post-processing..."
+	#eg=20
+	#e.process_inplace("mask.zeroedge2d",{"x0":eg,"x1":eg,"y0":eg,"y1":eg})
+	#e.process_inplace("normalize")
+	#e.process_inplace("threshold.belowtozero",{"minval":0})
+	#e.process_inplace("filter.lowpass.gauss",{"cutoff_abs":.05})
+	#e.div(e["maximum"])
+	if nframe==1:
+		e.process_inplace("normalize")
 		e.write_image(options.output,-1)
-		print "Output written to {}.".format(options.output)
+	else:
+		e.write_image(options.output,0)
+	print "Output written to {}.".format(options.output)
 	
 	if nframe>1:
 		ss=options.output
 		fout=ss[:ss.rfind('.')]+"_pp.hdf"
-		e=EMData(ss,0,True)
 		apix=e["apix_x"]
-		launch_childprocess("e2proc2d.py {} {} --process math.fft.resample:n=.5 --apix {} --twod2threed".format(ss,fout, apix))
+		pp=None
+		for nf in range(nframe):
+			s=EMNumPy.numpy2em(out[nf]).process("math.fft.resample",{"n":.5})
+			if pp==None:
+				pp=EMData(s["nx"],s["ny"],nframe)
+			pp.insert_clip(s,(0,0,nf))
+		pp["apix_x"]=pp["apix_y"]=pp["apix_z"]=apix
+		pp.write_image(fout,0)
 		
+def read_batches(fname,nframe,is3d,shape,batch,queue):
+	"""Reads and normalizes the images for apply_neuralnet, and puts them in queue as arrays of batch flattened images. Puts None on error."""
+	try:
+		for b in range(0,nframe,batch):
+			data=[]
+			for nf in range(b,min(b+batch,nframe)):
+				if is3d:
+					e=EMData(fname,0,False,Region(0,0,nf,shape[0],shape[1],1))
+				else:
+					e=EMData(fname,nf)
+					if e["nx"]!=shape[0] or e["ny"]!=shape[1]:
+						raise Exception,"Image {} is not the same size as the first image".format(nf)
+				
+				e.process_inplace("normalize")
+				enp=EMNumPy.em2numpy(e)
+				enp[enp>3.0]=3.0
+				enp/=np.max(enp)
+				data.append(enp.flatten())
+			queue.put(np.asarray(data,dtype=theano.config.floatX))
+	except:
+		traceback.print_exc()
+		queue.put(None)
 
 def load_particles(ptcls,labelshrink,ncopy=5):
 	num=EMUtil.get_image_count(ptcls)/2
@@ -530,9 +530,74 @@ class TrimBox:
 			self.changed = True
 
 
+class CacheBudget:
+	'''
+	A memory budget shared by every boxer image Cache. Cached objects are tracked in least recently used order
+	across all caches, and whenever the images they hold take more than maxbytes, the least recently used
+	objects are removed from whichever Cache holds them. The size of an object is that of the EMData
+	instances it holds, counted once even if shared (eg BigImage alternates).
+	
+	Note that the derived images (FLCFImage, SincBlackmanSubsampledImage etc) are written to the e2boxercache
+	database when they are generated, along with the parameters used to make them, so an evicted entry is
+	read back from disk rather than recomputed when it is requested again with the same parameters.
+	'''
+	def __init__(self,maxbytes=2*1024**3):
+		self.maxbytes = maxbytes
+		self.lru = []		# (cache,object) pairs, least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def set_max_bytes(self,maxbytes):
+		self.maxbytes = maxbytes
+		self.enforce()
+	
+	def touch(self,cache,object):
+		'''
+		Marks object (held by cache) as the most recently used, adding it if necessary
+		'''
+		self.forget(object)
+		self.lru.append((cache,object))
+	
+	def forget(self,object):
+		self.lru = [i for i in self.lru if i[1] is not object]
+	
+	def object_images(self,object):
+		return [v for v in object.__dict__.values() if isinstance(v,EMData)]
+	
+	def image_bytes(self,image):
+		return image.get_xsize()*image.get_ysize()*image.get_zsize()*4
+	
+	def get_used_bytes(self):
+		seen = {}
+		for cache,object in self.lru:
+			for image in self.object_images(object): seen[id(image)] = self.image_bytes(image)
+		return sum(seen.values())
+	
+	def enforce(self):
+		'''
+		Evicts least recently used objects until the budget is met. The most recently used object is always kept.
+		'''
+		used = self.get_used_bytes()
+		while used > self.maxbytes and len(self.lru) > 1:
+			cache,object = self.lru.pop(0)
+			cache.remove_from_cache(object)
+			self.evictions += 1
+			used = self.get_used_bytes()
+	
+	def get_stats(self):
+		return {"hits":self.hits,"misses":self.misses,"evictions":self.evictions,"entries":len(self.lru),"bytes":self.get_used_bytes(),"maxbytes":self.maxbytes}
+	
+	def print_stats(self):
+		st = self.get_stats()
+		print "Boxer image cache: %(entries)d entries, %(bytes)d/%(maxbytes)d bytes, %(hits)d hits, %(misses)d misses, %(evictions)d evictions"%st
+
+CacheMemory = CacheBudget()
+
 class Cache:
 	'''
-	Provides a cache of static size (as defined by self.maxsize, self.set_max_size())
+	Provides a cache of objects holding images, limited by the memory budget shared by all caches (CacheMemory)
+	and optionally by a maximum number of entries (as defined by self.maxsize, self.set_max_size())
 	As the cache grows objects are popped off the end of the self.cache list
 	
 	===
@@ -576,53 +641,72 @@ class Cache:
 	
 	===
 	
-	use set_max_size to change the size of the cache. By default the cache has room for 10 entries, this may
-	be untenable, for instance if you're using a BigImageCache
+	use set_max_size to also limit the number of entries, by default the number is unlimited and only the
+	memory budget applies. Use CacheMemory.set_max_bytes to change the budget, and CacheMemory.print_stats
+	to see how well the caches are working
 	
 	'''
 	factory = EMAbstractFactory()
-	def __init__(self,class_name):
-		self.maxsize = 10
+	def __init__(self,class_name,budget=CacheMemory):
+		self.maxsize = None
 		self.cache = []
 		self.class_name = class_name
 		self.accessor_name = str(class_name)
+		self.budget = budget
+		self.hits = 0
+		self.misses = 0
 		Cache.factory.register(self.accessor_name,class_name)
 
 	def set_max_size(self,size):
 		'''
 		Will resize the cache if it is current larger than the new maxsize
 		'''
-		if len(self.cache) > size:
+		if size != None:
+			for object in self.cache[size:]: self.budget.forget(object)
 			self.cache = self.cache[0:size]
 
 		self.maxsize = size
 	
 	def clear_cache(self):
+		for object in self.cache: self.budget.forget(object)
 		self.cache = []
 	
+	def remove_from_cache(self,object):
+		self.cache = [i for i in self.cache if i is not object]
+	
 	def add_to_cache(self,object):
 		'''
-		Add 
+		Add an object at the front of the cache, removing the least recently used if the cache is full
 		'''
-		oldcache = self.cache
-		self.cache = [object]
-		self.cache.extend(oldcache)
-		
+		if self.maxsize != None and len(self.cache) >= self.maxsize:
+			for old in self.cache[self.maxsize-1:]: self.budget.forget(old)
+			self.cache = self.cache[:self.maxsize-1]
+		self.cache.insert(0,object)
+		self.budget.touch(self,object)
+	
+	def find(self,test):
+		'''
+		Returns the first cached object for which test(object) is true, moving it to the front, or None
+		'''
+		for i,object in enumerate(self.cache):
+			if test(object):
+				if i > 0: self.cache.insert(0,self.cache.pop(i))
+				self.hits += 1
+				self.budget.hits += 1
+				return object
+		self.misses += 1
+		self.budget.misses += 1
+		return None
+	
+	def get_stats(self):
+		return {"hits":self.hits,"misses":self.misses,"entries":len(self.cache)}
 	
 	def get_image(self,image_name, *args, **kargs):
 		# print "get_image: %s"%image_name
-		encapsulated_image = None
 		# first see if the object is already stored
-		for object in self.get_cache():
-			if object.get_image_name() == image_name:
-				encapsulated_image = object
-				break;
-			
+		encapsulated_image = self.find(lambda object:object.get_image_name() == image_name)
 			
 		if encapsulated_image == None:
-			if len(self.cache) >= self.maxsize:
-				self.cache.pop(-1)
-			
 			#if we make it here the cfimage is not cached
 			#print "had to cache an image for",image_name
 			encapsulated_image = getattr(Cache.factory,self.accessor_name)(image_name)
@@ -631,6 +715,8 @@ class Cache:
 			
 		
 		image = encapsulated_image.get_image_carefully( *args, **kargs)
+		self.budget.touch(self,encapsulated_image)
+		self.budget.enforce()
 		if image != None:
 			# A segfault was occuring at this return statement
 			#return image.copy()
@@ -641,24 +727,18 @@ class Cache:
 	
 	
 	def get_object(self,image_name):
-		for object in self.get_cache():
-			if object.get_image_name() == image_name:
-				return object
+		encapsulated_object = self.find(lambda object:object.get_image_name() == image_name)
 		
-		if len(self.cache) >= self.maxsize:
-			self.cache.pop(-1)
+		if encapsulated_object == None:
+			encapsulated_object = getattr(Cache.factory,self.accessor_name)(image_name)
+			self.add_to_cache(encapsulated_object)
 		
-		encapsulated_object = getattr(Cache.factory,self.accessor_name)(image_name)
-		self.add_to_cache(encapsulated_object)
+		self.budget.touch(self,encapsulated_object)
+		self.budget.enforce()
 		return encapsulated_object
 	
 	def get_image_directly(self,construction_argument):
-		encapsulated_image = None
-		for object in self.get_cache():
-			if object.get_construction_argument() == construction_argument:
-				encapsulated_image = object
-				break
-			
+		encapsulated_image = self.find(lambda object:object.get_construction_argument() == construction_argument)
 		
 		## if we make it here the image is not cached
 		if encapsulated_image == None:
@@ -666,6 +746,8 @@ class Cache:
 			self.add_to_cache(encapsulated_image)
 			
 		image = encapsulated_image.get_image()
+		self.budget.touch(self,encapsulated_image)
+		self.budget.enforce()
 		if image != None:
 			return image
 		else:
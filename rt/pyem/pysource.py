@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+"""Loads selected pure-python functions and classes straight from a source file in the tree, so they can be
+tested without the compiled EMAN2 library. Only the named top-level definitions are executed."""
+
+import ast
+import os
+import unittest
+
+SRCROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+def load(relpath, names, namespace=None):
+    """Returns a dict containing the top-level defs/classes 'names' from SRCROOT/relpath, executed in 'namespace'
+    (a dict of the module globals they need). Raises unittest.SkipTest outside of a source tree."""
+    path = os.path.join(SRCROOT, relpath)
+    if not os.path.exists(path):
+        raise unittest.SkipTest("source file %s not available" % relpath)
+
+    tree = ast.parse(open(path).read(), path)
+    body = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names]
+    missing = set(names) - set(node.name for node in body)
+    if missing:
+        raise Exception("%s does not define %s" % (relpath, ", ".join(sorted(missing))))
+
+    if namespace is None:
+        namespace = {}
+    namespace.setdefault("__name__", "pysource_" + os.path.basename(path).split(".")[0])
+    exec compile(ast.Module(body=body), path, "exec") in namespace
+    return namespace
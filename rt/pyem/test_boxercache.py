@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+import unittest
+import pysource
+
+class FakeEMData:
+    """only the size of the image matters to the cache budget"""
+    def __init__(self, nx, ny=1, nz=1):
+        self.size = (nx, ny, nz)
+    def get_xsize(self): return self.size[0]
+    def get_ysize(self): return self.size[1]
+    def get_zsize(self): return self.size[2]
+
+class Holder:
+    """a cached object, holding one or more images"""
+    def __init__(self, name, *images):
+        self.name = name
+        for i, image in enumerate(images):
+            setattr(self, "image%d" % i, image)
+        self.other = "not an image"
+
+class TestCacheBudget(unittest.TestCase):
+    """shared memory budget of the boxer image caches"""
+
+    def setUp(self):
+        ns = pysource.load("libpyEM/EMAN2.py", ["EMAbstractFactory", "EMFunctor"], {"EMData": FakeEMData})
+        pysource.load("pyemtbx/boxertools.py", ["CacheBudget"], ns)
+        ns["CacheMemory"] = ns["CacheBudget"]()
+        pysource.load("pyemtbx/boxertools.py", ["Cache"], ns)
+        self.ns = ns
+
+    def names(self, cache):
+        return [o.name for o in cache.cache]
+
+    def test_eviction_order(self):
+        """test CacheBudget least recently used eviction ....."""
+        budget = self.ns["CacheBudget"](10 * 400)
+        c1 = self.ns["Cache"](Holder, budget)
+        c2 = self.ns["Cache"](FakeEMData, budget)
+
+        a, b, c, d = [Holder(n, FakeEMData(100, 3)) for n in "abcd"]    # 1200 bytes each
+        c1.add_to_cache(a)
+        c2.add_to_cache(b)
+        c1.add_to_cache(c)
+        self.assertEqual(budget.get_used_bytes(), 3600)
+        self.assertEqual(budget.evictions, 0)
+
+        # using a makes b the least recently used, which goes when d is added
+        self.assert_(c1.find(lambda o: o.name == "a") is a)
+        budget.touch(c1, a)
+        c1.add_to_cache(d)
+        budget.enforce()
+        self.assertEqual(self.names(c1), ["d", "a", "c"])
+        self.assertEqual(self.names(c2), [])
+        self.assertEqual(budget.evictions, 1)
+        self.assertEqual([o.name for cache, o in budget.lru], ["c", "a", "d"])
+
+        # shrinking the budget removes the oldest first, but always keeps the most recent
+        budget.set_max_bytes(2500)
+        self.assertEqual(self.names(c1), ["d", "a"])
+        budget.set_max_bytes(0)
+        self.assertEqual(self.names(c1), ["d"])
+        self.assertEqual(budget.evictions, 3)
+        self.assertEqual(budget.get_stats()["entries"], 1)
+
+    def test_shared_images(self):
+        """test CacheBudget counts shared images once ........"""
+        budget = self.ns["CacheBudget"](10000)
+        cache = self.ns["Cache"](Holder, budget)
+        shared = FakeEMData(10, 10)    # 400 bytes
+        cache.add_to_cache(Holder("a", shared, FakeEMData(10, 10)))
+        cache.add_to_cache(Holder("b", shared))
+        self.assertEqual(budget.get_used_bytes(), 800)
+
+    def test_cache_limits(self):
+        """test Cache max size and hit counting .............."""
+        budget = self.ns["CacheBudget"](10000)
+        cache = self.ns["Cache"](Holder, budget)
+        for n in "abc":
+            cache.add_to_cache(Holder(n, FakeEMData(10)))
+        cache.set_max_size(2)
+        self.assertEqual(self.names(cache), ["c", "b"])
+        self.assertEqual([o.name for c, o in budget.lru], ["b", "c"])
+
+        self.assertEqual(cache.find(lambda o: o.name == "a"), None)
+        self.assertEqual(cache.find(lambda o: o.name == "b").name, "b")
+        self.assertEqual(self.names(cache), ["b", "c"])
+        self.assertEqual((budget.hits, budget.misses), (1, 1))
+
+        cache.clear_cache()
+        self.assertEqual(budget.lru, [])
+
+def test_main():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCacheBudget)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+import unittest
+import Queue
+import threading
+import traceback
+import numpy as np
+import pysource
+
+KMEANS = ["kmeans_minibatch", "kmeans_pp", "kmeans_assign", "kmeans_chunks", "kmeans_worker"]
+
+class FakeImage(dict):
+    """stands in for the EMData returned by KMeansData.image()"""
+    def __init__(self, v):
+        dict.__init__(self)
+        self.v = v
+
+class FakeData:
+    """KMeansData interface over an in-memory array"""
+    def __init__(self, x):
+        self.x = x
+
+    def __len__(self):
+        return len(self.x)
+
+    def rows(self, idx):
+        return self.x[idx].astype(np.float32)
+
+    def image(self, v):
+        return FakeImage(np.array(v))
+
+class TestKMeans(unittest.TestCase):
+    """mini-batch k-means in e2classifykmeans.py"""
+
+    def setUp(self):
+        self.k = pysource.load("programs/e2classifykmeans.py", KMEANS,
+                               {"np": np, "threading": threading, "Queue": Queue, "traceback": traceback})
+        rng = np.random.RandomState(7)
+        self.ncls = 5
+        self.truecenters = rng.normal(0, 10, (self.ncls, 16))
+        self.truelab = np.arange(600) % self.ncls
+        rng.shuffle(self.truelab)
+        self.x = self.truecenters[self.truelab] + rng.normal(0, 0.5, (600, 16))
+
+    def check_purity(self, lab):
+        """every found class must contain exactly one of the true clusters"""
+        lab = np.asarray(lab)
+        for c in range(self.ncls):
+            self.assertEqual(len(set(lab[self.truelab == c])), 1)
+        self.assertEqual(len(set(lab)), self.ncls)
+
+    def test_kmeans_assign(self):
+        """test kmeans_assign ................................"""
+        idx = np.arange(0, 600, 3)
+        idx2, lab, sums, sqsums, cnt = self.k["kmeans_assign"](FakeData(self.x), idx, self.truecenters, True)
+        self.assert_(idx2 is idx)
+        self.assertEqual(lab.tolist(), self.truelab[idx].tolist())
+        self.assertEqual(cnt.sum(), len(idx))
+        for c in range(self.ncls):
+            members = self.x[idx][lab == c]
+            self.assertEqual(cnt[c], len(members))
+            self.assert_(np.allclose(sums[c], members.sum(0), rtol=1e-5))
+            self.assert_(np.allclose(sqsums[c], (members ** 2).sum(0), rtol=1e-5))
+
+    def test_kmeans_pp(self):
+        """test kmeans_pp ...................................."""
+        centers = self.k["kmeans_pp"](self.x, self.ncls, np.random.RandomState(3))
+        self.assertEqual(centers.shape, (self.ncls, 16))
+        # distinct rows of the data, one near each true cluster
+        near = [((self.truecenters - c) ** 2).sum(1).argmin() for c in centers]
+        self.assertEqual(sorted(near), range(self.ncls))
+        for c in centers:
+            self.assert_(((self.x - c) ** 2).sum(1).min() == 0)
+
+    def test_kmeans_chunks(self):
+        """test kmeans_chunks ................................"""
+        res = list(self.k["kmeans_chunks"](range(20), 3, lambda j: j * j))
+        self.assertEqual(sorted(res), [j * j for j in range(20)])
+
+        def fail(j):
+            if j == 5: raise ValueError("test")
+            return j
+        import sys, StringIO
+        err, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertRaises(Exception, list, self.k["kmeans_chunks"](range(10), 2, fail))
+        finally:
+            sys.stderr = err
+
+    def test_kmeans_minibatch(self):
+        """test kmeans_minibatch ............................."""
+        for threads in (1, 3):
+            imgs, clsid = self.k["kmeans_minibatch"](FakeData(self.x), self.ncls, 100, 20, threads, 2, True, True, 0)
+            self.assertEqual(len(imgs), 2 * self.ncls)
+            self.assertEqual(len(clsid), len(self.x))
+            self.check_purity(clsid)
+
+            clsid = np.array(clsid)
+            for c in range(self.ncls):
+                members = self.x[clsid == c]
+                self.assertEqual(imgs[c]["ptcl_repr"], len(members))
+                self.assert_(np.allclose(imgs[c].v, members.mean(0), atol=1e-4))
+                self.assert_(np.allclose(imgs[self.ncls + c].v, members.std(0), atol=1e-3))
+
+def test_main():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestKMeans)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
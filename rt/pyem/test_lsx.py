@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+import unittest
+import os
+import shutil
+import tempfile
+import pysource
+
+class TestLSXFile(unittest.TestCase):
+    """LSXFile (#LSX) record access"""
+
+    def setUp(self):
+        self.LSXFile = pysource.load("libpyEM/EMAN2.py", ["LSXFile"], {"os": os})["LSXFile"]
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.lst")
+        self.recs = [(i * 3, "particles/file%d.hdf" % (i % 4), "c%d" % i if i % 2 else None) for i in range(25)]
+
+        lst = self.LSXFile(self.path)
+        for r in self.recs:
+            lst.write(-1, r[0], r[1], r[2])
+        lst.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_columns(self, cols, recs):
+        nums, fsps, cmts = cols
+        self.assertEqual(nums.tolist(), [r[0] for r in recs])
+        self.assertEqual(fsps, [r[1] for r in recs])
+        self.assertEqual(cmts, [r[2] for r in recs])
+
+    def test_read_range(self):
+        """test LSXFile.read_range .........................."""
+        lst = self.LSXFile(self.path, True, True)
+        self.assertEqual(len(lst), len(self.recs))
+        self.check_columns(lst.read_range(), self.recs)
+        self.check_columns(lst.read_range(5, 12), self.recs[5:12])
+        self.check_columns(lst.read_range(20, 100), self.recs[20:])
+        self.check_columns(lst.read_range(7, 7), [])
+        lst.close()
+
+    def test_read_many(self):
+        """test LSXFile.read_many ..........................."""
+        lst = self.LSXFile(self.path, True, True)
+        idx = [24, 0, 13, 13, 2]
+        self.check_columns(lst.read_many(idx), [self.recs[i] for i in idx])
+        self.assertRaises(Exception, lst.read_many, [25])
+        lst.close()
+
+    def test_read_write_mode(self):
+        """test LSXFile.read_range without mmap ............."""
+        lst = self.LSXFile(self.path, True)
+        self.check_columns(lst.read_range(3, 9), self.recs[3:9])
+        self.check_columns(lst.read_many([9, 1]), [self.recs[9], self.recs[1]])
+        lst.close()
+
+    def test_readonly_unnormalized(self):
+        """test read-only LSXFile with ragged lines ........."""
+        # a hand-edited file, with lines shorter and longer than the declared length
+        out = open(self.path, "w")
+        out.write("#LSX\n# comment\n# 20\n")
+        for r in self.recs:
+            if r[2] is None:
+                out.write("%d\t%s\n" % (r[0], r[1]))
+            else:
+                out.write("%d\t%s\t%s\n" % r)
+        out.close()
+
+        lst = self.LSXFile(self.path, True, True)
+        self.assertEqual(len(lst), len(self.recs))
+        self.check_columns(lst.read_range(), self.recs)
+        self.check_columns(lst.read_range(10, 15), self.recs[10:15])
+        self.check_columns(lst.read_many([24, 3]), [self.recs[24], self.recs[3]])
+        self.assertEqual(lst.read(6), [self.recs[6][0], self.recs[6][1], None])
+        lst.close()
+
+        # the file must not have been rewritten
+        self.assertEqual(open(self.path).read().split("\n")[2], "# 20")
+
+def test_main():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLSXFile)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+import unittest
+import Queue
+import threading
+import traceback
+import numpy as np
+import pysource
+
+class TestRSVD(unittest.TestCase):
+    """randomized SVD used by e2msa.py --rsvd"""
+
+    def setUp(self):
+        self.m = pysource.load("programs/e2msa.py", ["rsvd_eig", "msa_chunks", "msa_worker"],
+                               {"np": np, "threading": threading, "Queue": Queue, "traceback": traceback})
+        # low rank signal with a decaying spectrum plus noise
+        rng = np.random.RandomState(5)
+        n, npix, rank = 300, 120, 8
+        u = np.linalg.qr(rng.normal(size=(n, rank)))[0]
+        v = np.linalg.qr(rng.normal(size=(npix, rank)))[0]
+        s = 100.0 * 0.6 ** np.arange(rank)
+        self.a = (np.dot(u * s, v.T) + rng.normal(0, 0.01, (n, npix))).astype(np.float32)
+
+    def chunkproduct(self, c, q):
+        a = self.a[c[0]:c[1]]
+        return np.dot(a.T, np.dot(a, q)).astype(np.float64)
+
+    def check(self, nvec, chunk, threads):
+        eigval, eigvec = self.m["rsvd_eig"](len(self.a), self.a.shape[1], nvec, self.chunkproduct, 2, chunk, threads)
+        u, s, vt = np.linalg.svd(self.a.astype(np.float64), full_matrices=False)
+
+        self.assertEqual(eigval.shape, (nvec,))
+        self.assertEqual(eigvec.shape, (self.a.shape[1], nvec))
+        self.assert_(np.allclose(eigval, s[:nvec] ** 2, rtol=1e-3))
+        # same vectors up to sign
+        self.assert_(np.allclose(np.abs((eigvec * vt[:nvec].T).sum(0)), 1.0, atol=1e-3))
+
+    def test_rsvd_serial(self):
+        """test rsvd_eig against a dense SVD ................."""
+        self.check(5, 1000, 1)
+
+    def test_rsvd_chunks(self):
+        """test rsvd_eig with threaded chunks ................"""
+        self.check(5, 37, 3)
+
+def test_main():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRSVD)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+import unittest
+import os
+import shutil
+import tempfile
+import pysource
+
+TEXTIO = ["text_token", "text_format", "text_cache_name", "text_cache_key", "text_cache_load", "text_cache_store",
+          "read_text_row", "write_text_row", "read_text_file", "write_text_file"]
+
+class TestTextIO(unittest.TestCase):
+    """sparx text parameter file reading/writing"""
+
+    def setUp(self):
+        self.u = pysource.load("sparx/libpy/utilities.py", TEXTIO)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "params.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_text_token(self):
+        """test text_token ..................................."""
+        text_token = self.u["text_token"]
+        self.assertEqual(map(text_token, ["1", "-7", "+3", "0012", "1.5", "2e3", "abc", "-", "1-2"]),
+                         [1, -7, 3, 12, 1.5, 2000.0, "abc", "-", "1-2"])
+        self.assertEqual(type(text_token("12")), int)
+        self.assertEqual(type(text_token("12.0")), float)
+        self.assertEqual(type(text_token("99999999999999999999")), long)
+
+    def test_row_roundtrip(self):
+        """test write_text_row/read_text_row ................."""
+        data = [[1, 2.5, -3, 4.0], [0, 1.0e-7, 123456, -0.25]]
+        self.u["write_text_row"](data, self.path)
+        self.assertEqual(self.u["read_text_row"](self.path), data)
+
+        self.u["write_text_row"]([5, 6.5], self.path)
+        self.assertEqual(self.u["read_text_row"](self.path), [[5], [6.5]])
+
+    def test_file_roundtrip(self):
+        """test write_text_file/read_text_file ..............."""
+        cols = [[1, 2, 3], [0.5, -1.5, 2.25]]
+        self.u["write_text_file"](cols, self.path)
+        self.assertEqual(self.u["read_text_file"](self.path, -1), cols)
+        self.assertEqual(self.u["read_text_file"](self.path, 1), cols[1])
+
+    def test_cache(self):
+        """test read_text_row sidecar cache ..................."""
+        read_text_row = self.u["read_text_row"]
+        self.u["write_text_row"]([[1, 2.5], [3, 4.5]], self.path)
+        self.assertEqual(read_text_row(self.path, cache=True), [[1, 2.5], [3, 4.5]])
+        self.assert_(os.path.exists(self.u["text_cache_name"](self.path)))
+        self.assertEqual(read_text_row(self.path, cache=True), [[1, 2.5], [3, 4.5]])
+
+        # same size and mtime, different contents, must not return the stale data
+        st = os.stat(self.path)
+        self.u["write_text_row"]([[7, 8.5], [9, 1.5]], self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime))
+        self.assertEqual(os.path.getsize(self.path), st.st_size)
+        self.assertEqual(read_text_row(self.path, cache=True), [[7, 8.5], [9, 1.5]])
+
+        # the key depends on the reader
+        key = self.u["text_cache_key"]
+        self.assertNotEqual(key(self.path, "row"), key(self.path, "col0"))
+        self.assertEqual(self.u["read_text_file"](self.path, 0, cache=True), [7, 9])
+
+def test_main():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTextIO)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -1759,49 +1759,126 @@ def read_spider_doc(fnam):
 			line = inf.readline()
 	return data
 
-def read_text_row(fnam, format="", skip=";"):
+def text_token(w):
+	"""
+		Convert one token of a text parameter file to int or float, or leave it as a string,
+		the same way as int() then float() would, but without raising exceptions for the common cases.
+	"""
+	if w.strip().lstrip("+-").isdigit():
+		try:  return int(w)
+		except ValueError:  pass
+	try:  return float(w)
+	except ValueError:  return w
+
+def text_format(tpt):
+	"""
+		Format one value for write_text_row/write_text_file.
+	"""
+	qtp = type(tpt)
+	if qtp == int:		return "  %12d"%tpt
+	elif qtp == float:
+		if( float(int(tpt)) == tpt ):	return "  %12.5e"%tpt
+		else:							return "  %12.5g"%tpt
+	else:						return "  %s"%tpt
+
+def text_cache_name(fnam):
+	"""
+		Name of the binary sidecar file caching the parsed contents of text file fnam.
+	"""
+	import os
+	d, f = os.path.split(fnam)
+	return os.path.join(d, "." + f + ".cache")
+
+def text_cache_key(fnam, kind):
+	"""
+		Key identifying the contents of text file fnam for the sidecar cache. Besides size and mtime it includes
+		the inode and a checksum of the contents, since fixed-width files rewritten within one mtime tick
+		(e.g. on NFS) keep the same size.
+	"""
+	import os, sys, zlib
+	st  = os.stat(fnam)
+	inf = open(fnam, "rb")
+	crc = zlib.crc32(inf.read())
+	inf.close()
+	return (sys.hexversion, kind, st.st_size, st.st_mtime, st.st_ino, crc)
+
+def text_cache_load(fnam, kind):
+	"""
+		Return the data stored by text_cache_store() for text file fnam, or None if there is no
+		cache, it was made by a different reader (kind), or fnam has changed since.
+	"""
+	import marshal
+	try:
+		inf = open(text_cache_name(fnam), "rb")
+		key, data = marshal.load(inf)
+		inf.close()
+		if key != text_cache_key(fnam, kind):  return None
+	except:  return None
+	return data
+
+def text_cache_store(fnam, kind, data):
+	"""
+		Store the parsed contents of text file fnam in its sidecar cache. Failures are ignored.
+	"""
+	import os, marshal
+	try:
+		key = text_cache_key(fnam, kind)
+		tmp = text_cache_name(fnam) + ".%d"%os.getpid()
+		outf = open(tmp, "wb")
+		marshal.dump((key, data), outf)
+		outf.close()
+		os.rename(tmp, text_cache_name(fnam))
+	except:  pass
+
+def read_text_row(fnam, format="", skip=";", cache=False):
 	"""
 	 	Read a column-listed txt file.
 		INPUT: filename: name of the Doc file
+		       cache: if True, the parsed data are kept in a binary sidecar file and reused while the text file is unchanged
 	 	OUTPUT:
 	    	nc : number of entries in each lines (number of columns)
 	    	len(data)/nc : number of lines (rows)
 	    	data: List of numbers from the doc file
  	"""
-	from string import split
+	if cache:
+		data = text_cache_load(fnam, "row%s%s"%(format, skip))
+		if data is not None:  return data
+
+	inf  = open(fnam, "r")
+	lines = inf.readlines()
+	inf.close()
 
-	inf  = file(fnam, "r")
-	strg = inf.readline()
-	x    = []
 	data = []
-	while (len(strg) > 0):
-		com_line = False
-		for j in xrange(len(strg)):
-			if(strg[j] == skip):	com_line = True
-		if com_line == False:
-			word=split(strg)
-			if format == "s" :
-				key = int(word[1])
-				if key != len(word) - 2:
-					del word
-					word = []
-					word.append(strg[0 : 5])
-					word.append(strg[6 : 7])
-					for k in xrange(key):
-						k_start = 7       + k*13
-						k_stop  = k_start + 13
-						word.append(strg[k_start : k_stop])
-			line=[]
-			for i in xrange(len(word)):
-				try:  line.append(int(word[i]))
-				except:
-					try:  	line.append(float(word[i]))
-					except:	line.append(word[i])
-			data.append(line)
-		strg=inf.readline()
-	inf.close
+	for strg in lines:
+		if len(skip) == 1 and skip in strg:  continue
+		word = strg.split()
+		if format == "s" :
+			key = int(word[1])
+			if key != len(word) - 2:
+				del word
+				word = []
+				word.append(strg[0 : 5])
+				word.append(strg[6 : 7])
+				for k in xrange(key):
+					k_start = 7       + k*13
+					k_stop  = k_start + 13
+					word.append(strg[k_start : k_stop])
+		data.append(map(text_token, word))
+
+	if cache:  text_cache_store(fnam, "row%s%s"%(format, skip), data)
 	return data
 
+def read_text_row_array(fnam, skip=";"):
+	"""
+		Read a numerical column-listed txt file, as written by write_text_row, into a 2-D float64 numpy array
+		(rows x columns). Lines containing the skip character are ignored. All rows must have the same length.
+	"""
+	import numpy as np
+	inf  = open(fnam, "r")
+	lines = [strg for strg in inf.readlines() if not (len(skip) == 1 and skip in strg) and strg.strip() != ""]
+	inf.close()
+	if len(lines) == 0:  return np.zeros((0, 0))
+	return np.array("".join(lines).split(), dtype=np.float64).reshape(len(lines), -1)
 
 def write_text_row(data, file_name):
 	"""
@@ -1813,66 +1890,63 @@ def write_text_row(data, file_name):
 		 If only one list is given, the file will contain one line
 	"""
 	import types
-	outf = open(file_name, "w")
 	if (type(data[0]) == types.ListType):
 		# It is a list of lists
-		for i in xrange(len(data)):
-			for j in xrange(len(data[i])):
-				tpt = data[i][j]
-				qtp = type(tpt)
-				if qtp == types.IntType:			outf.write("  %12d"%tpt)
-				elif qtp == types.FloatType:
-					if( float(int(tpt)) == tpt ):	outf.write("  %12.5e"%tpt)
-					else:							outf.write("  %12.5g"%tpt)
-				else:                   			outf.write("  %s"%tpt)
-			outf.write("\n")
+		out = ["".join(map(text_format, row)) + "\n" for row in data]
 	else:
 		# Single list
-		for j in xrange(len(data)):
-			tpt = data[j]
-			qtp = type(tpt)
-			if qtp == types.IntType :			outf.write("  %12d\n"%tpt)
-			elif qtp == types.FloatType:
-				if( float(int(tpt)) == tpt ):	outf.write("  %12.5e\n"%tpt)
-				else:							outf.write("  %12.5g\n"%tpt)
-			elif qtp == types.IntType :  		outf.write("  %12.5g\n"%tpt)
-			else:								outf.write("  %s\n"%tpt)
+		out = [text_format(tpt) + "\n" for tpt in data]
+	outf = open(file_name, "w")
+	outf.write("".join(out))
 	outf.flush()
 	outf.close()
 
+def write_text_row_array(data, file_name):
+	"""
+	   Write a 1-D or 2-D numpy array to an ASCII file in the format of write_text_row (each row of a 2-D array
+	   is a line), formatting all values at once. Integer arrays are written as ints, float arrays as floats.
+	"""
+	import numpy as np
+	a = np.asarray(data)
+	if a.ndim == 1:  a = a.reshape(-1, 1)
+	if a.dtype.kind in "iu":
+		cells = np.char.mod("  %12d", a)
+	else:
+		a = a.astype(np.float64)
+		cells = np.where(a == np.trunc(a), np.char.mod("  %12.5e", a), np.char.mod("  %12.5g", a))
+	outf = open(file_name, "w")
+	outf.write("".join(["".join(row) + "\n" for row in cells.tolist()]))
+	outf.close()
 
-def read_text_file(file_name, ncol = 0):
+def read_text_file(file_name, ncol = 0, cache=False):
 	"""
 		Read data from text file, if ncol = -1, read all columns
 		if ncol >= 0, just read the (ncol)-th column.
+		If cache is True, the parsed data are kept in a binary sidecar file and reused while the text file is unchanged.
 	"""
+	if cache:
+		data = text_cache_load(file_name, "col%d"%ncol)
+		if data is not None:  return data
 
-	from string import split
-	inf = file(file_name, "r")
-	line = inf.readline()
-	data = []
-	while len(line) > 0:
-		if ncol == -1:
-			vdata = split(line)
-			if data == []:
-				for i in xrange(len(vdata)):
-					try:     data.append([int(vdata[i])])
-					except:
-						try:  	 data.append([float(vdata[i])])
-						except:  data.append([vdata[i]])
-			else:
-				for i in xrange(len(vdata)):
-					try:  data[i].append(int(vdata[i]))
-					except:
-						try:  data[i].append(float(vdata[i]))
-						except:  data[i].append(vdata[i])
+	inf = open(file_name, "r")
+	lines = inf.readlines()
+	inf.close()
+
+	if ncol == -1:
+		rows = [map(text_token, line.split()) for line in lines]
+		rows = [row for row in rows if row != []]
+		if len(rows) > 0 and min(map(len, rows)) == max(map(len, rows)):
+			data = map(list, zip(*rows))
 		else:
-			vdata = split(line)[ncol]
-			try:     data.append(int(vdata))
-			except:
-				try:  	data.append(float(vdata))
-				except:  data.append(vdata)
-		line = inf.readline()
+			data = []
+			for row in rows:
+				if data == []:  data = [[v] for v in row]
+				else:
+					for i in xrange(len(row)):  data[i].append(row[i])
+	else:
+		data = [text_token(line.split()[ncol]) for line in lines]
+
+	if cache:  text_cache_store(file_name, "col%d"%ncol, data)
 	return data
 
 def write_text_file(data, file_name):
@@ -1891,30 +1965,14 @@ def write_text_file(data, file_name):
 		return
 
 	import types
-	outf = open(file_name, "w")
 	if (type(data[0]) == types.ListType):
 		# It is a list of lists
-		for i in xrange(len(data[0])):
-			for j in xrange(len(data)):
-				tpt = data[j][i]
-				qtp = type(tpt)
-				if qtp == types.IntType:		outf.write("  %12d"%tpt)
-				elif qtp == types.FloatType:
-					if( float(int(tpt)) == tpt ):	outf.write("  %12.5e"%tpt)
-					else:							outf.write("  %12.5g"%tpt)
-				else:                   		outf.write("  %s"%tpt)
-			outf.write("\n")
+		out = ["".join([text_format(data[j][i]) for j in xrange(len(data))]) + "\n" for i in xrange(len(data[0]))]
 	else:
 		# Single list
-		for j in xrange(len(data)):
-			tpt = data[j]
-			qtp = type(tpt)
-			if qtp == types.IntType :			outf.write("  %12d\n"%tpt)
-			elif qtp == types.FloatType:
-				if( float(int(tpt)) == tpt ):	outf.write("  %12.5e\n"%tpt)
-				else:							outf.write("  %12.5g\n"%tpt)
-			elif qtp == types.IntType :			outf.write("  %12.5g\n"%tpt)
-			else:                   			outf.write("  %s\n"%tpt)
+		out = [text_format(tpt) + "\n" for tpt in data]
+	outf = open(file_name, "w")
+	outf.write("".join(out))
 	outf.close()
 
 def reconstitute_mask(image_mask_applied_file, new_mask_file, save_file_on_disk = True, saved_file_name = "image_in_reconstituted_mask.hdf"):
@@ -3707,115 +3765,111 @@ def closest_ang( vecs, vec) :
 
 	return best_i
 """
-# This is in python, it is very slow, we keep it just for comparison, use Util.assign_projangles instead
-def assign_projangles_slow(projangles, refangles):
-	refnormal = [None]*len(refangles)
-	for i in xrange(len(refangles)):
-		refnormal[i] = getvec(refangles[i][0], refangles[i][1])
-	assignments = [[] for i in xrange(len(refangles))]
-	for i in xrange(len(projangles)):
-		best_i = nearest_ang(refnormal, projangles[i][0], projangles[i][1])
-		assignments[best_i].append(i)
-	return assignments
-
-def nearestk_projangles(projangles, whichone = 0, howmany = 1, sym="c1"):
-	# In both cases mirrored should be treated the same way as straight as they carry the same structural information
-	lookup = range(len(projangles))
-	if( sym == "c1"):
-		from utilities import getvec
-		refnormal = [None]*(len(projangles)*3)
-		for i in xrange(len(projangles)):
-			ref = getvec(projangles[i][0], projangles[i][1])
-			for k in xrange(3):
-				refnormal[3*i+k] = ref[k]
-		# remove the reference projection from the list
-		ref = [0.0,0.0,0.0]
-		for k in xrange(3):
-			ref[k] = refnormal[3*whichone+k]
-		for k in xrange(3): del refnormal[3*whichone+2-k]
-		del lookup[whichone]
-		assignments = [-1]*howmany
-		for i in xrange(howmany):
-			k = Util.nearest_ang(refnormal, ref[0],ref[1],ref[2])
-			assignments[i] = lookup[k]
-			for l in xrange(3): del refnormal[3*k+2-l]
-			del lookup[k]
-
-	elif( sym[:1] == "d" ):
-		from utilities import get_symt, getvec
-		from EMAN2 import Vec2f, Transform
-		t = get_symt(sym)
-		phir = 360.0/int(sym[1:])
-		for i in xrange(len(t)):  t[i] = t[i].inverse()
-		a = Transform({"type":"spider","phi":projangles[whichone][0], "theta":projangles[whichone][1]})
-		for l in xrange(len(t)):
-			q = a*t[l]
-			q = q.get_params("spider")
-			if(q["phi"]<phir and q["theta"] <= 90.0): break
-		refvec = getfvec(q["phi"], q["theta"])
-		#print  "refvec   ",q["phi"], q["theta"]
-
-		tempan = projangles[:]
-		del tempan[whichone], lookup[whichone]
-		assignments = [-1]*howmany
+class projDirIndex:
+	"""
+	Index of projection directions for nearest-neighbour queries.
+	Directions are stored as unit vectors, together with their symmetry-related copies and antipodes
+	(mirrored projections carry the same structural information), so the distance between two directions
+	is the smallest angle between any of the copies. Queries use a KD-tree (scipy) on the copies when available,
+	otherwise, or when most of the directions are requested, all dot products are computed in blocks.
+	  projangles - list of [phi, theta, ...]
+	  sym        - point-group symmetry, "c1", "c5", "d2", ...
+	"""
+	def __init__(self, projangles, sym = "c1"):
+		from numpy import array, radians, sin, cos, dot, concatenate, float64
 
-		for i in xrange(howmany):
-			best = -1
-			for j in xrange(len(tempan)):
-				nearest = -1.
-				a = Transform({"type":"spider","phi":tempan[j][0], "theta":tempan[j][1]})
-				for l in xrange(len(t)):
-					q = a*t[l]
-					q = q.get_params("spider")
-					vecs = getfvec(q["phi"], q["theta"])
-					s = abs(vecs[0]*refvec[0] + vecs[1]*refvec[1] + vecs[2]*refvec[2])
-					if( s > nearest ):
-						nearest = s
-						#ttt = (q["phi"], q["theta"])
-				if( nearest > best ):
-					best = nearest
-					best_j = j
-					#print  j,tempan[j][0], tempan[j][1],best,lookup[j],ttt
-			assignments[i] = lookup[best_j]
-			del tempan[best_j], lookup[best_j]
+		ang = radians(array([[q[0], q[1]] for q in projangles], float64).reshape(-1, 2))
+		self.vecs = array([sin(ang[:,1])*cos(ang[:,0]), sin(ang[:,1])*sin(ang[:,0]), cos(ang[:,1])]).T
+		self.n = len(self.vecs)
 
-	elif( sym[:1] == "c" ):
-		from utilities import get_symt, getvec
-		from EMAN2 import Vec2f, Transform
-		t = get_symt(sym)
-		phir = 360.0/int(sym[1:])
+		# direction of Transform a*t is t^T applied to the direction of a
+		if sym == "c1":  self.symm = [None]
+		else:
+			self.symm = []
+			for t in get_symt(sym):
+				m = t.get_matrix()
+				self.symm.append(array([m[0:3], m[4:7], m[8:11]], float64))
+		self.copies = [self.vecs if m is None else dot(self.vecs, m) for m in self.symm]
+		self.allvecs = concatenate(self.copies + [-v for v in self.copies])
 
-		tempan =  projangles[:]
-		del tempan[whichone], lookup[whichone]
-		assignments = [-1]*howmany
-		refvec = getvec(projangles[whichone][0], projangles[whichone][1])
+		try:
+			from scipy.spatial import cKDTree
+			self.tree = cKDTree(self.allvecs)
+		except ImportError:
+			self.tree = None
+
+	def similarity(self, qvecs):
+		"""Largest |cos| of the angle between each query vector and each (symmetry-expanded) direction, nq x n"""
+		from numpy import dot, maximum
+		sim = abs(dot(qvecs, self.copies[0].T))
+		for v in self.copies[1:]:  sim = maximum(sim, abs(dot(qvecs, v.T)))
+		return sim
+
+	def query(self, qvecs, howmany = 1, exclude = None):
+		"""
+		For each query unit vector return the indices of the howmany nearest directions, nearest first.
+		  exclude - optional list, for each query an index which should not be returned (e.g., the query itself)
+		"""
+		from numpy import array, argsort, float64
+		qvecs = array(qvecs, float64).reshape(-1, 3)
+		if exclude is None:  exclude = [-1]*len(qvecs)
+		howmany = min(howmany, self.n - (exclude[0] >= 0))
+		ncopy = len(self.allvecs)//max(self.n, 1)
+		# a direction occurs ncopy times in the tree, so this many tree neighbours always contain enough distinct directions
+		ktree = (howmany + 1)*ncopy
+
+		result = []
+		if self.tree is not None and 4*ktree < len(self.allvecs):
+			for iq in xrange(len(qvecs)):
+				dist, idx = self.tree.query(qvecs[iq], ktree)
+				seen = set([exclude[iq]])
+				near = []
+				for k in idx:
+					j = int(k)%self.n
+					if j not in seen:
+						seen.add(j)
+						near.append(j)
+						if len(near) == howmany:  break
+				result.append(near)
+		else:
+			block = max(1, (1<<22)//max(self.n*len(self.copies), 1))
+			for i0 in xrange(0, len(qvecs), block):
+				sim = self.similarity(qvecs[i0:i0+block])
+				for l in xrange(len(sim)):
+					if exclude[i0+l] >= 0:  sim[l, exclude[i0+l]] = -1.0
+				order = argsort(-sim, axis = 1, kind = "mergesort")[:, :howmany]
+				result.extend(order.tolist())
+		return result
+
+	def nearest(self, qvecs):
+		"""Index of the nearest direction for each query unit vector"""
+		return [q[0] for q in self.query(qvecs, 1)]
 
-		for i in xrange(howmany):
-			best = -1
-			for j in xrange(len(tempan)):
-				nearest = -1.
-				a = Transform({"type":"spider","phi":tempan[j][0], "theta":tempan[j][1]})
-				for l in xrange(len(t)):
-					q = a*t[l]
-					q = q.get_params("spider")
-					vecs = getfvec(q["phi"], q["theta"])
-					s = abs(vecs[0]*refvec[0] + vecs[1]*refvec[1] + vecs[2]*refvec[2])
-					if( s > nearest ):
-						nearest = s
-						#ttt = (q["phi"], q["theta"])
-				if( nearest > best ):
-					best = nearest
-					best_j = j
-					#print  j,tempan[j][0], tempan[j][1],best,lookup[j],ttt
-			assignments[i] = lookup[best_j]
-			del tempan[best_j], lookup[best_j]
+def assign_projangles_slow(projangles, refangles):
+	from utilities import getfvec
+	index = projDirIndex(refangles)
+	best = index.nearest([getfvec(q[0], q[1]) for q in projangles])
+	assignments = [[] for i in xrange(len(refangles))]
+	for i in xrange(len(projangles)):
+		assignments[best[i]].append(i)
+	return assignments
 
-	else:
+def nearestk_projangles(projangles, whichone = 0, howmany = 1, sym="c1", index = None):
+	"""
+	Return the indices of the howmany projection directions nearest to projangles[whichone], excluding whichone itself.
+	In both cases mirrored should be treated the same way as straight as they carry the same structural information.
+	whichone may also be a list, in which case a list of results is returned.
+	To avoid rebuilding it for repeated queries, a projDirIndex of projangles with the same symmetry may be given as index.
+	"""
+	from utilities import getfvec
+	if sym[:1] not in ["c", "d"]:
 		print  "  ERROR:  symmetry not supported  ",sym
-		assignments = []
-
+		return []
 
-	return assignments
+	if index is None:  index = projDirIndex(projangles, sym)
+	if type(whichone) == type(0):
+		return index.query([getfvec(projangles[whichone][0], projangles[whichone][1])], howmany, [whichone])[0]
+	return index.query([getfvec(projangles[i][0], projangles[i][1]) for i in whichone], howmany, whichone)
 
 
 def nearest_full_k_projangles(anormals, refang, howmany = 1, sym="c1"):